@@ -0,0 +1,520 @@
+import asyncio
+import click
+import contextlib
+import io
+import json
+import os
+import queue
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from habit_tracker import DataBase, Habit, Periodicity, Streaks, Analyse, HabitRecord, CheckHistory, init_predefined_habits, create_habits, archive_habits, import_checks, rebuild_all_streaks, ShardRouter, STATEMENTS, STATEMENT_CACHE_SIZE, rollover, DATE_COLUMNS, date_sql
+import service
+from vectorised_streaks import HAS_NUMPY, calculate_streaks_vectorised
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+
+def time_runs(function, runs):
+    """Calls the function the given number of times and returns the durations in seconds"""
+    timings = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+def report(label, timings):
+    """Prints the minimum and median of the timings in milliseconds"""
+    click.echo(f"{label}: min {min(timings) * 1000:.1f} ms, median {statistics.median(timings) * 1000:.1f} ms over {len(timings)} runs")
+
+def create_synthetic_habits(db, habits, days):
+    """Inserts habits created the given number of days ago, every second one weekly, and returns their names"""
+    creation_time = datetime.combine(datetime.now().date() - timedelta(days=days), datetime.min.time())
+    names = []
+    with db.transaction():
+        for number in range(habits):
+            periodicity = Periodicity.DAILY if number % 2 == 0 else Periodicity.WEEKLY
+            habit = Habit(db, f"habit {number}", "synthetic habit", number % 10 + 1, periodicity)
+            habit.creation_time = creation_time
+            db.db_insert(habit)
+            names.append(habit.name)
+    return names
+
+def synthetic_checks(names, days, density, seed=0):
+    """Yields (name, date) checks from the creation day of create_synthetic_habits until yesterday,
+    daily habits are checked on density of the days and weekly ones on density of the weeks"""
+    rng = random.Random(seed)
+    first_day = datetime.now().date() - timedelta(days=days)
+    for number, name in enumerate(names):
+        step = 1 if number % 2 == 0 else 7
+        for day in range(0, days, step):
+            if rng.random() < density:
+                yield name, (first_day + timedelta(days=day)).isoformat()
+
+def time_once(timings, label, function):
+    """Times a single call of the function and adds the duration to timings[label]"""
+    start_time = time.perf_counter()
+    function()
+    timings.setdefault(label, []).append(time.perf_counter() - start_time)
+
+def git_commit():
+    """Returns the current commit of the repository, None outside of git"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(CLI_PATH), check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@click.group()
+def benchmarks():
+    """Benchmarks for the habit tracker, every command prints its timings"""
+
+@benchmarks.command()
+@click.option('--runs', default=10, type=click.IntRange(1), help='How often each command is started.')
+def startup(runs):
+    """Times the start of cli.py --help and of a max-value query as separate processes"""
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "benchmark.db")
+        db = DataBase(db_path)
+        init_predefined_habits(db, "meditate")
+        db.close()
+        commands = {
+            "cli.py --help": ["--help"],
+            "cli.py max-value": ["--db", db_path, "max-value", "--type", "longest_streak"],
+        }
+        for label, args in commands.items():
+            # runs in the temporary directory so a stray habit_database.db would show up there and not in the repo
+            timings = time_runs(lambda: subprocess.run([sys.executable, CLI_PATH] + args, cwd=directory, check=True, capture_output=True), runs)
+            report(label, timings)
+
+@benchmarks.command()
+@click.option('--checks', default=300, type=click.IntRange(1), help='How many days are checked one after another in each mode.')
+def commit_modes(checks):
+    """Compares checks per second with one transaction per check and with a commit per write on a database file"""
+    with tempfile.TemporaryDirectory() as directory:
+        for label, batch_writes in (("transaction per check", True), ("commit per write", False)):
+            db = DataBase(os.path.join(directory, f"{label}.db"), batch_writes=batch_writes)
+            habit = Habit(db, "benchmark", "benchmark habit", 5, Periodicity.DAILY)
+            habit.creation_time = datetime.now() - timedelta(days=checks)
+            db.db_insert(habit)
+            dates = [(datetime.now() - timedelta(days=day)).strftime('%Y-%m-%d') for day in range(checks, 0, -1)]
+            start_time = time.perf_counter()
+            for checked_date in dates:
+                habit.check("benchmark", checked_date, checked_date)
+            elapsed = time.perf_counter() - start_time
+            click.echo(f"{label}: {checks / elapsed:.0f} checks/s ({elapsed:.2f}s for {checks} checks)")
+            db.close()
+
+@benchmarks.command()
+@click.option('--habits', default=200, type=click.IntRange(1), help='The number of habits.')
+@click.option('--days', default=1095, type=click.IntRange(1), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days that are checked.')
+def streak_backends(habits, days, density):
+    """Compares the calculate_streaks loop with the NumPy and the SQL window function backends, habit by habit
+    and for all habits in one pass, the NumPy backend is left out if NumPy is not installed"""
+    rng = random.Random(0)
+    db = DataBase(":memory:")
+    creation_time = datetime.now() - timedelta(days=days)
+    habit_checks = []
+    for number in range(habits):
+        periodicity = Periodicity.DAILY if number % 2 == 0 else Periodicity.WEEKLY
+        habit = Habit(db, f"habit {number}", "benchmark habit", 5, periodicity)
+        habit.creation_time = creation_time
+        db.db_insert(habit)
+        step = 1 if periodicity == Periodicity.DAILY else 7
+        check_days = [creation_time.toordinal() + day for day in range(0, days, step) if rng.random() < density]
+        habit_checks.append((habit.name, step, creation_time.toordinal(), check_days))
+        db.db_insert_check([(habit.name, check_day, 1) for check_day in check_days])
+    today = datetime.now().toordinal()
+
+    def sql_statement(name=None):
+        db.clear_streaks_for_habit(name) if name else db.cursor.execute("DELETE FROM streakdata")
+        db.insert_streaks_sql(datetime.now().date(), name)
+
+    def python_loop():
+        for name, step, _, check_days in habit_checks:
+            Streaks(db, name, rebuild=False).calculate_streaks(check_days, step, [])
+
+    report("python calculate_streaks", time_runs(python_loop, 3))
+    if HAS_NUMPY:
+        report("numpy per habit", time_runs(lambda: [calculate_streaks_vectorised([habit], today) for habit in habit_checks], 3))
+        report("numpy all habits at once", time_runs(lambda: calculate_streaks_vectorised(habit_checks, today), 3))
+    # the SQL backend reads the checks and writes the segments itself, the others get the checks handed in
+    report("sql per habit", time_runs(lambda: [sql_statement(name) for name, _, _, _ in habit_checks], 3))
+    report("sql all habits in one statement", time_runs(sql_statement, 3))
+    db.close()
+
+async def rpc_client(host, port, requests, latencies, errors):
+    """Sends the (method, params) requests one after another over one keep-alive connection and records their latencies"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for number, (method, params) in enumerate(requests):
+            body = json.dumps({"jsonrpc": "2.0", "method": method, "params": params, "id": number}).encode()
+            start_time = time.perf_counter()
+            writer.write(f"POST / HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = next(int(line.split(b":")[1]) for line in headers.split(b"\r\n") if line.lower().startswith(b"content-length"))
+            response = json.loads(await reader.readexactly(length))
+            latencies.append(time.perf_counter() - start_time)
+            if "error" in response:
+                errors.append(response["error"]["message"])
+    finally:
+        writer.close()
+
+def load_requests(names, days, clients, requests, read_share, seed=0):
+    """Splits a mix of checks on distinct days and Analyse queries over the clients"""
+    rng = random.Random(seed)
+    first_day = datetime.now().date() - timedelta(days=days)
+    unchecked = [(name, day) for name in names for day in range(days)]
+    rng.shuffle(unchecked)
+    reads = [
+        ("max_value", {"type": "longest_streak"}),
+        ("select_habits", {"name": "all", "type": "current_streak", "only": "True", "order": "DESC"}),
+        ("same_value", {"type": "periodicity", "value": "DAILY"}),
+        ("completion_rate", {"name": "all", "start": first_day.isoformat(), "end": datetime.now().date().isoformat()}),
+    ]
+    mix = []
+    for _ in range(requests):
+        if rng.random() < read_share or not unchecked:
+            mix.append(rng.choice(reads))
+        else:
+            name, day = unchecked.pop()
+            checked_date = (first_day + timedelta(days=day)).isoformat()
+            mix.append(("check", {"name": name, "startdate": checked_date, "enddate": checked_date}))
+    return [mix[client::clients] for client in range(clients)]
+
+async def run_load(host, port, client_requests):
+    latencies, errors = [], []
+    start_time = time.perf_counter()
+    await asyncio.gather(*(rpc_client(host, port, requests, latencies, errors) for requests in client_requests))
+    return time.perf_counter() - start_time, latencies, errors
+
+@benchmarks.command()
+@click.option('--host', default='127.0.0.1', help='The host of a running service (python cli.py serve).')
+@click.option('--port', default=None, type=click.IntRange(1, 65535), help='The port of a running service, without it a local instance on a synthetic database is started.')
+@click.option('--habits', default=50, type=click.IntRange(1), help='The number of synthetic daily habits of the local instance.')
+@click.option('--days', default=365, type=click.IntRange(1), help='How many days back the habits can be checked.')
+@click.option('--clients', default=50, type=click.IntRange(1), help='The number of concurrent client connections.')
+@click.option('--requests', default=5000, type=click.IntRange(1), help='The total number of requests.')
+@click.option('--read-share', default=0.5, type=click.FloatRange(0, 1), help='The share of Analyse queries, the rest are checks.')
+def service_load(host, port, habits, days, clients, requests, read_share):
+    """Load tests the JSON-RPC service with concurrent clients and reports requests per second and latency percentiles"""
+    with tempfile.TemporaryDirectory() as directory:
+        if port is None:
+            db_path = os.path.join(directory, "service.db")
+            db = DataBase(db_path, profile="concurrent")
+            names = create_synthetic_habits(db, habits, days)
+            db.cursor.execute("UPDATE habitdata SET periodicity = ?", (Periodicity.DAILY.value,))
+            db.commit()
+            db.close()
+            address = queue.Queue()
+            loop = asyncio.new_event_loop()
+            # the service runs on its own event loop in a thread, like a separate instance
+            server = threading.Thread(target=loop.run_until_complete, args=(service.serve(db_path, host, 0, ready=address.put),), daemon=True)
+            server.start()
+            host, port = address.get(timeout=30)
+        else:
+            # checks go to the habits of the running instance that the synthetic names match
+            names = [f"habit {number}" for number in range(habits)]
+        elapsed, latencies, errors = asyncio.run(run_load(host, port, load_requests(names, days, clients, requests, read_share)))
+    latencies.sort()
+    click.echo(f"{len(latencies)} requests from {clients} clients in {elapsed:.2f}s: {len(latencies) / elapsed:.0f} requests/s")
+    click.echo(f"latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+    if errors:
+        click.echo(f"{len(errors)} requests failed, e.g. {errors[0]}")
+
+@benchmarks.command()
+@click.option('--habits', default=200, type=click.IntRange(1), help='The number of habits that are looked up in turn.')
+@click.option('--calls', default=20000, type=click.IntRange(1), help='The number of lookups per variant.')
+def queries(habits, calls):
+    """Compares the per call latency of the habit lookup of Habit.check through db_query_by_name, through the habit query
+    and through the habit cache, and of the habit statement with and without the statement cache"""
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "queries.db")
+        db = DataBase(db_path)
+        names = create_synthetic_habits(db, habits, 30)
+
+        def untyped():
+            # the lookups Habit.check made before the typed queries, with their tuple unwrapping
+            for number in range(calls):
+                name = names[number % habits]
+                exists = len(db.db_query_by_name(name, "name", "habitdata")) > 0
+                periodicity = db.db_query_by_name(name, "periodicity", "habitdata")[0][0]
+                creation_time = db.db_query_by_name(name, "creation_time", "habitdata")[0][0]
+
+        def loaded():
+            for number in range(calls):
+                db.load_habit(names[number % habits])
+
+        def cached():
+            for number in range(calls):
+                db.query_schedule(names[number % habits])
+
+        report_per_call("db_query_by_name lookups", time_runs(untyped, 3), calls)
+        report_per_call("load_habit, one query", time_runs(loaded, 3), calls)
+        report_per_call("query_schedule, habit cache", time_runs(cached, 3), calls)
+        for label, cache_size in (("statement cache off", 0), (f"statement cache of {STATEMENT_CACHE_SIZE}", STATEMENT_CACHE_SIZE)):
+            connection = sqlite3.connect(db_path, cached_statements=cache_size)
+            lookup = lambda: [connection.execute(STATEMENTS["habit"], (names[number % habits],)).fetchone() for number in range(calls)]
+            report_per_call(f"habit statement, {label}", time_runs(lookup, 3), calls)
+            connection.close()
+        db.close()
+
+def report_per_call(label, timings, calls):
+    """Prints the per call latency of the fastest run in microseconds"""
+    click.echo(f"{label}: {min(timings) / calls * 1e6:.2f} us per call")
+
+@benchmarks.command(name='rollover')
+@click.option('--habits', default=100000, type=click.IntRange(1), help='The number of synthetic habits, every second one weekly.')
+@click.option('--days', default=30, type=click.IntRange(1), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days (or weeks) that are checked.')
+def rollover_benchmark(habits, days, density):
+    """Times the daily rollover of all habits on a database file whose streaks were rebuilt a few days ago"""
+    with tempfile.TemporaryDirectory() as directory:
+        db = DataBase(os.path.join(directory, "rollover.db"))
+        names = create_synthetic_habits(db, habits, days)
+        import_checks(db, synthetic_checks(names, days, density))
+        # shifts every date back, as if the streaks were last updated three days ago
+        with db.transaction():
+            for table, columns in (("checkdata", ("datemodify",)), ("streakdata", ("start_date", "end_date")), ("habitdata", ("creation_time",))):
+                db.cursor.execute(f"UPDATE {table} SET " + ", ".join(f"{column} = {column} - 3" for column in columns))
+        for label in ("first run", "second run"):
+            start_time = time.perf_counter()
+            extended, started, updated = rollover(db)
+            click.echo(f"{label}: {time.perf_counter() - start_time:.2f}s, extended {extended} and started {started} breaks, updated {updated} of {habits} habits")
+        db.close()
+
+def storage_sizes(db):
+    """Vacuums the database and returns the bytes of the file and of the check and streak tables and indexes"""
+    db.connection.execute("VACUUM")
+    page_count = db.connection.execute("PRAGMA page_count").fetchone()[0]
+    page_size = db.connection.execute("PRAGMA page_size").fetchone()[0]
+    sizes = dict(db.connection.execute("""
+        SELECT name, SUM(pgsize) FROM dbstat WHERE name IN ('checkdata', 'sqlite_autoindex_checkdata_1', 'streakdata') GROUP BY name
+        """
+    ))
+    return page_count * page_size, sizes
+
+@benchmarks.command(name='date-storage')
+@click.option('--habits', default=1000, type=click.IntRange(1), help='The number of synthetic habits, every second one weekly.')
+@click.option('--days', default=365, type=click.IntRange(1), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days (or weeks) that are checked.')
+def date_storage(habits, days, density):
+    """Compares the size of a database file with the dates as year-month-day strings and as day ordinals,
+    and times the migration from the one to the other"""
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "dates.db")
+        db = DataBase(db_path)
+        names = create_synthetic_habits(db, habits, days)
+        import_checks(db, synthetic_checks(names, days, density))
+        rebuild_all_streaks(db, workers=1)
+        # turns the file back into the layout before schema version 5
+        with db.transaction():
+            for table, columns in DATE_COLUMNS.items():
+                db.cursor.execute(f"UPDATE {table} SET " + ", ".join(f"{column} = {date_sql(column)}" for column in columns))
+            db.cursor.execute("PRAGMA user_version = 4")
+        layouts = [("date strings", storage_sizes(db))]
+        db.close()
+        start_time = time.perf_counter()
+        db = DataBase(db_path)
+        elapsed = time.perf_counter() - start_time
+        layouts.append(("day ordinals", storage_sizes(db)))
+        db.close()
+    for label, (file_size, sizes) in layouts:
+        click.echo(f"{label}: {file_size / 1024:.0f} KiB file, " + ", ".join(f"{name} {size / 1024:.0f} KiB" for name, size in sorted(sizes.items())))
+    click.echo(f"migration: {elapsed:.2f}s")
+
+@benchmarks.command(name='habit-creation')
+@click.option('--habits', default=2000, type=click.IntRange(1), help='The number of habits created in each mode.')
+@click.option('--checks', default=20, type=click.IntRange(0), help='The checked days attached to every habit.')
+def habit_creation(habits, checks):
+    """Compares creating habits with their checks one at a time, like create and select-predefined did, with create_habits"""
+    creation_time = datetime.now() - timedelta(days=checks + 1)
+    definitions = [
+        {"name": f"habit {number}", "description": "benchmark habit", "priority": number % 10 + 1, "periodicity": "DAILY",
+         "creation_time": creation_time.strftime('%Y-%m-%d'),
+         "checks": [(creation_time + timedelta(days=day)).strftime('%Y-%m-%d') for day in range(0, checks, 2)]}
+        for number in range(habits)
+    ]
+
+    def one_at_a_time(db):
+        for definition in definitions:
+            habit = Habit(db, definition["name"], definition["description"], definition["priority"], Periodicity.DAILY)
+            habit.creation_time = creation_time
+            with db.transaction():
+                db.db_insert(habit)
+                if definition["checks"]:
+                    db.db_insert_check([(habit.name, checked_date, 1) for checked_date in definition["checks"]])
+                    streaks = Streaks(db, habit.name)
+                    db.update_streaks(habit.name, streaks.current_streak(), *streaks.longest_streak())
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, create in (("one at a time", one_at_a_time), ("create_habits", lambda db: create_habits(db, definitions))):
+            db = DataBase(os.path.join(directory, f"{label}.db"))
+            start_time = time.perf_counter()
+            create(db)
+            elapsed = time.perf_counter() - start_time
+            click.echo(f"{label}: {habits / elapsed:.0f} habits/s ({elapsed:.2f}s for {habits} habits)")
+            db.close()
+
+@benchmarks.command(name='storage-reclaim')
+@click.option('--habits', default=1000, type=click.IntRange(2), help='The number of synthetic habits, every second one weekly.')
+@click.option('--days', default=365, type=click.IntRange(2), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days (or weeks) that are checked.')
+def storage_reclaim(habits, days, density):
+    """Deletes every second habit through the cascades and times compact, reporting the size of the file before and after"""
+    with tempfile.TemporaryDirectory() as directory:
+        db = DataBase(os.path.join(directory, "churn.db"))
+        names = create_synthetic_habits(db, habits, days)
+        import_checks(db, synthetic_checks(names, days, density))
+        db.cursor.execute("UPDATE habitdata SET priority = 1 WHERE rowid % 2 = 0")
+        db.commit()
+        timings = {}
+        time_once(timings, "delete", lambda: archive_habits(db, None, priority=1))
+        page_count, freelist_count, page_size = db.query_storage()
+        time_once(timings, "compact", db.compact)
+        pages_after = db.query_storage()[0]
+        time_once(timings, "compact full", lambda: db.compact(full=True))
+        pages_full = db.query_storage()[0]
+        db.close()
+    click.echo(f"{page_count * page_size / 1024:.0f} KiB file with {freelist_count} free pages after the delete, "
+               f"{pages_after * page_size / 1024:.0f} KiB after compact, {pages_full * page_size / 1024:.0f} KiB after compact --full")
+    for label, seconds in timings.items():
+        click.echo(f"{label}: {seconds[0]:.3f}s")
+
+def write_checks(db_path, number, checks):
+    """Creates a habit in the database file and checks it day by day, one transaction per check, in a worker process"""
+    db = DataBase(db_path, profile="concurrent")
+    habit = Habit(db, f"habit {number}", "benchmark habit", 5, Periodicity.DAILY)
+    habit.creation_time = datetime.now() - timedelta(days=checks)
+    db.db_insert(habit)
+    for day in range(checks, 0, -1):
+        checked_date = (datetime.now() - timedelta(days=day)).strftime('%Y-%m-%d')
+        habit.check(habit.name, checked_date, checked_date)
+    db.close()
+    return checks
+
+@benchmarks.command()
+@click.option('--workers', default=4, type=click.IntRange(1), help='The number of users writing at the same time, one process each.')
+@click.option('--checks', default=300, type=click.IntRange(1), help='How many days each user checks one after another.')
+def shard_writes(workers, checks):
+    """Compares the checks per second of users writing to one shared database file and to a shard file per user"""
+    with tempfile.TemporaryDirectory() as directory:
+        router = ShardRouter(os.path.join(directory, "shards"))
+        layouts = (
+            ("one shared file", [os.path.join(directory, "shared.db")] * workers),
+            ("one shard per user", [router.path(f"user {number}") for number in range(workers)]),
+        )
+        for label, paths in layouts:
+            # creates and migrates the files before the workers race for it
+            for path in set(paths):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                DataBase(path, profile="concurrent").close()
+            start_time = time.perf_counter()
+            with ProcessPoolExecutor(workers) as executor:
+                total = sum(executor.map(write_checks, paths, range(workers), [checks] * workers))
+            elapsed = time.perf_counter() - start_time
+            click.echo(f"{label}: {total / elapsed:.0f} checks/s ({total} checks by {workers} users in {elapsed:.2f}s)")
+
+def traced_memory(build):
+    """Returns the object build() returns and the bytes it still holds on to"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used
+
+@benchmarks.command()
+@click.option('--habits', default=10000, type=click.IntRange(1), help='The number of habits held in memory.')
+@click.option('--days', default=1095, type=click.IntRange(1), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days that are checked.')
+def memory(habits, days, density):
+    """Compares the memory of habits and check histories as query result tuples and as HabitRecord and CheckHistory"""
+    rng = random.Random(0)
+    creation_time = datetime(2022, 1, 1)
+    # the same checked days for both representations
+    checked_days = [[day for day in range(days) if rng.random() < density] for _ in range(habits)]
+    date_bytes = [(creation_time + timedelta(days=day)).strftime('%Y-%m-%d').encode() for day in range(days)]
+
+    def as_tuples():
+        habit_rows = [(f"habit {number}", "benchmark habit", 5, 0, 0, 0, 0, str(creation_time)) for number in range(habits)]
+        # decode creates a new string for every row, like fetchall does
+        check_rows = {row[0]: [(date_bytes[day].decode(),) for day in checked_days[number]] for number, row in enumerate(habit_rows)}
+        return habit_rows, check_rows
+
+    def as_records():
+        creation_day = creation_time.date().toordinal()
+        records = [HabitRecord(f"habit {number}", "benchmark habit", 5, Periodicity.DAILY, 0, 0, 0, creation_day) for number in range(habits)]
+        histories = {record.name: CheckHistory(record.name, [creation_day + day for day in checked_days[number]]) for number, record in enumerate(records)}
+        return records, histories
+
+    for label, build in (("tuples of strings", as_tuples), ("HabitRecord and CheckHistory", as_records)):
+        result, used = traced_memory(build)
+        click.echo(f"{label}: {used / 1024 / 1024:.1f} MiB for {habits} habits with {sum(map(len, checked_days))} checks")
+        del result
+
+@benchmarks.command()
+@click.option('--habits', default=200, type=click.IntRange(1), help='The number of synthetic habits, every second one weekly.')
+@click.option('--days', default=365, type=click.IntRange(1), help='The days of check history per habit.')
+@click.option('--density', default=0.7, type=click.FloatRange(0, 1), help='The share of days (or weeks) that are checked.')
+@click.option('--runs', default=3, type=click.IntRange(1), help='How often the suite runs on a fresh database, the median is recorded.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Writes the results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None, help='JSON results of an earlier run to compare against.')
+@click.option('--threshold', default=0.2, type=click.FloatRange(0), help='Fails if a benchmark is slower than the baseline by more than this share.')
+def suite(habits, days, density, runs, output, baseline, threshold):
+    """Times check ingestion, streak rebuilds, streak lookups and the Analyse commands on a synthetic database"""
+    timings = {}
+    for _ in range(runs):
+        db = DataBase(":memory:")
+        names = create_synthetic_habits(db, habits, days)
+        time_once(timings, "import_checks", lambda: import_checks(db, synthetic_checks(names, days, density)))
+        today = datetime.now().strftime('%Y-%m-%d')
+        checked = names[:100]
+        time_once(timings, "habit_check", lambda: [Habit(db, name, "synthetic habit", 1, Periodicity.DAILY).check(name, today, today) for name in checked])
+        time_once(timings, "rebuild_all_streaks", lambda: rebuild_all_streaks(db, workers=1))
+        time_once(timings, "streak_lookups", lambda: [(Streaks(db, name, rebuild=False).current_streak(), Streaks(db, name, rebuild=False).longest_streak()) for name in names])
+        analyse = Analyse(db)
+        # the Analyse commands print their results
+        with contextlib.redirect_stdout(io.StringIO()):
+            time_once(timings, "analyse_max_typ", lambda: analyse.max_typ("longest_streak"))
+            time_once(timings, "analyse_same", lambda: analyse.same("periodicity", "DAILY"))
+            time_once(timings, "analyse_select", lambda: analyse.select("all", "longest_streak", "False", True))
+        db.close()
+
+    results = {label: statistics.median(durations) for label, durations in timings.items()}
+    for label, seconds in results.items():
+        click.echo(f"{label}: {seconds * 1000:.1f} ms")
+    if output:
+        record = {
+            "commit": git_commit(),
+            "parameters": {"habits": habits, "days": days, "density": density, "runs": runs},
+            "results": results,
+        }
+        with open(output, "w") as file:
+            json.dump(record, file, indent=2)
+    if baseline:
+        with open(baseline) as file:
+            previous = json.load(file)
+        if previous["parameters"] != {"habits": habits, "days": days, "density": density, "runs": runs}:
+            raise click.ClickException("The baseline was recorded with different parameters")
+        regressions = []
+        for label, seconds in results.items():
+            previous_seconds = previous["results"].get(label)
+            # sub millisecond differences are timer noise rather than regressions
+            if previous_seconds and seconds > previous_seconds * (1 + threshold) and seconds - previous_seconds > 0.001:
+                regressions.append(f"{label}: {previous_seconds * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+        if regressions:
+            raise click.ClickException("Regressions against the baseline:\n" + "\n".join(regressions))
+        click.echo(f"No regressions above {threshold:.0%} against {previous['commit'] or baseline}")
+
+if __name__ == '__main__':
+    benchmarks()
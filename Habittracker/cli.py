@@ -1,13 +1,66 @@
 import click
+import json
 import sqlite3
 import random
+import time
+import instrumentation
 from datetime import datetime, timedelta
 from enum import Enum
-from habit_tracker import db, Habit, Periodicity, InvalidParameterError, Analyse, init_predefined_habits
+from habit_tracker import db, DB_PATH_ENV, STORAGE_PROFILE_ENV, STORAGE_PROFILES, STREAK_BACKEND_ENV, STREAK_BACKENDS, Streaks, Habit, check_habit, Periodicity, InvalidParameterError, Analyse, init_predefined_habits, create_habits, predefined_definitions, read_habit_file, PREDEFINED_HABITS, archive_habits, import_checks, read_check_file, rebuild_all_streaks, EXPORT_TABLES, EXPORT_FORMATS, export_table, ShardRouter, ShardedAnalyse, SHARD_DIR_ENV, USER_ENV, DEFAULT_SHARD_DIR, seconds_until_tomorrow
+from habit_tracker import rollover as rollover_streaks
 
 @click.group()
-def interface():
-    pass
+@click.option('--db', 'db_path', envvar=DB_PATH_ENV, default=None, type=click.Path(dir_okay=False), help=f'The SQLite database file, defaults to ${DB_PATH_ENV} or habit_database.db in the current directory.')
+@click.option('--storage-profile', envvar=STORAGE_PROFILE_ENV, default=None, type=click.Choice(list(STORAGE_PROFILES)), help=f'The SQLite settings, "concurrent" uses a write ahead log for several processes checking habits at once. Defaults to ${STORAGE_PROFILE_ENV} or "default".')
+@click.option('--streak-backend', envvar=STREAK_BACKEND_ENV, default=None, type=click.Choice(STREAK_BACKENDS), help=f'How streaks are rebuilt, "numpy" needs NumPy and otherwise falls back to "python", "sql" computes them inside SQLite. Defaults to ${STREAK_BACKEND_ENV} or "python".')
+@click.option('--profile', 'profile_format', type=click.Choice(['table', 'json', 'cprofile']), default=None, help='Profiles the command: "table" prints the time and rows per SQL statement and per phase, "json" the same as JSON, "cprofile" the cProfile statistics.')
+@click.option('--profile-output', type=click.Path(dir_okay=False), default=None, help='Writes the JSON or cProfile output to this file instead of printing it.')
+@click.option('--user', envvar=USER_ENV, default=None, help=f'Uses the database file of this user in the shard directory instead of --db. Defaults to ${USER_ENV}.')
+@click.option('--shard-dir', envvar=SHARD_DIR_ENV, default=DEFAULT_SHARD_DIR, type=click.Path(file_okay=False), help=f'The directory with one database file per user, defaults to ${SHARD_DIR_ENV} or "{DEFAULT_SHARD_DIR}".')
+@click.pass_context
+def interface(ctx, db_path, storage_profile, streak_backend, profile_format, profile_output, user, shard_dir):
+    # profiling has to start before the database is opened, so its connection times the statements
+    if profile_format:
+        start_profiling(profile_format, profile_output)
+    if user and db_path:
+        raise click.UsageError('--user and --db select different database files, use one of them')
+    # the router opens nothing until a command uses it, it is passed to the commands that can query all users
+    ctx.obj = ShardRouter(shard_dir, profile=storage_profile or "default")
+    ctx.call_on_close(ctx.obj.close)
+    # the database itself is only opened once a command uses it
+    db.configure(ctx.obj.path(user) if user else db_path, storage_profile)
+    if streak_backend:
+        Streaks.backend = streak_backend
+
+def start_profiling(profile_format, profile_output):
+    """Starts profiling and reports the results once the command has finished"""
+    # cProfile and pstats are only needed with --profile, the other calls start without importing them
+    import cProfile
+    import pstats
+    profiler = instrumentation.start()
+    python_profiler = cProfile.Profile() if profile_format == 'cprofile' else None
+    if python_profiler:
+        python_profiler.enable()
+
+    def report():
+        instrumentation.stop()
+        if python_profiler:
+            python_profiler.disable()
+            if profile_output:
+                python_profiler.dump_stats(profile_output)
+            else:
+                pstats.Stats(python_profiler).sort_stats('cumulative').print_stats(25)
+        elif profile_format == 'json':
+            output = json.dumps(profiler.to_dict(), indent=2)
+            if profile_output:
+                with open(profile_output, 'w') as file:
+                    file.write(output)
+            else:
+                click.echo(output)
+        else:
+            click.echo(profiler.summary())
+
+    click.get_current_context().call_on_close(report)
 
 @interface.command()
 @click.option('--name', prompt='Name of the habit', help='The name of the habit.')
@@ -17,7 +70,8 @@ def interface():
 def create(name, description, priority, periodicity):
     try:
         habit = Habit(db, name, description, priority, Periodicity[periodicity])
-        db.db_insert(habit)
+        with db.transaction():
+            db.db_insert(habit)
         click.echo(f'You created the habit: {name}')
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
@@ -27,44 +81,55 @@ def create(name, description, priority, periodicity):
 def delete(name):
     try:
         # Check if the habit exists
-        habit_exists = db.db_query_by_name(name, "all", "habitdata")
-        
-        if not habit_exists:
+        if db.query_schedule(name) is None:
             click.echo(f'Error: No habit found with the name "{name}".')
             return
 
         # If the habit exists, proceed with deletion
-        db.delete_habit(name)
+        with db.transaction():
+            db.delete_habit(name)
         click.echo(f'Habit "{name}" deleted successfully!')
         
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
 
+@interface.command(name='delete-habits')
+@click.option('--inactive-since', default=None, help='Deletes the habits created before this year-month-day date that have not been checked since.')
+@click.option('--priority', default=None, type=click.IntRange(1, 10), help='Deletes the habits with this priority, together with --inactive-since only the inactive ones.')
+@click.option('--archive', 'path', default=None, type=click.Path(dir_okay=False, writable=True), help='Writes the habits and their checks to this JSONL file before they are deleted, create-habits --file reads it back.')
+@click.confirmation_option(prompt='Delete all habits that match?')
+def delete_habits(inactive_since, priority, path):
+    """Deletes many habits with their checks and streaks at once"""
+    try:
+        names = archive_habits(db, path, inactive_since, priority)
+        page_count, freelist_count, page_size = db.query_storage()
+        archived = f' and archived them to {path}' if path else ''
+        click.echo(f'Deleted {len(names)} habit(s){archived}.')
+        click.echo(f'{freelist_count} of {page_count} pages ({freelist_count * page_size / 1024:.0f} KiB) are free now, run compact to give them back.')
+    except (InvalidParameterError, ValueError) as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--full', is_flag=True, help='Rewrites the whole file, which also repacks pages that deletes left partly empty.')
+def compact(full):
+    """Shrinks the database file by the pages that deleted data left free"""
+    try:
+        pages_before, pages_after, page_size = db.compact(full)
+        click.echo(f'{pages_before} pages before, {pages_after} after, reclaimed {(pages_before - pages_after) * page_size / 1024:.0f} KiB.')
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
 @interface.command()
 @click.option('--name', prompt='Name of the Habit you wanna check', help='Enter the name of the habit you want to check')
 @click.option('--startdate', prompt='Enter the start year-month-day of your chosen habit\'s streak, put the same day for both enddate and startdate if you only wanna check one day', default=None, required=False, help='Enter a date in the format of year-month-day, don\'t forget "-" in between. Leave empty if you just want to check today')
 @click.option('--enddate', prompt='Enter the end year-month-day of your chosen habit\'s streak, put the same day for both enddate and startdate if you only wanna check one day', default=None, required=False, help='Enter a date in the format of year-month-day, don\'t forget "-" in between. Leave empty if you just want to check today')
 def check(name, startdate=None, enddate=None):
-    habit_data = db.db_query_by_name(name, "all", "habitdata")
-    if not habit_data:
-        raise InvalidParameterError(f"No habit found with the name '{name}'")
-    db.clear_streaks_for_habit(name)
-    #makes sure that habit_data is a list not a list of tuples
-    habit_data = habit_data[0] 
-    habit_name = habit_data[0]
-    habit_description = habit_data[1]
-    habit_priority = habit_data[2]
-    habit_periodicity = Periodicity(habit_data[3])
-
-    habit = Habit(
-        db=db,
-        name=habit_name,
-        description=habit_description,
-        priority=habit_priority,
-        periodicity=habit_periodicity,
-    )
-    habit.check(name, startdate, enddate)
-    click.echo(f'You checked "{name}" for the time frame of "{startdate}" till "{enddate}".')
+    try:
+        # the habit is looked up once by name, there is no need to load it into a Habit first
+        added = check_habit(db, name, startdate, enddate)
+        click.echo(f'You checked "{name}" for the time frame of "{startdate}" till "{enddate}", {added} new check(s).')
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
 
 @interface.command()
 @click.option('--name',prompt='Enter the Name of one of the following habits:"reading","cdcworkout","vegandiet","smokingcessation","meditate".',type=click.Choice(['reading','cdcworkout','vegandiet','smokingcessation','meditate']), help='Enter one of the provided names, you don\'t have to worry about capitalisation.')
@@ -75,11 +140,30 @@ def select_predefined(name):
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
 
+@interface.command(name='create-habits')
+@click.option('--file', 'path', type=click.Path(exists=True, dir_okay=False), default=None, help='A CSV file with name, description, priority and periodicity columns and optionally creation_time and checks (dates separated by spaces), or a JSONL file with these keys and checks as a list of dates.')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None, help='The file format, by default taken from the file extension.')
+@click.option('--predefined', multiple=True, type=click.Choice(list(PREDEFINED_HABITS)), help='A predefined habit to add with its check data, can be given several times.')
+def create_habits_file(path, file_format, predefined):
+    """Creates many habits at once, nothing is created if one of them is invalid and habits that exist are skipped"""
+    if not path and not predefined:
+        raise click.UsageError('Pass --file, --predefined or both')
+    start_time = time.perf_counter()
+    try:
+        definitions = list(read_habit_file(path, file_format)) if path else []
+        created, skipped, checks = create_habits(db, definitions + predefined_definitions(predefined))
+        elapsed = time.perf_counter() - start_time
+        click.echo(f'Created {len(created)} habit(s) with {checks} check(s) in {elapsed:.2f}s, skipped {len(skipped)} existing habit(s).')
+    except (InvalidParameterError, ValueError) as e:
+        click.echo(f'Error: {e}')
+
 @interface.command()
-@click.option('--type', prompt='select the habit attribute you want to have the greatest value for: priority, current_streak, longest_streak or longest break', type=click.Choice(['priority', 'current_streak', 'longest_streak', 'longest_break']), help='Type in: priority, current_streak, longest_streak or longest break, to get their respective greatest value e.g. which habit/s have/has the longest_streak.')
-def max_value(type):
+@click.option('--type', prompt='select the habit attribute you want to have the greatest value for: priority, current_streak, longest_streak or longest break', type=click.Choice(['priority', 'current_streak', 'longest_streak', 'longest_break', 'total_checks', 'completion_rate']), help='Type in: priority, current_streak, longest_streak, longest break, total_checks or completion_rate, to get their respective greatest value e.g. which habit/s have/has the longest_streak.')
+@click.option('--all-users', is_flag=True, help='Finds the greatest value over the habits of all users in the shard directory.')
+@click.pass_obj
+def max_value(router, type, all_users):
     try:
-        analyse= Analyse(db)
+        analyse = ShardedAnalyse(router) if all_users else Analyse(db)
         analyse.max_typ(type)
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
@@ -87,30 +171,137 @@ def max_value(type):
 @interface.command()
 @click.option('--type', prompt='The type of attribute you want to find matching Habits for', type=click.Choice(['priority', 'periodicity']), help='The type of habit detail to match.')
 @click.option('--value', prompt='The value you want to find matching Habits for', help='A matching value like "DAILY" or "WEEKLY" for periodicity or 1-10 for priority.')
-def same_value(type, value):
+@click.option('--all-users', is_flag=True, help='Lists the matching habits of all users in the shard directory.')
+@click.pass_obj
+def same_value(router, type, value, all_users):
     try:
-        analyse=Analyse(db)
+        analyse = ShardedAnalyse(router) if all_users else Analyse(db)
         analyse.same(type, value)
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
 
 @interface.command()
 @click.option('--name', prompt='The name of the habit you wanna choose,if you wanna choose all habits in type in \'all\'', help='The name of the habit you want to check values for, or "all" to select all habits.')
-@click.option('--type', prompt='The attribute you wanna choose for your habit,if you wanna choose all type in \'all\'', type=click.Choice(['name','priority', 'current_streak', 'longest_streak', 'longest_break','all']), help='The type of habit attribute you want to sort your habit list by or filter out.')
+@click.option('--type', prompt='The attribute you wanna choose for your habit,if you wanna choose all type in \'all\'', type=click.Choice(['name','priority', 'current_streak', 'longest_streak', 'longest_break', 'total_checks', 'completion_rate','all']), help='The type of habit attribute you want to sort your habit list by or filter out.')
 @click.option('--only', prompt='If you want only the greatest or smallest value of the attribute you selected', type=click.Choice(['True', 'False']), help='True if you only want to see the previously selected attribute for a given or all habits.')
 @click.option('--order', prompt='If you decided to order the list by an attribute type in either if you wanna order ascending(largest->smallest) or descending(smallest->largest) otherwise type in either one.', type=click.Choice(['ASC', 'DESC']), help='Based on your attribute sorting criteria you can select ASC or DESC to sort your habits e.g. from 10-1 or 1-10 for priority.')
 def select_habits(name, type, only, order):
     try:
         analyse=Analyse(db)
-        analyse.select(name=name, typ=type, only=only, order=order)
+        # ASC lists the habits from the largest to the smallest value
+        analyse.select(name=name, typ=type, only=only, order=(order == 'ASC'))
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--date', 'day', prompt='The date as year-month-day', help='The date to list the checked habits for, weekly habits count if they were checked in its week.')
+def checked_on(day):
+    try:
+        Analyse(db).checked_on(day)
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--name', prompt='The name of the habit, or \'all\' for all habits', help='The name of the habit, or "all" to list all habits.')
+@click.option('--start', prompt='The start date as year-month-day', help='The first day of the time frame.')
+@click.option('--end', prompt='The end date as year-month-day', help='The last day of the time frame.')
+def completion_rate(name, start, end):
+    try:
+        Analyse(db).completion(name, start, end)
     except InvalidParameterError as e:
         click.echo(f'Error: {e}')
 
+@interface.command()
+@click.option('--name', prompt='The name of the habit', help='The name of the habit to draw.')
+@click.option('--days', default=365, type=click.IntRange(1), help='How many days back from today are drawn.')
+def heatmap(name, days):
+    try:
+        Analyse(db).heatmap(name, days)
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command(name='import-checks')
+@click.option('--file', 'path', prompt='Path of the CSV or JSONL file with the checks', type=click.Path(exists=True, dir_okay=False), help='A CSV file with a name and date column or a JSONL file with name and date keys, dates as year-month-day.')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None, help='The file format, by default taken from the file extension.')
+@click.option('--batch-size', default=10000, type=click.IntRange(1), help='The number of checks inserted per batch.')
+@click.option('--backdate', is_flag=True, default=False, help='Moves the creation date of a habit back to its earliest imported check instead of refusing checks before it, e.g. for the history of a habit kept in another tracker.')
+def import_checks_file(path, file_format, batch_size, backdate):
+    start_time = time.perf_counter()
+
+    def report(rows_read, inserted):
+        elapsed = time.perf_counter() - start_time
+        click.echo(f'{rows_read} checks read, {inserted} new, {rows_read / elapsed:.0f} checks/s')
+
+    try:
+        rows_read, inserted, names = import_checks(db, read_check_file(path, file_format), batch_size, report, backdate)
+        elapsed = time.perf_counter() - start_time
+        click.echo(f'Imported {inserted} new checks of {rows_read} for {len(names)} habit(s) in {elapsed:.2f}s.')
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--table', prompt='The table to export: habitdata, checkdata or streakdata', type=click.Choice(list(EXPORT_TABLES)), help='The table to export, the habits, their checks or their streaks and breaks.')
+@click.option('--file', 'path', prompt='Path of the export file', type=click.Path(dir_okay=False, writable=True), help='The file to write, its extension (.csv, .jsonl, .parquet) sets the format unless --format is given.')
+@click.option('--format', 'file_format', type=click.Choice(EXPORT_FORMATS), default=None, help='The file format, Parquet needs pyarrow.')
+@click.option('--name', default=None, help='Only exports the rows of this habit.')
+@click.option('--start', default=None, help='Only exports rows from this year-month-day date on.')
+@click.option('--end', default=None, help='Only exports rows up to this year-month-day date.')
+@click.option('--periodicity', type=click.Choice(['DAILY', 'WEEKLY']), default=None, help='Only exports rows of daily or weekly habits.')
+@click.option('--chunk-size', default=1000, type=click.IntRange(1), help='The number of rows fetched and written at a time.')
+def export(table, path, file_format, name, start, end, periodicity, chunk_size):
+    try:
+        periodicity = Periodicity[periodicity] if periodicity else None
+        rows = export_table(db, table, path, file_format, name, start, end, periodicity, chunk_size)
+        click.echo(f'Exported {rows} rows of {table} to {path}.')
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--workers', default=None, type=click.IntRange(1), help='The number of worker processes, defaults to the number of CPUs.')
+def rebuild_streaks(workers):
+    try:
+        habits, segments, timings = rebuild_all_streaks(db, workers)
+        click.echo(f'Rebuilt {segments} streaks and breaks of {habits} habit(s).')
+        for phase, seconds in timings.items():
+            click.echo(f'{phase}: {seconds:.3f}s')
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+
+@interface.command()
+@click.option('--host', default='127.0.0.1', help='The address the service listens on.')
+@click.option('--port', default=8080, type=click.IntRange(0, 65535), help='The port the service listens on.')
+@click.option('--readers', default=4, type=click.IntRange(1), help='The number of threads and read only connections for the Analyse queries.')
+def serve(host, port, readers):
+    """Serves the habits as JSON-RPC over HTTP until it is interrupted"""
+    # only this command needs asyncio, the other commands start without importing it
+    import asyncio
+    import service
+    try:
+        asyncio.run(service.serve(db.path(), host, port, readers, lambda address: click.echo(f'Serving {db.path()} on http://{address[0]}:{address[1]}/')))
+    except InvalidParameterError as e:
+        click.echo(f'Error: {e}')
+    except KeyboardInterrupt:
+        click.echo('Stopped the service.')
+
+@interface.command()
+@click.option('--watch', is_flag=True, help='Keeps running and rolls the streaks over again after every midnight.')
+def rollover(watch):
+    """Updates the open breaks and current streaks of all habits for today, running it again the same day changes nothing"""
+    while True:
+        extended, started, updated = rollover_streaks(db)
+        click.echo(f'{datetime.now():%Y-%m-%d %H:%M}: extended {extended} and started {started} open break(s), updated {updated} habit(s).')
+        if not watch:
+            break
+        # a second into the new day, so the date has surely changed
+        time.sleep(seconds_until_tomorrow() + 1)
+
 @interface.command()
 def clear_database():
     try:
-        db.clear_all_tables()
-        click.echo('All tables have been cleared from the database.')
+        with db.transaction():
+            db.clear_all_tables()
+        pages_before, pages_after, page_size = db.compact()
+        click.echo(f'All tables have been cleared from the database, reclaimed {(pages_before - pages_after) * page_size / 1024:.0f} KiB.')
     except Exception as e:
         click.echo(f'Error: {e}')
 
@@ -1,8 +1,21 @@
 import click
 import sqlite3
 import random
-from datetime import datetime, timedelta
+import csv
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from enum import Enum
+from vectorised_streaks import HAS_NUMPY, calculate_streaks_vectorised
+from instrumentation import ProfiledConnection, phase, timed
+import instrumentation
 
 class InvalidParameterError(Exception):
     """Exception in case we are missing parameters or there is a wrong parameter in the habit instantiation"""
@@ -17,8 +30,38 @@ def adjust_week(date):
     adjusted_date = date - timedelta(days=date.weekday())
     return adjusted_date
 
+# dates are stored as day ordinals (date.toordinal, 1 is monday 0001-01-01), julianday() of a date is its ordinal plus this
+JULIAN_DAY_OFFSET = 1721424.5
+
+def to_day(value):
+    """Converts a date, datetime, year-month-day string or timestamp string into a day ordinal, day ordinals are kept"""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = date.fromisoformat(value.split(' ')[0])
+    return value.toordinal()
+
+def day_string(day):
+    """Converts a day ordinal back into a year-month-day string"""
+    return date.fromordinal(day).isoformat()
+
+def week_start(day):
+    """Returns the day ordinal of the monday of the week a day ordinal is in, adjust_week for day ordinals"""
+    return day - (day - 1) % 7
+
+def current_period_start(periodicity, today):
+    """Returns the day ordinal of the first day of the day or week the day ordinal today is in,
+    a streak is current if it ends on or after it"""
+    return week_start(today) if periodicity == Periodicity.WEEKLY else today
+
+def date_sql(column):
+    """Returns the SQL expression that shows a day ordinal column as a year-month-day string"""
+    return f"date({column} + {JULIAN_DAY_OFFSET})"
+
 class Habit:
     """The Class to create habits and check off habits, it takes the arguments name, description, priority and periodicity."""
+    __slots__ = ("name", "description", "priority", "periodicity", "current_streak", "longest_streak", "longest_break", "creation_time", "db")
+
     def __init__(self, db, name: str = None, description: str = None, priority: int = None, periodicity: Periodicity = None) -> None:
         if not name or not description or not priority or not periodicity:
             raise InvalidParameterError("You are missing one or more parameters in your habit. Please check!")
@@ -33,6 +76,19 @@ class Habit:
         self.creation_time = datetime.now()
         self.db = db
 
+    def to_row(self):
+        """Returns the habitdata row of the habit in HABIT_COLUMNS order"""
+        return (
+            self.name,
+            self.description,
+            self.priority,
+            self.periodicity.value,
+            self.current_streak,
+            self.longest_streak,
+            self.longest_break,
+            to_day(self.creation_time)
+        )
+
     def validate_priority(self, priority):
         """validates that the priority is set between 1 and 10"""
         if 1 <= priority <= 10:
@@ -41,65 +97,397 @@ class Habit:
 
     def check(self, name, startdate=None, enddate=None):
         """Checks of a habit given its name for the current day, 
-        unless you specify a start and end date as a year-month-day for a time period that you want to check."""
-        #validates if a habit with the name exists
-        exists = self.db.db_query_by_name(name, "COUNT(1)", "habitdata")[0]
-        #makes sure that exists is not a tuple for comparison
-        exists= exists[0]
-        #converting to correct time format
-        if startdate and enddate:
-            start_date = datetime.strptime(startdate, '%Y-%m-%d')
-            end_date = datetime.strptime(enddate, '%Y-%m-%d')
-        #this one there in case we directly use check, the CLI requires two inputs
+        unless you specify a start and end date as a year-month-day for a time period that you want to check.
+        Days (or weeks) that are already checked are skipped, returns the number of new checks."""
+        return check_habit(self.db, name, startdate, enddate)
+
+@timed("Habit.check")
+def check_habit(db, name, startdate=None, enddate=None):
+    """Habit.check without a Habit instance, the habit is looked up by name through the habit cache of the database"""
+    #validates if a habit with the name exists, None if it doesn't
+    schedule = db.query_schedule(name)
+    #converting to correct time format
+    if startdate and enddate:
+        start_date = datetime.strptime(startdate, '%Y-%m-%d')
+        end_date = datetime.strptime(enddate, '%Y-%m-%d')
+    #this one there in case we directly use check, the CLI requires two inputs
+    else:
+        start_date = end_date = datetime.now()
+    # an empty range would still insert its start date, nothing is written for it
+    if end_date < start_date:
+        raise InvalidParameterError("The end of the time frame is before its start")
+
+    if schedule is not None:
+        periodicity, creation_day = schedule
+        creation_time = datetime.combine(date.fromordinal(creation_day), datetime.min.time())
+        # these are to validate that the habit is within the creation date and todays date
+        if periodicity == Periodicity.DAILY:
+            end_validate = datetime.now() >= end_date
+            start_validate = start_date >= creation_time
+        #for weeks you'll find this structure appear more often
         else:
-            start_date = end_date = datetime.now()
-
-        if exists > 0:
-            periodicity = self.db.db_query_by_name(name, "periodicity", "habitdata")[0]
-            creation_time_tuple = self.db.db_query_by_name(name, "creation_time", "habitdata")
-            # This one comes up a couple times throughout the code, and makes sure that lists of tuples are correcly handled so singular values can be obtained
-            if isinstance(creation_time_tuple[0], tuple):
-                creation_time_str = creation_time_tuple[0][0] 
+            end_validate = adjust_week(datetime.now()) >= adjust_week(end_date)
+            start_validate = adjust_week(start_date) >= adjust_week(creation_time)
+        #code for creating checks
+        if start_validate and end_validate:
+            if periodicity == Periodicity.DAILY:
+                step_days, count = 1, (end_date - start_date).days + 1
             else:
-                creation_time_str = creation_time_tuple[0]
-
-            creation_time = datetime.strptime(creation_time_str.split(' ')[0], '%Y-%m-%d')
-            # here (0,) is used because the queried periodicity return either that or (1,) for DAILY or WEEKLY habits
-            # these are to validate that the habit is within the creation date and todays date
-            if periodicity == (0,):
-                end_validate = datetime.now() >= end_date
-                start_validate = start_date >= creation_time
-            #for weeks you'll find this structure appear more often
-            else:
-                end_validate = adjust_week(datetime.now()) >= adjust_week(end_date)
-                start_validate = adjust_week(start_date) >= adjust_week(creation_time)
-            #code for creating checks
-            if start_validate and end_validate:
-                check_list = []
-                if periodicity == (0,):
-                    for x in range((end_date - start_date).days + 1):
-                        datemodify = (start_date + timedelta(days=x)).strftime('%Y-%m-%d')
-                        check_list.append((name, datemodify, 1))
-                else:
-                    for x in range((adjust_week(end_date) - adjust_week(start_date)).days // 7 + 1):
-                        datemodify = (start_date + timedelta(weeks=x)).strftime('%Y-%m-%d')
-                        check_list.append((name, datemodify, 1))
-                self.db.db_insert_check(check_list)
-                streaks = Streaks(self.db, name)
-                current_streak_value = streaks.current_streak()
-                longest_streak_value, longest_break_value = streaks.longest_streak()
-                self.db.update_streaks(name, current_streak_value, longest_streak_value, longest_break_value)
-            else:
-                raise InvalidParameterError("The time frame you selected is not within the habit creation and today's date")
+                step_days, count = 7, (adjust_week(end_date) - adjust_week(start_date)).days // 7 + 1
+            # the engine inserts the checks the range doesn't have yet in one statement and only recomputes
+            # the streak segments from the range on, all in one transaction
+            with db.transaction():
+                return IncrementalStreaks(db).add_range(name, start_date.toordinal(), count, step_days)
+        else:
+            raise InvalidParameterError("The time frame you selected is not within the habit creation and today's date")
+    else:
+        raise InvalidParameterError("The habit you selected is not in the database")
+
+class HabitRecord:
+    """Compact in-memory habitdata row for long running processes, the creation time is the stored day ordinal (date.toordinal)"""
+    __slots__ = ("name", "description", "priority", "periodicity", "current_streak", "longest_streak", "longest_break", "creation_day")
+
+    def __init__(self, name, description, priority, periodicity, current_streak, longest_streak, longest_break, creation_day) -> None:
+        self.name = name
+        self.description = description
+        self.priority = priority
+        self.periodicity = periodicity
+        self.current_streak = current_streak
+        self.longest_streak = longest_streak
+        self.longest_break = longest_break
+        self.creation_day = creation_day
+
+    @classmethod
+    def from_row(cls, row):
+        """Creates the record from a habitdata row in HABIT_COLUMNS order"""
+        name, description, priority, periodicity, current_streak, longest_streak, longest_break, creation_day = row
+        return cls(name, description, priority, Periodicity(periodicity), current_streak, longest_streak, longest_break, creation_day)
+
+    @property
+    def creation_date(self):
+        return date.fromordinal(self.creation_day)
+
+class CheckHistory:
+    """The checked dates of a habit as a sorted array('i') of day ordinals instead of a list of date string tuples"""
+    __slots__ = ("name", "days")
+
+    def __init__(self, name, days=()) -> None:
+        self.name = name
+        self.days = array('i', days)
+
+    @classmethod
+    def from_dates(cls, name, dates):
+        """Parses year-month-day strings once, they don't have to be sorted"""
+        return cls(name, sorted(to_day(checked_date) for checked_date in dates))
+
+    def __len__(self):
+        return len(self.days)
+
+    def __contains__(self, checked_date):
+        day = to_day(checked_date)
+        index = bisect_left(self.days, day)
+        return index < len(self.days) and self.days[index] == day
+
+    def add(self, checked_date):
+        """Adds a checked date in order, returns False if it was already checked"""
+        if checked_date in self:
+            return False
+        day = to_day(checked_date)
+        self.days.insert(bisect_left(self.days, day), day)
+        return True
+
+    def count_between(self, start_date, end_date):
+        """Counts the checks from start_date to end_date, both included"""
+        return bisect_right(self.days, to_day(end_date)) - bisect_left(self.days, to_day(start_date))
+
+    def dates(self):
+        """Returns the checked dates as date objects"""
+        return [date.fromordinal(day) for day in self.days]
+
+class CheckBitmap:
+    """The checks of a habit as one bit per period (day or week) in a Python int, bit 0 is the period that starts on the origin day ordinal.
+    Range counts are a mask and a popcount instead of a scan over checkdata rows."""
+    __slots__ = ("name", "periodicity", "origin", "bits")
+
+    def __init__(self, name, periodicity, origin, bits=0) -> None:
+        self.name = name
+        self.periodicity = periodicity
+        self.origin = origin
+        self.bits = bits
+
+    @classmethod
+    def from_row(cls, name, periodicity, creation_day, origin=None, bits=None):
+        """Creates the bitmap from a habitdata row joined with its checkbitmap row, an empty one starts at the creation period"""
+        periodicity = Periodicity(periodicity)
+        if origin is None:
+            return cls(name, periodicity, cls.period_start(periodicity, creation_day))
+        return cls(name, periodicity, origin, int.from_bytes(bits, "little"))
+
+    @staticmethod
+    def period_start(periodicity, day):
+        """Returns the day ordinal of the day or of the monday of the week the day ordinal is in"""
+        if periodicity == Periodicity.WEEKLY:
+            return week_start(day)
+        return day
+
+    @property
+    def period_days(self):
+        return 7 if self.periodicity == Periodicity.WEEKLY else 1
+
+    def index(self, checked_date):
+        """Returns the bit of the period a date is in, negative before the origin"""
+        return (self.period_start(self.periodicity, to_day(checked_date)) - self.origin) // self.period_days
+
+    def add(self, checked_date):
+        """Sets the bit of a checked date, a date before the origin moves the origin back"""
+        index = self.index(checked_date)
+        if index < 0:
+            self.bits <<= -index
+            self.origin += index * self.period_days
+            index = 0
+        self.bits |= 1 << index
+
+    def add_range(self, start_date, end_date):
+        """Sets the bits of all periods from start_date to end_date with one mask"""
+        self.add(start_date)
+        start, end = self.index(start_date), self.index(end_date)
+        self.bits |= ((1 << end - start + 1) - 1) << start
+
+    def __contains__(self, checked_date):
+        index = self.index(checked_date)
+        return index >= 0 and bool(self.bits >> index & 1)
+
+    def periods_between(self, start_date, end_date):
+        """Counts the periods from start_date to end_date that are not before the origin, both included"""
+        return max(0, self.index(end_date) - max(self.index(start_date), 0) + 1)
+
+    def count_between(self, start_date, end_date):
+        """Counts the checked periods from start_date to end_date, both included"""
+        start, end = max(self.index(start_date), 0), self.index(end_date)
+        if end < start:
+            return 0
+        return (self.bits >> start & ((1 << end - start + 1) - 1)).bit_count()
+
+    def calendar(self, start_date, end_date):
+        """Returns (period start date, checked) for every period from start_date to end_date that is not before the origin"""
+        start, end = max(self.index(start_date), 0), self.index(end_date)
+        return [
+            (date.fromordinal(self.origin + index * self.period_days), bool(self.bits >> index & 1))
+            for index in range(start, end + 1)
+        ]
+
+    def to_bytes(self):
+        return self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+
+# the statements of the typed queries, their parameters are always bound so each one is parsed once and then
+# served from the statement cache of the connection
+STATEMENTS = {
+    "habit": "SELECT name, description, priority, periodicity, current_streak, longest_streak, longest_break, creation_time FROM habitdata WHERE name = ?",
+    "check_dates": "SELECT datemodify FROM checkdata WHERE name = ? ORDER BY datemodify",
+}
+# the sqlite3 statement cache per connection, room for the typed queries and the column and filter combinations
+# db_query_by_name and query_habits build, more than the default of 128 in a long running process
+STATEMENT_CACHE_SIZE = 512
+
+# environment variable for the database file, the --db option of the CLI takes precedence
+DB_PATH_ENV = "HABIT_TRACKER_DB"
+DEFAULT_DB_PATH = "habit_database.db"
+# environment variables for the directory with one database file per user and the user whose file is used
+SHARD_DIR_ENV = "HABIT_TRACKER_SHARDS"
+USER_ENV = "HABIT_TRACKER_USER"
+DEFAULT_SHARD_DIR = "shards"
+# the number of habits whose periodicity and creation day a DataBase keeps in memory
+HABIT_CACHE_SIZE = 1024
+# bump this when create_table changes, so existing databases get the new schema once
+SCHEMA_VERSION = 6
+# the habitdata columns in table order, also the whitelist for column names that end up in SQL statements
+HABIT_COLUMNS = ("name", "description", "priority", "periodicity", "current_streak", "longest_streak", "longest_break", "creation_time")
+# the columns of every table db_query_by_name can read, the whitelist for the names that end up in its statements
+TABLE_COLUMNS = {
+    "habitdata": HABIT_COLUMNS,
+    "checkdata": ("name", "date", "datemodify", "checks"),
+    "streakdata": ("name", "start_date", "end_date", "streak_type", "count"),
+}
+# the tables whose rows belong to a habitdata row and are deleted with it through ON DELETE CASCADE
+CHILD_TABLES = ("checkdata", "streakdata", "habitstats", "checkbitmap")
+# the columns stored as day ordinals, shown and filtered as year-month-day strings outside of the database
+DATE_COLUMNS = {
+    "habitdata": ("creation_time",),
+    "checkdata": ("datemodify",),
+    "streakdata": ("start_date", "end_date"),
+    "habitstats": ("as_of",),
+}
+# rows converted per transaction when the migration turns the stored date strings into day ordinals
+DATE_MIGRATION_BATCH = 10000
+# the aggregates of the habitstats table, the streak values there replace the ones of habitdata once they are computed
+STATS_COLUMNS = ("current_streak", "longest_streak", "longest_break", "total_checks", "completion_rate")
+
+# the exportable tables with the columns the start and end of a date range filter are compared with,
+# streaks are exported if they overlap the range
+EXPORT_TABLES = {
+    "habitdata": ("creation_time", "creation_time"),
+    "checkdata": ("datemodify", "datemodify"),
+    "streakdata": ("end_date", "start_date"),
+}
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+
+# environment variable for the storage profile, the --storage-profile option of the CLI takes precedence
+STORAGE_PROFILE_ENV = "HABIT_TRACKER_PROFILE"
+# PRAGMA settings applied to every connection, cache_size is in KiB when negative and mmap_size in bytes
+STORAGE_PROFILES = {
+    # the rollback journal sqlite uses by default
+    "default": {"busy_timeout": 5000},
+    # write ahead log: readers never block the single writer, for several processes or threads on one file
+    "concurrent": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000, "cache_size": -16000, "mmap_size": 268435456},
+}
+
+class HabitRepository:
+    """Loads habits with one query and keeps the metadata that never changes once a habit exists, its periodicity
+    and creation day, of the max_size most recently used habits. Deleting habits, moving their creation back in a
+    check import or rolling back a transaction drops the cached entries; a habit deleted and created again by another connection isn't noticed, so read only
+    connections, which only ever see the writes of others, don't cache (max_size 0)."""
+    def __init__(self, db, max_size=HABIT_CACHE_SIZE) -> None:
+        self.db = db
+        self.max_size = max_size
+        self.schedules = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, name):
+        """Returns the habitdata row of a habit as a HabitRecord and caches its metadata, None if the habit doesn't exist"""
+        row = self.db.query_row("habit", (name,))
+        if row is None:
+            return None
+        record = HabitRecord.from_row(row)
+        self.remember(name, (record.periodicity, record.creation_day))
+        return record
+
+    def schedule(self, name):
+        """Returns the Periodicity and creation day ordinal of a habit, only the first call per habit reads the database"""
+        schedule = self.schedules.get(name)
+        if schedule is not None:
+            self.hits += 1
+            self.schedules.move_to_end(name)
+            return schedule
+        self.misses += 1
+        record = self.load(name)
+        return None if record is None else (record.periodicity, record.creation_day)
+
+    def remember(self, name, schedule):
+        if not self.max_size:
+            return
+        self.schedules[name] = schedule
+        self.schedules.move_to_end(name)
+        if len(self.schedules) > self.max_size:
+            self.schedules.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """Drops the cached metadata of a habit, or of all habits without a name"""
+        if name is None:
+            self.schedules.clear()
         else:
-            raise InvalidParameterError("The habit you selected is not in the database")
+            self.schedules.pop(name, None)
 
 class DataBase:
-    """DataBase class"""
-    def __init__(self, db_path='habit_database.db') -> None:
-        self.connection = sqlite3.connect(db_path)
+    """DataBase class, batch_writes=False makes every write commit on its own, also inside transaction blocks.
+    profile is the name of one of the STORAGE_PROFILES or a dict of PRAGMA settings,
+    read_only connections don't touch the schema and can be handed between threads (see ConnectionPool)."""
+    def __init__(self, db_path=DEFAULT_DB_PATH, batch_writes=True, profile="default", read_only=False) -> None:
+        # the statements are only timed while profiling is on, otherwise this is a plain sqlite3 connection
+        factory = ProfiledConnection if instrumentation.active is not None else sqlite3.Connection
+        if read_only:
+            # only the read only connections need it, importing it on every start would slow the CLI down
+            import urllib.parse
+            uri = f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=factory, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            self.connection = sqlite3.connect(db_path, factory=factory, cached_statements=STATEMENT_CACHE_SIZE)
+        self.db_path = db_path
+        self.read_only = read_only
         self.cursor = self.connection.cursor()
-        self.create_table()
+        self.batch_writes = batch_writes
+        self.transaction_depth = 0
+        self.habits = HabitRepository(self, 0 if read_only else HABIT_CACHE_SIZE)
+        if not read_only and self.cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # only takes effect on a new file before its header is written, which a change of the journal mode does,
+            # older files switch with their first compact()
+            self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.apply_profile(profile, read_only)
+        if not read_only:
+            self.migrate()
+            # foreign keys are off by default in every new connection and can't be switched inside a transaction,
+            # with them on deleting a habit deletes its checks, streaks, stats and bitmap through ON DELETE CASCADE
+            self.connection.commit()
+            self.cursor.execute("PRAGMA foreign_keys = ON")
+
+    def apply_profile(self, profile, read_only=False):
+        """Applies the PRAGMA settings of a storage profile to the connection"""
+        settings = STORAGE_PROFILES.get(profile) if isinstance(profile, str) else profile
+        if settings is None:
+            raise InvalidParameterError(f"The storage profile {profile} doesn't exist, choose one of: {', '.join(STORAGE_PROFILES)}")
+        for pragma, value in settings.items():
+            # the journal mode is stored in the database file, so only writers may change it
+            if pragma == "journal_mode" and read_only:
+                continue
+            if pragma not in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size"):
+                raise InvalidParameterError(f"The storage setting {pragma} is not supported")
+            self.cursor.execute(f"PRAGMA {pragma} = {value}").fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Unit of work: the writes inside the with block are committed once at the end of the outermost block,
+        or rolled back if it raises"""
+        if not self.batch_writes:
+            yield self
+            return
+        self.transaction_depth += 1
+        # takes the write lock right away, a read that is later upgraded to a write can't wait for other writers
+        if self.transaction_depth == 1 and not self.connection.in_transaction:
+            self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.rollback()
+                # habits created in the rolled back transaction may be cached
+                self.habits.invalidate()
+            raise
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            self.connection.commit()
+
+    def commit(self):
+        """Commits the pending writes, unless they are part of a transaction block"""
+        if self.transaction_depth == 0:
+            self.connection.commit()
+
+    def migrate(self):
+        """Brings the schema of new and existing database files up to SCHEMA_VERSION, does nothing if it already is"""
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        # version 1: the tables, auto_vacuum of new files is set in __init__ before the storage profile
+        if version < 1:
+            self.create_table()
+        # version 2: indexes for the per habit streakdata queries
+        if version < 2:
+            self.create_indexes()
+        # version 3: materialised per habit aggregates for the analyse commands
+        if version < 3:
+            self.create_stats_table()
+        # version 5: dates as integer day ordinals instead of year-month-day strings,
+        # converted before the steps below read them
+        if version < 5:
+            self.convert_dates()
+        # version 4: check bitmaps for the calendar queries, filled from the existing checks
+        if version < 4:
+            self.create_bitmap_table()
+            self.rebuild_check_bitmaps()
+        # version 6: foreign keys are enforced, rows left behind by habits deleted without them would violate them
+        if version < 6:
+            self.delete_orphans()
+        self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     #the tables with the fitting data types and Key dependencies(design diagram in powerpoint), to make sure deletion are carried out correctly(or for future functionalities like changing the name of a habit)
     def create_table(self):
         """creates tables if they don't exist yet for the database"""
@@ -112,7 +500,7 @@ class DataBase:
                 current_streak INTEGER,
                 longest_streak INTEGER,
                 longest_break INTEGER,
-                creation_time TIMESTAMP
+                creation_time INTEGER
             ) """
         )
         #combined UNIQUE statment as every habit can only be checked for each day once, but for several names
@@ -120,7 +508,7 @@ class DataBase:
             CREATE TABLE IF NOT EXISTS checkdata (
                 name VARCHAR,
                 date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                datemodify DATE,
+                datemodify INTEGER,
                 checks INTEGER,
                 UNIQUE(name, datemodify)
                 FOREIGN KEY(name) REFERENCES habitdata(name) ON UPDATE CASCADE ON DELETE CASCADE
@@ -130,80 +518,613 @@ class DataBase:
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS streakdata (
                 name VARCHAR,
-                start_date DATE,
-                end_date DATE,
+                start_date INTEGER,
+                end_date INTEGER,
                 streak_type VARCHAR,
                 count INTEGER,
                 FOREIGN KEY(name) REFERENCES habitdata(name) ON UPDATE CASCADE ON DELETE CASCADE
             )"""
         )
-        self.connection.commit()
+        self.create_indexes()
+        self.create_stats_table()
+        self.create_bitmap_table()
+
+    def create_stats_table(self):
+        """creates the habitstats table, one row of aggregates per habit that is valid for the as_of date
+        and deleted whenever the streaks of the habit change"""
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS habitstats (
+                name VARCHAR PRIMARY KEY,
+                as_of INTEGER,
+                current_streak INTEGER,
+                longest_streak INTEGER,
+                longest_break INTEGER,
+                total_checks INTEGER,
+                completion_rate REAL,
+                FOREIGN KEY(name) REFERENCES habitdata(name) ON UPDATE CASCADE ON DELETE CASCADE
+            )"""
+        )
+        self.commit()
+
+    def create_bitmap_table(self):
+        """creates the checkbitmap table, the checks of every habit as a little endian bit string with one bit per period from origin on"""
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS checkbitmap (
+                name VARCHAR PRIMARY KEY,
+                origin INTEGER,
+                bits BLOB,
+                FOREIGN KEY(name) REFERENCES habitdata(name) ON UPDATE CASCADE ON DELETE CASCADE
+            )"""
+        )
+        self.commit()
+
+    def convert_dates(self, batch_size=DATE_MIGRATION_BATCH):
+        """Converts the year-month-day strings and timestamps of the DATE_COLUMNS into day ordinals in place,
+        batch_size rows per transaction so other connections get the database between the batches.
+        Rows that are converted already are skipped, an interrupted migration continues where it stopped.
+        Returns the number of converted rows."""
+        converted = 0
+        for table, columns in DATE_COLUMNS.items():
+            text_rows = " OR ".join(f"typeof({column}) = 'text'" for column in columns)
+            assignments = ", ".join(
+                f"{column} = CASE WHEN typeof({column}) = 'text' THEN CAST(julianday({column}) - {JULIAN_DAY_OFFSET} AS INTEGER) ELSE {column} END"
+                for column in columns
+            )
+            while True:
+                self.cursor.execute(
+                    f"UPDATE {table} SET {assignments} WHERE rowid IN (SELECT rowid FROM {table} WHERE {text_rows} LIMIT ?)", (batch_size,)
+                )
+                converted += self.cursor.rowcount
+                self.commit()
+                if self.cursor.rowcount < batch_size:
+                    break
+        return converted
+
+    def delete_orphans(self):
+        """Deletes the rows of the CHILD_TABLES whose habit doesn't exist, returns how many were deleted"""
+        deleted = 0
+        for table in CHILD_TABLES:
+            self.cursor.execute(f"DELETE FROM {table} WHERE name NOT IN (SELECT name FROM habitdata)")
+            deleted += self.cursor.rowcount
+        self.commit()
+        return deleted
+
+    def create_indexes(self):
+        """creates the indexes for the hot queries if they don't exist yet,
+        checkdata(name, datemodify) is already indexed through its UNIQUE constraint"""
+        # covers the per habit lookups, deletes and the MAX(count) of streaks and breaks
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_streakdata_name_type_count
+            ON streakdata (name, streak_type, count)"""
+        )
+        self.commit()
 
     def clear_all_tables(self):
-        """Drops all tables in the database to clear all data."""
+        """Drops all tables in the database to clear all data, compact() gives the freed pages back to the file system"""
+        # the habits last, dropping habitdata first would delete all their rows through the cascade before they are dropped
+        for table in CHILD_TABLES:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {table}")
         self.cursor.execute("DROP TABLE IF EXISTS habitdata")
-        self.cursor.execute("DROP TABLE IF EXISTS checkdata")
-        self.cursor.execute("DROP TABLE IF EXISTS streakdata")
-        self.connection.commit()
+        # makes sure the tables are created again the next time the database is opened
+        self.cursor.execute("PRAGMA user_version = 0")
+        self.habits.invalidate()
+        self.commit()
 
     def db_insert(self, habit: Habit) -> None:
         """Inserts specifically Habit class habit data into the database."""
-        habit_data = (
-            habit.name,
-            habit.description,
-            habit.priority,
-            habit.periodicity.value,
-            habit.current_streak,
-            habit.longest_streak,
-            habit.longest_break, 
-            habit.creation_time
-        )
         self.cursor.execute(
-            "INSERT OR IGNORE INTO habitdata VALUES (?, ?, ?, ?, ?, ?, ?, ?)", habit_data
+            "INSERT OR IGNORE INTO habitdata VALUES (?, ?, ?, ?, ?, ?, ?, ?)", habit.to_row()
         )
-        self.connection.commit()
+        self.commit()
+
+    def insert_habits(self, habits):
+        """Inserts Habit class habits with one statement without committing, names that exist are skipped.
+        Returns how many habits were new."""
+        changes = self.connection.total_changes
+        self.cursor.executemany(
+            "INSERT OR IGNORE INTO habitdata VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (habit.to_row() for habit in habits)
+        )
+        return self.connection.total_changes - changes
+
+    def query_existing_habits(self, names):
+        """Returns the set of the given habit names that are in the database, with one query for all of them"""
+        self.cursor.execute("SELECT name FROM habitdata WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(list(names)),))
+        return {name for name, in self.cursor.fetchall()}
 
     def db_insert_check(self, check_list) -> None:
-        """Inserts check data into the database."""
+        """Inserts check data into the database, the dates can be day ordinals, dates or year-month-day strings."""
+        check_list = [(name, to_day(checked_date), checks) for name, checked_date, checks in check_list]
         self.cursor.executemany(
             "INSERT INTO checkdata (name, datemodify, checks) VALUES (?, ?, ?)", check_list
         )
-        self.connection.commit()
+        self.set_check_bits(check_list)
+        self.commit()
 
     def db_insert_streak(self, streak_list) -> None:
         """Inserts streak data into the database."""
         self.cursor.executemany("INSERT OR IGNORE INTO streakdata VALUES (?, ?, ?, ?, ?)", streak_list)
-        self.connection.commit()
+        self.commit()
     
+    def bulk_insert_checks(self, checks, batch_size=10000, progress=None, backdate=False):
+        """Inserts (name, date) checks of many habits in one transaction, dates that are already checked are skipped.
+        progress is called with the rows read and new checks after every batch. Dates before the creation of a habit
+        are refused, unless backdate=True moves its creation_time back to the earliest imported date.
+        Returns the rows read, the new checks and the names of the habits in the import."""
+        # one query for all habits instead of three round trips per check
+        self.cursor.execute("SELECT name, creation_time FROM habitdata")
+        creation_days = dict(self.cursor.fetchall())
+        today = date.today().toordinal()
+        rows_read = inserted = 0
+        names = set()
+        backdated = {}
+        batch = []
+        # an invalid row rolls back the whole import, inside an outer transaction block together with its writes
+        with self.transaction():
+            for name, datemodify in checks:
+                creation_day = creation_days.get(name)
+                if creation_day is None:
+                    raise InvalidParameterError(f"The habit {name} is not in the database")
+                try:
+                    datemodify = date.fromisoformat(datemodify).toordinal()
+                except (TypeError, ValueError):
+                    raise InvalidParameterError(f"The date {datemodify} of the habit {name} is not a year-month-day date")
+                if datemodify > today or (datemodify < creation_day and not backdate):
+                    raise InvalidParameterError(f"The date {day_string(datemodify)} of the habit {name} is not within the habit creation and today's date")
+                if datemodify < creation_day:
+                    creation_days[name] = backdated[name] = datemodify
+                names.add(name)
+                batch.append((name, datemodify, 1))
+                if len(batch) >= batch_size:
+                    inserted += self.insert_check_batch(batch)
+                    rows_read += len(batch)
+                    batch = []
+                    if progress:
+                        progress(rows_read, inserted)
+            if batch:
+                inserted += self.insert_check_batch(batch)
+                rows_read += len(batch)
+                if progress:
+                    progress(rows_read, inserted)
+            if backdated:
+                self.cursor.executemany(
+                    "UPDATE habitdata SET creation_time = ? WHERE name = ?", [(day, name) for name, day in backdated.items()]
+                )
+                # the streaks are rebuilt from the cached creation day, it has to be read again
+                for name in backdated:
+                    self.habits.invalidate(name)
+            self.commit()
+        return rows_read, inserted, names
+
+    def insert_check_batch(self, check_list):
+        """Inserts checks without committing, returns how many of them were new"""
+        changes = self.connection.total_changes
+        self.cursor.executemany(
+            "INSERT OR IGNORE INTO checkdata (name, datemodify, checks) VALUES (?, ?, ?)", check_list
+        )
+        inserted = self.connection.total_changes - changes
+        # setting the bit of a check that was already there changes nothing
+        self.set_check_bits(check_list)
+        return inserted
+
+    def insert_check_range(self, name, start_date, count, step_days):
+        """Inserts count checks of a habit every step_days from start_date with one statement, dates that are
+        already checked are skipped. Returns how many checks were new, without committing."""
+        # the CTE always yields the first day, so an empty range has to be refused before it runs
+        if count <= 0:
+            raise InvalidParameterError("The time frame has no days to check")
+        changes = self.connection.total_changes
+        start_day = to_day(start_date)
+        # the recursive CTE generates the days in SQLite instead of one Python value per day,
+        # WHERE true keeps the parser from reading ON CONFLICT as a join constraint
+        self.cursor.execute("""
+            WITH RECURSIVE offsets(day) AS (
+                SELECT 0 UNION ALL SELECT day + ? FROM offsets WHERE day + ? < ? * ?
+            )
+            INSERT INTO checkdata (name, datemodify, checks)
+            SELECT ?, ? + day, 1 FROM offsets WHERE true
+            ON CONFLICT (name, datemodify) DO NOTHING
+            """, (step_days, step_days, count, step_days, name, start_day)
+        )
+        inserted = self.connection.total_changes - changes
+        if inserted:
+            bitmap = self.load_check_bitmap(name)
+            if bitmap is not None:
+                bitmap.add_range(start_day, start_day + (count - 1) * step_days)
+                self.cursor.execute("INSERT OR REPLACE INTO checkbitmap VALUES (?, ?, ?)", (bitmap.name, bitmap.origin, bitmap.to_bytes()))
+        return inserted
+
+    def set_check_bits(self, check_list):
+        """Sets the bits of (name, date, checks) checks in the bitmaps of their habits without committing"""
+        checked_dates = {}
+        for name, checked_date, _ in check_list:
+            checked_dates.setdefault(name, []).append(checked_date)
+        bitmaps = []
+        for name, dates in checked_dates.items():
+            bitmap = self.load_check_bitmap(name)
+            if bitmap is None:
+                continue
+            for checked_date in dates:
+                bitmap.add(checked_date)
+            bitmaps.append((bitmap.name, bitmap.origin, bitmap.to_bytes()))
+        self.cursor.executemany("INSERT OR REPLACE INTO checkbitmap VALUES (?, ?, ?)", bitmaps)
+
+    def rebuild_check_bitmaps(self):
+        """Recomputes the bitmaps of all habits from checkdata"""
+        self.cursor.execute("DELETE FROM checkbitmap")
+        for history in self.iter_check_histories():
+            bitmap = self.load_check_bitmap(history.name)
+            if bitmap is None:
+                continue
+            for day in history.days:
+                bitmap.add(day)
+            self.cursor.execute("INSERT INTO checkbitmap VALUES (?, ?, ?)", (bitmap.name, bitmap.origin, bitmap.to_bytes()))
+        self.commit()
+
+    def load_check_bitmap(self, name):
+        """Returns the CheckBitmap of a habit, None if the habit doesn't exist"""
+        schedule = self.habits.schedule(name)
+        if schedule is None:
+            return None
+        # the periodicity and creation day come from the habit cache, only the bits are read
+        row = self.connection.execute("SELECT origin, bits FROM checkbitmap WHERE name = ?", (name,)).fetchone()
+        return CheckBitmap.from_row(name, *schedule, *(row or ()))
+
+    def iter_check_bitmaps(self):
+        """Streams the CheckBitmap of every habit in insertion order"""
+        for row in self.connection.execute("""
+            SELECT name, periodicity, creation_time, origin, bits FROM habitdata LEFT JOIN checkbitmap USING (name) ORDER BY habitdata.rowid
+            """):
+            yield CheckBitmap.from_row(*row)
+
+    def load_habit(self, name):
+        """Returns the habitdata row of a habit as a HabitRecord, None if the habit doesn't exist"""
+        return self.habits.load(name)
+
+    def load_check_history(self, name, since=0):
+        """Returns the checks of a habit, optionally only those from the since day on, as a CheckHistory"""
+        rows = self.connection.execute("SELECT datemodify FROM checkdata WHERE name = ? AND datemodify >= ? ORDER BY datemodify", (name, to_day(since)))
+        return CheckHistory(name, (day for day, in rows))
+
+    def iter_check_histories(self):
+        """Streams the CheckHistory of every habit with checks, one habit at a time"""
+        history = None
+        for name, day in self.connection.execute("SELECT name, datemodify FROM checkdata ORDER BY name, datemodify"):
+            if history is None or history.name != name:
+                if history is not None:
+                    yield history
+                history = CheckHistory(name)
+            history.days.append(day)
+        if history is not None:
+            yield history
+
+    def query_check_bounds(self, name):
+        """Returns the first and last checked day ordinal and the number of checks of a habit"""
+        self.cursor.execute("SELECT MIN(datemodify), MAX(datemodify), COUNT(*) FROM checkdata WHERE name = ?", (name,))
+        return self.cursor.fetchone()
+
+    def query_closed_segment(self, name, before, first_check, last_check):
+        """Returns the last stored streak or break (with its rowid) that ends before the given date,
+        the break before the first and after the last check are left out as they don't end on a check"""
+        self.cursor.execute("""
+            SELECT rowid, start_date, end_date, streak_type, count FROM streakdata
+            WHERE name = ? AND end_date < ? AND start_date >= ? AND start_date <= ?
+            ORDER BY rowid DESC LIMIT 1
+            """, (name, before, first_check, last_check)
+        )
+        return self.cursor.fetchone()
+
+    def replace_streaks_from(self, name, rowid, streak_list):
+        """Replaces the streakdata of a habit from the given row onwards"""
+        self.cursor.execute("DELETE FROM streakdata WHERE name = ? AND rowid >= ?", (name, rowid))
+        self.cursor.executemany("INSERT INTO streakdata VALUES (?, ?, ?, ?, ?)", streak_list)
+        self.commit()
+
+    def query_current_streak(self, name, since):
+        """Returns the length of the streak of a habit that ends on or after the since day ordinal, 0 if there is none"""
+        self.cursor.execute(
+            "SELECT count FROM streakdata WHERE name = ? AND streak_type = 'streak' AND end_date >= ? ORDER BY end_date DESC LIMIT 1", (name, since)
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def query_longest(self, name, streak_type):
+        """Returns the longest streak or break of a habit, 0 if there is none"""
+        self.cursor.execute("SELECT MAX(count) FROM streakdata WHERE name = ? AND streak_type = ?", (name, streak_type))
+        return self.cursor.fetchone()[0] or 0
+
+    def replace_all_streaks(self, streak_list, habit_updates):
+        """Replaces the whole streakdata table and writes the (current_streak, longest_streak, longest_break, name) updates"""
+        self.cursor.execute("DELETE FROM streakdata")
+        self.cursor.executemany("INSERT INTO streakdata VALUES (?, ?, ?, ?, ?)", streak_list)
+        self.cursor.executemany(
+            "UPDATE habitdata SET current_streak = ?, longest_streak = ?, longest_break = ? WHERE name = ?", habit_updates
+        )
+        self.cursor.execute("DELETE FROM habitstats")
+        self.commit()
+
     def clear_streaks_for_habit(self, habit_name):
         """If a habit is checked to prevent duplicates this function deletes the streaddata associated with the habit"""
         self.cursor.execute("DELETE FROM streakdata WHERE name = ?", (habit_name,))
-        self.connection.commit()
+        self.commit()
 
     # the structure is to control output columns for analysis purpose
+    # rows are returned in insertion order, also when the query is answered through an index
     def db_query_by_name(self, name, typ, tb):
-        """Selects data from any table with or without specified column of the database."""
+        """Selects data from any table with or without specified column of the database.
+        Only the tables and columns of TABLE_COLUMNS are accepted."""
+        if tb not in TABLE_COLUMNS or (typ != "all" and typ not in TABLE_COLUMNS[tb]):
+            raise InvalidParameterError("This column or database doesn't exist")
+        if not name:
+            raise InvalidParameterError("You entered a habit that does not exist")
+        columns = self.columns_sql(tb, TABLE_COLUMNS[tb] if typ == "all" else [typ])
         if name == "all":
-            if typ == "all":
-                self.cursor.execute(f"SELECT * FROM {tb}")
-                return self.cursor.fetchall()
-            elif typ:
-                self.cursor.execute(f"SELECT {typ} FROM {tb}")
-                return self.cursor.fetchall()
-            else:
-                raise InvalidParameterError("This column or database doesn't exist")
-        elif name:
-            if typ == "all":
-                self.cursor.execute(f"SELECT * FROM {tb} WHERE name = ?", (name,))
-                return self.cursor.fetchall()
-            elif typ:
-                self.cursor.execute(f"SELECT {typ} FROM {tb} WHERE name = ?", (name,))
-                return self.cursor.fetchall()
+            self.cursor.execute(f"SELECT {columns} FROM {tb} ORDER BY rowid")
+        else:
+            self.cursor.execute(f"SELECT {columns} FROM {tb} WHERE name = ? ORDER BY rowid", (name,))
+        return self.cursor.fetchall()
+
+    def columns_sql(self, table, columns):
+        """Returns the select list of whitelisted columns of a table, day ordinal columns as year-month-day strings"""
+        return ", ".join(f"{date_sql(column)} AS {column}" if column in DATE_COLUMNS[table] else column for column in columns)
+
+    def query_row(self, statement, parameters=()):
+        """Runs one of the STATEMENTS and returns its first row, None if there is none"""
+        self.cursor.execute(STATEMENTS[statement], parameters)
+        return self.cursor.fetchone()
+
+    def query_schedule(self, name):
+        """Returns the Periodicity and creation day ordinal of a habit from the habit cache, None if the habit doesn't exist"""
+        return self.habits.schedule(name)
+
+    def query_check_dates(self, name):
+        """Returns the checked days of a habit as sorted day ordinals"""
+        self.cursor.execute(STATEMENTS["check_dates"], (name,))
+        return [day for day, in self.cursor.fetchall()]
+
+    def export_chunks(self, table, name=None, start=None, end=None, periodicity=None, chunk_size=1000):
+        """Returns the column names and a generator of row lists of at most chunk_size rows of an exportable table,
+        filtered in SQL by habit name, a year-month-day date range and the periodicity of the habits"""
+        if table not in EXPORT_TABLES:
+            raise InvalidParameterError(f"The table '{table}' can't be exported")
+        start_column, end_column = EXPORT_TABLES[table]
+        days = []
+        for value in (start, end):
+            try:
+                days.append(date.fromisoformat(value).toordinal() if value else None)
+            except ValueError:
+                raise InvalidParameterError(f"The date {value} is not a year-month-day date")
+        start, end = days
+        conditions, parameters = [], []
+        if name:
+            conditions.append("name = ?")
+            parameters.append(name)
+        if start:
+            conditions.append(f"{start_column} >= ?")
+            parameters.append(start)
+        if end:
+            conditions.append(f"{end_column} <= ?")
+            parameters.append(end)
+        if periodicity is not None:
+            if table == "habitdata":
+                conditions.append("periodicity = ?")
             else:
-                raise InvalidParameterError("This column or database doesn't exist")
+                conditions.append("name IN (SELECT name FROM habitdata WHERE periodicity = ?)")
+            parameters.append(periodicity.value)
+        sql = f"SELECT {self.columns_sql(table, TABLE_COLUMNS[table])} FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        # its own cursor, other queries on self.cursor would reset it in the middle of the export
+        cursor = self.connection.execute(sql + " ORDER BY rowid", parameters)
+        columns = [column[0] for column in cursor.description]
+
+        def chunks():
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        return columns, chunks()
+
+    def query_column_types(self, table):
+        """Returns the declared types of the columns of a table, the day ordinal columns are exported as DATE strings"""
+        if table not in EXPORT_TABLES:
+            raise InvalidParameterError(f"The table '{table}' can't be exported")
+        return {
+            name: "DATE" if name in DATE_COLUMNS[table] else column_type
+            for _, name, column_type, _, _, _ in self.connection.execute(f"PRAGMA table_info({table})")
+        }
+
+    def query_max(self, column):
+        """Returns the greatest value of a habitdata or habitstats column"""
+        self.cursor.execute(f"SELECT MAX({self.validate_habit_column(column)}) FROM habitdata LEFT JOIN habitstats USING (name)")
+        return self.cursor.fetchone()[0]
+
+    def query_habits(self, columns, name="all", where=None, order_by=(), limit=None):
+        """Streams the given habitdata or habitstats columns of all or the named habit through its own cursor.
+        where is a (column, value) pair, order_by a list of (column, descending) pairs, ties keep the insertion order."""
+        columns = [self.validate_habit_column(column) for column in columns]
+        conditions, parameters = [], []
+        if name != "all":
+            conditions.append("habitdata.name = ?")
+            parameters.append(name)
+        if where:
+            conditions.append(f"{self.validate_habit_column(where[0])} = ?")
+            parameters.append(where[1])
+        sql = f"SELECT {', '.join(columns)} FROM habitdata LEFT JOIN habitstats USING (name)"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        order_by = [(self.validate_habit_column(column), descending) for column, descending in order_by]
+        if "habitdata.rowid" not in [column for column, _ in order_by]:
+            order_by.append(("habitdata.rowid", False))
+        sql += " ORDER BY " + ", ".join(f"{column} {'DESC' if descending else 'ASC'}" for column, descending in order_by)
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return self.connection.execute(sql, parameters)
+
+    def validate_habit_column(self, column):
+        """Makes sure only habitdata and habitstats columns (or the rowid) are put into SQL statements
+        and returns their SQL expression, cached aggregates take precedence over the habitdata streak values
+        and the creation day is shown as a year-month-day string"""
+        if column in STATS_COLUMNS:
+            if column in HABIT_COLUMNS:
+                return f"COALESCE(habitstats.{column}, habitdata.{column})"
+            return f"habitstats.{column}"
+        if column in DATE_COLUMNS["habitdata"]:
+            return date_sql(f"habitdata.{column}")
+        if column in HABIT_COLUMNS or column == "rowid":
+            return f"habitdata.{column}"
+        raise InvalidParameterError(f"Column name '{column}' is not valid.")
+
+    def refresh_stats(self, today=None):
+        """Recomputes the habitstats rows that were invalidated by a change of the streaks or are from an earlier day,
+        returns how many. Read only connections can't write them and use what is stored."""
+        if self.read_only:
+            return 0
+        today = today or date.today()
+        stale = self.connection.execute("""
+            SELECT name, periodicity, creation_time FROM habitdata
+            WHERE name NOT IN (SELECT name FROM habitstats WHERE as_of = ?)
+            """, (today.toordinal(),)
+        ).fetchall()
+        stats = [self.compute_stats(name, periodicity, creation_time, today) for name, periodicity, creation_time in stale]
+        if stats:
+            self.cursor.executemany("INSERT OR REPLACE INTO habitstats VALUES (?, ?, ?, ?, ?, ?, ?)", stats)
+            self.commit()
+        return len(stats)
+
+    def compute_stats(self, name, periodicity, creation_day, today):
+        """Returns the habitstats row of a habit as of today from indexed lookups of its checks and streaks"""
+        today = today.toordinal()
+        first_check, last_check, total_checks = self.query_check_bounds(name)
+        if not total_checks:
+            return (name, today, None, 0, 0, 0, 0.0)
+        longest_streak = self.query_longest(name, "streak")
+        # the stored break after the last check ended on the day of the last rebuild, it is recomputed for today
+        self.cursor.execute(
+            "SELECT MAX(count) FROM streakdata WHERE name = ? AND streak_type = 'break' AND start_date <= ?", (name, last_check)
+        )
+        longest_break = self.cursor.fetchone()[0] or 0
+        # like Streaks and the rollover, a habit with a single check has no breaks
+        if total_checks > 1:
+            longest_break = max(longest_break, today - last_check - 1)
+        current_streak = self.query_current_streak(name, current_period_start(Periodicity(periodicity), today))
+        if periodicity == Periodicity.DAILY.value:
+            periods = today - creation_day + 1
         else:
-            raise InvalidParameterError("You entered a habit that does not exist")
-    
+            periods = (week_start(today) - week_start(creation_day)) // 7 + 1
+        completion_rate = min(1.0, total_checks / periods) if periods > 0 else 0.0
+        return (name, today, current_streak, longest_streak, longest_break, total_checks, completion_rate)
+
+    def rollover_streaks(self, today):
+        """Brings the open breaks and current streaks of all habits to today in a few set-based statements without
+        committing: the break after the last check of a habit is extended to today (or started if the habit was
+        checked in the meantime), current streaks that don't reach into the current day or week are closed and the
+        longest breaks are recomputed. Running it again on the same day changes nothing.
+        Returns the number of extended breaks, started breaks and updated habits."""
+        today_day = today.toordinal()
+        # like Streaks, a habit with a single check has no breaks
+        last_checks = """
+            SELECT name, MAX(datemodify) AS last_check FROM checkdata GROUP BY name HAVING COUNT(*) > 1
+        """
+        self.cursor.execute(f"""
+            UPDATE streakdata SET end_date = :today, count = :today - start_date
+            FROM ({last_checks}) AS checks
+            WHERE streakdata.name = checks.name AND streak_type = 'break' AND start_date > checks.last_check
+            AND (end_date != :today OR count != :today - start_date)
+            """, {"today": today_day}
+        )
+        extended = self.cursor.rowcount
+        self.cursor.execute(f"""
+            INSERT INTO streakdata (name, start_date, end_date, streak_type, count)
+            SELECT name, last_check + 1, :today, 'break', :today - last_check - 1
+            FROM ({last_checks}) AS checks
+            WHERE :today - last_check > 1 AND NOT EXISTS (
+                SELECT 1 FROM streakdata WHERE streakdata.name = checks.name AND streak_type = 'break' AND start_date > checks.last_check
+            )
+            """, {"today": today_day}
+        )
+        started = self.cursor.rowcount
+        updated = self.update_streak_values(today)
+        # the cached stats of earlier days are outdated, today's already counted the open breaks until today
+        self.cursor.execute("DELETE FROM habitstats WHERE as_of != ?", (today_day,))
+        return extended, started, updated
+
+    def update_streak_values(self, today, name=None):
+        """Writes the current streak, longest streak and longest break of one habit, or of all habits, from their
+        streakdata in one statement without committing, returns the number of updated habits"""
+        # the same values IncrementalStreaks.update_habit writes, habits without checks keep their empty current streak
+        self.cursor.execute(f"""
+            UPDATE habitdata SET
+                current_streak = COALESCE((
+                    SELECT count FROM streakdata WHERE streakdata.name = habitdata.name AND streak_type = 'streak'
+                    AND end_date >= CASE habitdata.periodicity WHEN :weekly THEN :week_start ELSE :today END
+                    ORDER BY end_date DESC LIMIT 1
+                ), 0),
+                longest_streak = COALESCE((
+                    SELECT MAX(count) FROM streakdata WHERE streakdata.name = habitdata.name AND streak_type = 'streak'
+                ), 0),
+                longest_break = COALESCE((
+                    SELECT MAX(count) FROM streakdata WHERE streakdata.name = habitdata.name AND streak_type = 'break'
+                ), 0)
+            WHERE EXISTS (SELECT 1 FROM checkdata WHERE checkdata.name = habitdata.name){" AND name = :name" if name is not None else ""}
+            """, {"today": today.toordinal(), "week_start": current_period_start(Periodicity.WEEKLY, today.toordinal()), "weekly": Periodicity.WEEKLY.value, "name": name}
+        )
+        return self.cursor.rowcount
+
+    def insert_streaks_sql(self, today, name=None):
+        """Computes the streaks and breaks of one habit, or of all habits, from their checks inside SQLite and appends
+        them to streakdata in one INSERT ... SELECT without committing. The segments are the same as the ones of
+        Streaks.calculate_streaks, returns how many were inserted."""
+        # consecutive pairs of checks are streak pairs if they are one period apart and break pairs if they are further
+        # apart, pairs closer than the periodicity (several checks in a week) change nothing and are left out.
+        # A run of pairs of the same type (an island) is numbered by the count of pairs of the other type before it,
+        # a segment ends on the check where the next one starts.
+        self.cursor.execute(f"""
+            INSERT INTO streakdata (name, start_date, end_date, streak_type, count)
+            WITH checks AS (
+                SELECT checkdata.name, habitdata.rowid AS habit, datemodify AS day,
+                    CASE habitdata.periodicity WHEN :weekly THEN 7 ELSE 1 END AS delta, habitdata.creation_time AS created
+                FROM checkdata JOIN habitdata ON habitdata.name = checkdata.name{" WHERE checkdata.name = :name" if name is not None else ""}
+            ),
+            habits AS (
+                SELECT name, habit, created, MIN(day) AS first_day, MAX(day) AS last_day, COUNT(*) AS total
+                FROM checks GROUP BY name
+            ),
+            pairs AS (
+                SELECT name, habit, day, delta, LEAD(day) OVER habit_checks - day AS gap,
+                    LAST_VALUE(day) OVER (habit_checks ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS last_day
+                FROM checks WINDOW habit_checks AS (PARTITION BY name ORDER BY day)
+            ),
+            islands AS (
+                SELECT name, habit, day, gap, CASE WHEN gap = delta THEN 'streak' ELSE 'break' END AS streak_type,
+                    CASE WHEN gap = delta THEN SUM(gap > delta) OVER habit_pairs ELSE SUM(gap = delta) OVER habit_pairs END AS island,
+                    COALESCE(LEAD(day) OVER habit_pairs, last_day) AS segment_end
+                FROM pairs WHERE gap >= delta
+                WINDOW habit_pairs AS (PARTITION BY name ORDER BY day)
+            ),
+            segments AS (
+                -- like calculate_streaks a single check is a streak of 1 without any breaks
+                SELECT habit, name, first_day AS start_day, first_day AS end_day, 'streak' AS streak_type, 1 AS count
+                FROM habits WHERE total = 1
+                UNION ALL
+                -- the break between the creation and the first check
+                SELECT habit, name, created, first_day - 1, 'break', first_day - created
+                FROM habits WHERE total > 1 AND created < first_day
+                UNION ALL
+                SELECT habit, name, CASE streak_type WHEN 'streak' THEN MIN(day) ELSE MIN(day) + 1 END, MAX(segment_end),
+                    streak_type, CASE streak_type WHEN 'streak' THEN COUNT(*) + 1 ELSE SUM(gap - 1) END
+                FROM islands GROUP BY name, streak_type, island
+                UNION ALL
+                -- the open break between the last check and today
+                SELECT habit, name, last_day + 1, :today, 'break', :today - last_day - 1
+                FROM habits WHERE total > 1 AND :today - last_day > 1
+            )
+            SELECT name, start_day, end_day, streak_type, count FROM segments
+            ORDER BY habit, start_day
+            """, {"today": today.toordinal(), "weekly": Periodicity.WEEKLY.value, "name": name}
+        )
+        return self.cursor.rowcount
+
     def update_streaks(self, name, current_streak, longest_streak, longest_break):
         """Updates the streak values for a given habit."""
         self.cursor.execute("""
@@ -212,189 +1133,597 @@ class DataBase:
             WHERE name = ?
             """, (current_streak, longest_streak, longest_break, name)
         )
-        self.connection.commit()
-    #updated, but kept code safetywise, Reference structure should handle deletions properly
+        # the cached aggregates of the habit are outdated now
+        self.cursor.execute("DELETE FROM habitstats WHERE name = ?", (name,))
+        self.commit()
     def delete_habit(self, name):
-        """Deletes a specified habit from the database using the name"""
-        self.cursor.execute(f"DELETE FROM habitdata WHERE name = ?", (name,))
-        self.cursor.execute(f"DELETE FROM checkdata WHERE name = ?", (name,))
-        self.cursor.execute(f"DELETE FROM streakdata WHERE name = ?", (name,))
+        """Deletes a specified habit from the database using the name, its rows in the CHILD_TABLES go with it through ON DELETE CASCADE"""
+        self.cursor.execute("DELETE FROM habitdata WHERE name = ?", (name,))
+        self.habits.invalidate(name)
+        self.commit()
+
+    def habit_filter(self, inactive_since=None, priority=None):
+        """Returns the WHERE clause and parameters that select the habitdata rows of the habits with the priority
+        and without checks since the inactive_since date (created before it), at least one of them has to be given"""
+        if inactive_since is None and priority is None:
+            raise InvalidParameterError("Select the habits by the date they are inactive since, by priority or both")
+        conditions, parameters = [], {}
+        if inactive_since is not None:
+            # the NOT EXISTS is answered through the UNIQUE(name, datemodify) index of checkdata
+            conditions.append("""habitdata.creation_time < :since AND NOT EXISTS (
+                SELECT 1 FROM checkdata AS later WHERE later.name = habitdata.name AND later.datemodify >= :since
+            )""")
+            parameters["since"] = to_day(inactive_since)
+        if priority is not None:
+            conditions.append("habitdata.priority = :priority")
+            parameters["priority"] = priority
+        return " AND ".join(conditions), parameters
+
+    def delete_habits(self, inactive_since=None, priority=None):
+        """Deletes the habits habit_filter selects with one statement, their other rows go with them through
+        ON DELETE CASCADE. Returns the names of the deleted habits."""
+        where, parameters = self.habit_filter(inactive_since, priority)
+        self.cursor.execute(f"DELETE FROM habitdata WHERE {where} RETURNING name", parameters)
+        names = [name for name, in self.cursor.fetchall()]
+        for name in names:
+            self.habits.invalidate(name)
+        self.commit()
+        return names
+
+    def iter_habit_definitions(self, inactive_since=None, priority=None):
+        """Streams the habits habit_filter selects with their checked dates as habit definitions for create_habits"""
+        where, parameters = self.habit_filter(inactive_since, priority)
+        definition = None
+        for name, description, priority, periodicity, creation_day, check_day in self.connection.execute(f"""
+            SELECT name, description, priority, periodicity, creation_time, datemodify
+            FROM habitdata LEFT JOIN checkdata USING (name)
+            WHERE {where} ORDER BY habitdata.rowid, datemodify
+            """, parameters):
+            if definition is None or definition["name"] != name:
+                if definition is not None:
+                    yield definition
+                definition = {
+                    "name": name, "description": description, "priority": priority, "periodicity": Periodicity(periodicity).name,
+                    "creation_time": day_string(creation_day), "checks": [],
+                }
+            if check_day is not None:
+                definition["checks"].append(day_string(check_day))
+        if definition is not None:
+            yield definition
+
+    def query_storage(self):
+        """Returns the pages of the file, how many of them are free and the page size in bytes"""
+        page_count = self.cursor.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.cursor.execute("PRAGMA page_size").fetchone()[0]
+        return page_count, freelist_count, page_size
+
+    def compact(self, full=False):
+        """Gives the free pages of the file back to the file system. Files with incremental auto_vacuum only move
+        their last pages into the free ones, older files are switched to it with one full VACUUM. full=True always
+        runs the VACUUM, which also repacks the pages that deletes left partly empty but rewrites the whole file.
+        Returns the pages before and after and the page size in bytes."""
+        if self.transaction_depth:
+            raise InvalidParameterError("The database can't be compacted inside a transaction")
         self.connection.commit()
+        pages_before, _, page_size = self.query_storage()
+        if not full and self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # execute() only steps the pragma once, which frees a single page, executescript runs it to the end
+            self.connection.executescript("PRAGMA incremental_vacuum;")
+        else:
+            self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.cursor.execute("VACUUM")
+        # in WAL mode the file only shrinks once the log is written back
+        if self.cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        pages_after = self.query_storage()[0]
+        return pages_before, pages_after, page_size
 
     def close(self):
         self.connection.close()
 
-db = DataBase()
-def init_predefined_habits(db: DataBase, habit_name: str) -> None:
-    """Initialises the predefined Habits"""
-    predefined_habits = {
-        "reading": ("reading", "10 minutes of daily reading", 4, Periodicity.DAILY),
-        "cdcworkout": ("CDC workout", "CDC recommended workout 180 minutes of moderate activity per week", 2, Periodicity.WEEKLY),
-        "vegandiet": ("vegan diet", "Following a healthy plant-based diet", 4, Periodicity.DAILY),
-        "smokingcessation": ("smoking cessation", "Not having smoked today", 8, Periodicity.DAILY),
-        "meditate": ("meditate", "10 minutes of meditation at any time of the day", 8, Periodicity.DAILY),
-    }
-    # pre-generated check data
-    habit_check_data = {
+class LazyDataBase:
+    """Stands in for a DataBase that is only opened when it is used for the first time,
+    so importing the module or showing the CLI help doesn't touch the database file."""
+    def __init__(self, db_path=None, profile=None) -> None:
+        # not named db_path and profile, those would hide the attributes of the DataBase from __getattr__
+        self.configured_path = db_path
+        self.configured_profile = profile
+        self.database = None
+
+    def configure(self, db_path=None, profile=None):
+        """Sets the database file and storage profile, has to be called before the database is used"""
+        if self.database is not None:
+            raise InvalidParameterError("The database is already open, configure it before using it")
+        self.configured_path = db_path or self.configured_path
+        self.configured_profile = profile or self.configured_profile
+
+    def path(self):
+        """Returns the configured database file, else the one of the environment or the default"""
+        return self.configured_path or os.environ.get(DB_PATH_ENV) or DEFAULT_DB_PATH
+
+    def get(self) -> DataBase:
+        """Returns the DataBase and opens it on the first call"""
+        if self.database is None:
+            self.database = DataBase(self.path(), profile=self.configured_profile or os.environ.get(STORAGE_PROFILE_ENV) or "default")
+        return self.database
+
+    def __getattr__(self, attribute):
+        return getattr(self.get(), attribute)
+
+class ConnectionPool:
+    """Hands out up to size read only DataBase connections to one database file, so readers like Analyse
+    in several threads don't share a connection and, with the concurrent profile, never wait for the writer"""
+    def __init__(self, db_path, size=4, profile="concurrent") -> None:
+        self.db_path = db_path
+        self.size = size
+        self.profile = profile
+        self.created = 0
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def reader(self):
+        """Lends a read only DataBase for the with block, waits if all of them are in use"""
+        database = self.acquire()
+        try:
+            yield database
+        finally:
+            self.idle.put(database)
+
+    def acquire(self):
+        """Returns an idle connection, opens a new one while there are less than size"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return DataBase(self.db_path, profile=self.profile, read_only=True)
+        return self.idle.get()
+
+    def close(self):
+        """Closes the idle connections"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ShardRouter:
+    """Routes every user to a database file of their own in a directory, so habit names only have to be unique per user
+    and users don't wait for each other's write locks. Keeps the max_open most recently used DataBases open
+    and closes the least recently used one beyond that. Like DataBase it is meant to be used by one thread."""
+    SUFFIX = ".db"
+
+    def __init__(self, directory, max_open=16, profile="default") -> None:
+        self.directory = directory
+        self.max_open = max_open
+        self.profile = profile
+        self.open_shards = OrderedDict()
+
+    def path(self, user):
+        """Returns the database file of a user, the name is quoted so any user name is a safe file name"""
+        if not user:
+            raise InvalidParameterError("The user name is missing")
+        import urllib.parse
+        return os.path.join(self.directory, urllib.parse.quote(user, safe="") + self.SUFFIX)
+
+    def get(self, user) -> DataBase:
+        """Returns the DataBase of a user, creating their file on first use"""
+        database = self.open_shards.get(user)
+        if database is not None:
+            self.open_shards.move_to_end(user)
+            return database
+        os.makedirs(self.directory, exist_ok=True)
+        database = DataBase(self.path(user), profile=self.profile)
+        self.open_shards[user] = database
+        if len(self.open_shards) > self.max_open:
+            _, evicted = self.open_shards.popitem(last=False)
+            evicted.close()
+        return database
+
+    def users(self):
+        """Returns the users with a database file in the directory, sorted"""
+        if not os.path.isdir(self.directory):
+            return []
+        import urllib.parse
+        return sorted(
+            urllib.parse.unquote(file_name[:-len(self.SUFFIX)])
+            for file_name in os.listdir(self.directory) if file_name.endswith(self.SUFFIX)
+        )
+
+    def close(self):
+        """Closes all open DataBases"""
+        while self.open_shards:
+            self.open_shards.popitem()[1].close()
+
+db = LazyDataBase()
+# the predefined habits by their CLI name, all created on PREDEFINED_CREATION_DATE
+PREDEFINED_HABITS = {
+    "reading": ("reading", "10 minutes of daily reading", 4, Periodicity.DAILY),
+    "cdcworkout": ("CDC workout", "CDC recommended workout 180 minutes of moderate activity per week", 2, Periodicity.WEEKLY),
+    "vegandiet": ("vegan diet", "Following a healthy plant-based diet", 4, Periodicity.DAILY),
+    "smokingcessation": ("smoking cessation", "Not having smoked today", 8, Periodicity.DAILY),
+    "meditate": ("meditate", "10 minutes of meditation at any time of the day", 8, Periodicity.DAILY),
+}
+PREDEFINED_CREATION_DATE = "2024-08-12"
+# pre-generated check data of the predefined habits by habit name
+PREDEFINED_CHECKS = {
     'reading': [
-        ('reading', '2024-08-12', 1),
-        ('reading', '2024-08-14', 1),
-        ('reading', '2024-08-19', 1),
-        ('reading', '2024-08-22', 1),
-        ('reading', '2024-08-23', 1),
-        ('reading', '2024-08-30', 1),
-        ('reading', '2024-08-31', 1),
-        ('reading', '2024-09-01', 1),
-        ('reading', '2024-09-02', 1),
-        ('reading', '2024-09-03', 1),
-        ('reading', '2024-09-04', 1),
-        ('reading', '2024-09-05', 1),
-        ('reading', '2024-09-08', 1)
+        '2024-08-12', '2024-08-14', '2024-08-19', '2024-08-22', '2024-08-23', '2024-08-30', '2024-08-31',
+        '2024-09-01', '2024-09-02', '2024-09-03', '2024-09-04', '2024-09-05', '2024-09-08',
     ],
     'CDC workout': [
-        ('CDC workout', '2024-08-12', 1),
-        ('CDC workout', '2024-08-14', 1),
-        ('CDC workout', '2024-08-15', 1),
-        ('CDC workout', '2024-08-17', 1),
-        ('CDC workout', '2024-08-20', 1),
-        ('CDC workout', '2024-08-23', 1),
-        ('CDC workout', '2024-08-27', 1),
-        ('CDC workout', '2024-08-28', 1),
-        ('CDC workout', '2024-08-30', 1),
-        ('CDC workout', '2024-09-01', 1),
-        ('CDC workout', '2024-09-02', 1),
-        ('CDC workout', '2024-09-03', 1),
-        ('CDC workout', '2024-09-05', 1),
-        ('CDC workout', '2024-09-06', 1),
-        ('CDC workout', '2024-09-08', 1)
+        '2024-08-12', '2024-08-14', '2024-08-15', '2024-08-17', '2024-08-20', '2024-08-23', '2024-08-27',
+        '2024-08-28', '2024-08-30', '2024-09-01', '2024-09-02', '2024-09-03', '2024-09-05', '2024-09-06',
+        '2024-09-08',
     ],
     'vegan diet': [
-        ('vegan diet', '2024-08-12', 1),
-        ('vegan diet', '2024-08-15', 1),
-        ('vegan diet', '2024-08-16', 1),
-        ('vegan diet', '2024-08-17', 1),
-        ('vegan diet', '2024-08-18', 1),
-        ('vegan diet', '2024-08-20', 1),
-        ('vegan diet', '2024-08-22', 1),
-        ('vegan diet', '2024-08-23', 1),
-        ('vegan diet', '2024-08-27', 1),
-        ('vegan diet', '2024-08-28', 1),
-        ('vegan diet', '2024-08-30', 1),
-        ('vegan diet', '2024-09-02', 1),
-        ('vegan diet', '2024-09-03', 1),
-        ('vegan diet', '2024-09-04', 1),
-        ('vegan diet', '2024-09-05', 1)
+        '2024-08-12', '2024-08-15', '2024-08-16', '2024-08-17', '2024-08-18', '2024-08-20', '2024-08-22',
+        '2024-08-23', '2024-08-27', '2024-08-28', '2024-08-30', '2024-09-02', '2024-09-03', '2024-09-04',
+        '2024-09-05',
     ],
     'smoking cessation': [
-        ('smoking cessation', '2024-08-12', 1),
-        ('smoking cessation', '2024-08-14', 1),
-        ('smoking cessation', '2024-08-15', 1),
-        ('smoking cessation', '2024-08-16', 1),
-        ('smoking cessation', '2024-08-17', 1),
-        ('smoking cessation', '2024-08-19', 1),
-        ('smoking cessation', '2024-08-23', 1),
-        ('smoking cessation', '2024-08-25', 1),
-        ('smoking cessation', '2024-08-28', 1),
-        ('smoking cessation', '2024-08-29', 1),
-        ('smoking cessation', '2024-08-30', 1),
-        ('smoking cessation', '2024-09-04', 1),
-        ('smoking cessation', '2024-09-06', 1),
-        ('smoking cessation', '2024-09-08', 1)
+        '2024-08-12', '2024-08-14', '2024-08-15', '2024-08-16', '2024-08-17', '2024-08-19', '2024-08-23',
+        '2024-08-25', '2024-08-28', '2024-08-29', '2024-08-30', '2024-09-04', '2024-09-06', '2024-09-08',
     ],
     'meditate': [
-        ('meditate', '2024-08-12', 1),
-        ('meditate', '2024-08-16', 1),
-        ('meditate', '2024-08-17', 1),
-        ('meditate', '2024-08-20', 1),
-        ('meditate', '2024-08-21', 1),
-        ('meditate', '2024-08-22', 1),
-        ('meditate', '2024-08-26', 1),
-        ('meditate', '2024-08-27', 1),
-        ('meditate', '2024-08-28', 1),
-        ('meditate', '2024-08-31', 1)
-    ]
-    }
-
-    add_habit = predefined_habits.get(habit_name.lower())
-    if add_habit:
-        habit = Habit(db, add_habit[0], add_habit[1], add_habit[2], add_habit[3])
-        
-        habit.current_streak = None
-        habit.longest_streak = 0
-        habit.longest_break = 0
-        habit.creation_time = datetime.strptime("2024-08-12", "%Y-%m-%d")
-        db.db_insert(habit)
+        '2024-08-12', '2024-08-16', '2024-08-17', '2024-08-20', '2024-08-21', '2024-08-22', '2024-08-26',
+        '2024-08-27', '2024-08-28', '2024-08-31',
+    ],
+}
+# the invalid habit definitions an error message lists before it only counts the rest
+MAX_LISTED_ERRORS = 20
 
-        check_list= habit_check_data.get(habit_name,[])
+def predefined_definitions(habit_names):
+    """Returns the habit definitions of predefined habits for create_habits, with their check data"""
+    definitions = []
+    for habit_name in habit_names:
+        add_habit = PREDEFINED_HABITS.get(habit_name.lower())
+        if add_habit is None:
+            raise InvalidParameterError(
+                f"The habit {habit_name} is not one of the predefined habits: \"reading\", \"cdcworkout\", \"vegandiet\", \"smokingceassation\", \"meditate\"."
+            )
+        name, description, priority, periodicity = add_habit
+        definitions.append({
+            "name": name, "description": description, "priority": priority, "periodicity": periodicity,
+            "creation_time": PREDEFINED_CREATION_DATE, "checks": PREDEFINED_CHECKS.get(name, []),
+        })
+    return definitions
 
-        if check_list:
-            db.db_insert_check(check_list)
-        streaks = Streaks(db, habit.name)
-        current_streak_value = streaks.current_streak()
-        longest_streak_value, longest_break_value = streaks.longest_streak()
-        db.update_streaks(habit.name, current_streak_value, longest_streak_value, longest_break_value)
-    
+def init_predefined_habits(db: DataBase, habit_name) -> None:
+    """Initialises the predefined Habits, habit_name is the name of one of them or a list of names"""
+    create_habits(db, predefined_definitions([habit_name] if isinstance(habit_name, str) else habit_name))
+
+def validate_habit_definitions(db: DataBase, definitions):
+    """Turns habit definitions into Habit instances and (name, day, 1) checks in one pass over them,
+    raises an InvalidParameterError that lists every invalid definition"""
+    habits, checks, errors, names = [], [], [], set()
+    today = date.today().toordinal()
+    for number, definition in enumerate(definitions, 1):
+        name = definition.get("name")
+        try:
+            if name in names:
+                raise InvalidParameterError("The name is used by an earlier definition")
+            try:
+                priority = int(definition.get("priority"))
+            except (TypeError, ValueError):
+                raise InvalidParameterError(f"The priority {definition.get('priority')} is not a number between 1 and 10")
+            periodicity = definition.get("periodicity")
+            if not isinstance(periodicity, Periodicity):
+                try:
+                    periodicity = Periodicity[str(periodicity).upper()]
+                except KeyError:
+                    raise InvalidParameterError(f"The periodicity {periodicity} is not DAILY or WEEKLY")
+            habit = Habit(db, name, definition.get("description"), priority, periodicity)
+            try:
+                if definition.get("creation_time"):
+                    habit.creation_time = date.fromordinal(to_day(definition["creation_time"]))
+                check_days = [to_day(checked_date) for checked_date in definition.get("checks") or ()]
+            except (AttributeError, TypeError, ValueError) as error:
+                raise InvalidParameterError(f"A date is not a year-month-day date: {error}")
+            creation_day = to_day(habit.creation_time)
+            if creation_day > today:
+                raise InvalidParameterError("The creation date is in the future")
+            for check_day in check_days:
+                if not creation_day <= check_day <= today:
+                    raise InvalidParameterError(f"The date {day_string(check_day)} is not within the habit creation and today's date")
+        except InvalidParameterError as error:
+            errors.append(f"{number} ({name}): {error}")
+            continue
+        names.add(name)
+        habits.append(habit)
+        checks.extend((name, check_day, 1) for check_day in check_days)
+    if errors:
+        listed = "\n".join(errors[:MAX_LISTED_ERRORS])
+        more = f"\n... and {len(errors) - MAX_LISTED_ERRORS} more" if len(errors) > MAX_LISTED_ERRORS else ""
+        raise InvalidParameterError(f"{len(errors)} invalid habit definition(s), nothing was created:\n{listed}{more}")
+    return habits, checks
+
+def create_habits(db: DataBase, definitions):
+    """Creates habits from dicts with a name, description, priority, periodicity and optionally a creation_time and
+    a list of checked dates (checks). Every definition is validated before anything is written, then the habits
+    are inserted with one statement and their checks with another in one transaction, and the streaks are computed
+    once per habit with checks. Habits whose name exists are skipped with their checks.
+    Returns the names of the created habits, the names of the skipped ones and the number of checks."""
+    habits, checks = validate_habit_definitions(db, definitions)
+    with db.transaction():
+        skipped = db.query_existing_habits(habit.name for habit in habits)
+        habits = [habit for habit in habits if habit.name not in skipped]
+        db.insert_habits(habits)
+        for habit in habits:
+            # the streak pass below finds the new habits in the habit cache instead of reading them back
+            db.habits.remember(habit.name, (habit.periodicity, to_day(habit.creation_time)))
+        checks = [check for check in checks if check[0] not in skipped]
+        inserted = db.insert_check_batch(checks) if checks else 0
+        streak_engine = IncrementalStreaks(db)
+        for name in dict.fromkeys(name for name, _, _ in checks):
+            Streaks(db, name)
+            streak_engine.update_habit(name)
+    return [habit.name for habit in habits], sorted(skipped), inserted
+
+def read_habit_file(path, file_format=None):
+    """Streams habit definitions for create_habits from a CSV file with name, description, priority, periodicity and
+    optionally creation_time and checks columns (the checked dates separated by spaces), or a JSONL file with these keys
+    and the checked dates as a list"""
+    if file_format is None:
+        file_format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+    with open(path, newline='') as file:
+        if file_format == "csv":
+            for row in csv.DictReader(file):
+                row["checks"] = (row.get("checks") or "").split()
+                yield row
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+def read_check_file(path, file_format=None):
+    """Streams (name, date) checks from a CSV file with a name and date column or a JSONL file with name and date keys"""
+    if file_format is None:
+        file_format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+    with open(path, newline='') as file:
+        if file_format == "csv":
+            for row in csv.DictReader(file):
+                yield row.get("name"), row.get("date") or row.get("datemodify")
+        else:
+            for line in file:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row.get("name"), row.get("date") or row.get("datemodify")
+
+def write_export(path, columns, chunks, file_format=None, column_types=None):
+    """Writes chunks of rows to a CSV, JSONL or Parquet file one chunk at a time and returns the number of rows.
+    Parquet needs pyarrow, column_types are the declared SQLite types of the columns for its schema."""
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lstrip(".")
+        file_format = {"json": "jsonl", "pq": "parquet"}.get(extension, extension)
+    if file_format not in EXPORT_FORMATS:
+        raise InvalidParameterError(f"The format '{file_format}' is not one of {', '.join(EXPORT_FORMATS)}")
+    if file_format == "parquet":
+        return write_parquet(path, columns, chunks, column_types or {})
+    rows_written = 0
+    with open(path, "w", newline='') as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for rows in chunks:
+                writer.writerows(rows)
+                rows_written += len(rows)
+        else:
+            for rows in chunks:
+                file.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+                rows_written += len(rows)
+    return rows_written
+
+def write_parquet(path, columns, chunks, column_types):
+    """Writes every chunk as a row group of a Parquet file, INTEGER and REAL columns keep their types, everything else is a string"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise InvalidParameterError("Exporting to Parquet needs pyarrow, install it with pip install pyarrow")
+    types = {"INTEGER": pyarrow.int64(), "REAL": pyarrow.float64()}
+    schema = pyarrow.schema([(column, types.get(column_types.get(column, "").upper(), pyarrow.string())) for column in columns])
+    rows_written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            values = [[None if value is None else str(value) if field.type == pyarrow.string() else value for value in column]
+                      for field, column in zip(schema, zip(*rows))]
+            writer.write_table(pyarrow.Table.from_arrays(values, schema=schema))
+            rows_written += len(rows)
+    return rows_written
+
+@timed("export_table")
+def export_table(db: DataBase, table, path, file_format=None, name=None, start=None, end=None, periodicity=None, chunk_size=1000):
+    """Streams a filtered table into an export file and returns the number of exported rows"""
+    columns, chunks = db.export_chunks(table, name, start, end, periodicity, chunk_size)
+    return write_export(path, columns, chunks, file_format, db.query_column_types(table))
+
+def archive_habits(db: DataBase, path=None, inactive_since=None, priority=None):
+    """Deletes the habits DataBase.habit_filter selects in one transaction, with path they are written to a JSONL file
+    of habit definitions first that create-habits can read back. Returns the names of the deleted habits."""
+    with db.transaction():
+        if path is not None:
+            with open(path, "w") as file:
+                for definition in db.iter_habit_definitions(inactive_since, priority):
+                    file.write(json.dumps(definition) + "\n")
+        return db.delete_habits(inactive_since, priority)
+
+@timed("import_checks")
+def import_checks(db: DataBase, checks, batch_size=10000, progress=None, backdate=False):
+    """Bulk imports checks for many habits and recomputes the streaks once per imported habit, all in one transaction.
+    backdate=True moves the creation of a habit back to its earliest imported check instead of refusing older checks."""
+    with db.transaction():
+        rows_read, inserted, names = db.bulk_insert_checks(checks, batch_size, progress, backdate)
+        streak_engine = IncrementalStreaks(db)
+        for name in sorted(names):
+            streak_engine.rebuild(name)
+            streak_engine.update_habit(name)
+    return rows_read, inserted, names
+
+def compute_streak_partition(db, habits, backend, today):
+    """Computes the streak segments and the current streak, longest streak and longest break of a list of
+    (name, periodicity, creation_time) habits without writing anything, db is a DataBase or the path of one"""
+    if isinstance(db, str):
+        db = DataBase(db, read_only=True)
+    habit_checks = []
+    for name, periodicity, creation_day in habits:
+        check_days = db.query_check_dates(name)
+        # habits without checks have no streaks to compute
+        if check_days:
+            delta_days = 1 if periodicity == Periodicity.DAILY.value else 7
+            habit_checks.append((name, delta_days, creation_day, check_days))
+    if backend == "numpy" and HAS_NUMPY:
+        segments = calculate_streaks_vectorised(habit_checks, today.toordinal())
     else:
-        raise InvalidParameterError(
-            f"The habit {habit_name} is not one of the predefined habits: \"reading\", \"cdcworkout\", \"vegandiet\", \"smokingceassation\", \"meditate\"."
-        )
+        segments = {}
+        for name, delta_days, _, check_days in habit_checks:
+            segments[name] = []
+            Streaks(db, name, rebuild=False).calculate_streaks(check_days, delta_days, segments[name])
+    streak_rows, habit_updates = [], []
+    for name, delta_days, _, _ in habit_checks:
+        streak_list = segments[name]
+        streak_rows.extend(streak_list)
+        since = current_period_start(Periodicity.WEEKLY if delta_days == 7 else Periodicity.DAILY, today.toordinal())
+        current_streak_value = next((count for _, _, end, typ, count in reversed(streak_list) if typ == "streak" and end >= since), 0)
+        longest_streak_value = max((count for _, _, _, typ, count in streak_list if typ == "streak"), default=0)
+        longest_break_value = max((count for _, _, _, typ, count in streak_list if typ == "break"), default=0)
+        habit_updates.append((current_streak_value, longest_streak_value, longest_break_value, name))
+    return streak_rows, habit_updates
+
+@timed("rebuild_all_streaks")
+def rebuild_all_streaks(db: DataBase, workers=None, backend=None):
+    """Recomputes the streaks of every habit, partitioned over a process pool where each worker reads through its own
+    read only connection, and writes all results in one transaction. Returns the habits and segments written and the
+    seconds spent per phase. Databases that only exist in memory are rebuilt in this process.
+    The "sql" backend runs the whole rebuild as a few statements inside SQLite and doesn't use workers."""
+    timings = {}
+    start_time = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    backend = backend or Streaks.backend
+    today = date.today()
+    if backend == "sql":
+        timings["partition"] = 0.0
+        with db.transaction():
+            db.cursor.execute("DELETE FROM streakdata")
+            start_time = time.perf_counter()
+            segments = db.insert_streaks_sql(today)
+            timings["compute"] = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            habits = db.update_streak_values(today)
+            db.cursor.execute("DELETE FROM habitstats")
+            timings["write"] = time.perf_counter() - start_time
+        return habits, segments, timings
+    habits = db.connection.execute("SELECT name, periodicity, creation_time FROM habitdata ORDER BY rowid").fetchall()
+    partitions = [habits[number::workers] for number in range(workers) if habits[number::workers]]
+    timings["partition"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    streak_rows, habit_updates = [], []
+    if workers > 1 and len(partitions) > 1 and db.db_path != ":memory:":
+        # the writes of this connection have to be visible to the workers
+        db.connection.commit()
+        # imported here, it takes longer to import than the whole CLI needs to start
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=len(partitions)) as executor:
+            futures = [executor.submit(compute_streak_partition, os.path.abspath(db.db_path), partition, backend, today) for partition in partitions]
+            results = [future.result() for future in futures]
+    else:
+        results = [compute_streak_partition(db, partition, backend, today) for partition in partitions]
+    for partition_rows, partition_updates in results:
+        streak_rows.extend(partition_rows)
+        habit_updates.extend(partition_updates)
+    timings["compute"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with db.transaction():
+        db.replace_all_streaks(streak_rows, habit_updates)
+    timings["write"] = time.perf_counter() - start_time
+    return len(habit_updates), len(streak_rows), timings
+
+@timed("rollover")
+def rollover(db: DataBase, today=None):
+    """Daily job that updates the open breaks and current streaks of all habits for today in one transaction,
+    returns the number of extended breaks, started breaks and updated habits"""
+    with db.transaction():
+        return db.rollover_streaks(today or date.today())
+
+def seconds_until_tomorrow(now=None):
+    """Returns the seconds until the next local midnight, when the scheduler runs the next rollover"""
+    now = now or datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+# environment variable for the default streak backend
+STREAK_BACKEND_ENV = "HABIT_TRACKER_STREAKS"
+STREAK_BACKENDS = ("python", "numpy", "sql")
 
 class Streaks:
-    """Streaks Class"""
-    def __init__(self, db, name) -> None:
+    """Streaks Class, rebuild=False gives access to the stored streaks without recomputing them.
+    backend overrides Streaks.backend for this habit, "numpy" falls back to "python" if NumPy is not installed
+    and "sql" computes the segments inside SQLite without loading the checks."""
+    # can be changed at runtime for all following rebuilds
+    backend = os.environ.get(STREAK_BACKEND_ENV, "python")
+
+    def __init__(self, db, name, rebuild=True, backend=None) -> None:
         self.db = db
         self.name = name
-        check_list = self.db.db_query_by_name(name, "datemodify", "checkdata")
-        check_list_sorted = sorted(check_list, reverse=False) 
-        if all(isinstance(date, str) for date in check_list_sorted):
-            check_list_sorted = [(date,) for date in check_list_sorted]
+        if not rebuild:
+            return
+        backend = backend or self.backend
+        if backend not in STREAK_BACKENDS:
+            raise InvalidParameterError(f"The streak backend {backend} doesn't exist, choose one of: {', '.join(STREAK_BACKENDS)}")
+        schedule = self.db.query_schedule(name)
+        if schedule is None:
+            raise InvalidParameterError(f"The habit {name} is not in the database")
+        if backend == "sql":
+            with phase("Streaks.insert_streaks_sql"):
+                self.db.insert_streaks_sql(date.today(), name)
+                self.db.commit()
+            return
+        periodicity, creation_day = schedule
+        check_days = self.db.query_check_dates(name)
         streak_list = []
-        periodicity = self.db.db_query_by_name(name, "periodicity", "habitdata")[0]
+        delta_days = 1 if periodicity == Periodicity.DAILY else 7
 
-        if periodicity == (0,):
-            self.calculate_streaks(check_list_sorted, timedelta(days=1), '%Y-%m-%d', streak_list)
-        elif periodicity == (1,):
-            self.calculate_streaks(check_list_sorted, timedelta(weeks=1), '%Y-%m-%d', streak_list)
+        if backend == "numpy" and HAS_NUMPY:
+            with phase("Streaks.calculate_streaks_vectorised"):
+                streak_list = calculate_streaks_vectorised([(name, delta_days, creation_day, check_days)], date.today().toordinal())[name]
         else:
-            raise InvalidParameterError(f"Invalid periodicity: {periodicity}")
-
-        
+            self.calculate_streaks(check_days, delta_days, streak_list)
         self.db.db_insert_streak(streak_list)
 
-    def calculate_streaks(self, check_list_sorted, delta, strftime_format, streak_list):
-        habit_data = self.db.db_query_by_name(self.name, "creation_time", "habitdata")
-        creation_date_tuple = habit_data[0][0] 
-        creation_date = datetime.strptime(creation_date_tuple.split(' ')[0], '%Y-%m-%d').date()  # Convert to date
-        if len(check_list_sorted) == 1:
+    @timed("Streaks.calculate_streaks")
+    def calculate_streaks(self, check_days, delta_days, streak_list):
+        """Appends the (name, start day, end day, type, count) streaks and breaks of the sorted checked day ordinals to streak_list"""
+        creation_day = self.db.query_schedule(self.name)[1]
+        if len(check_days) == 1:
             # Handles the case where there is only one date in the list e.g. if you check a newly created habit
-            current_date = datetime.strptime(check_list_sorted[0][0], strftime_format)
-            streak_list.append((self.name, current_date.strftime('%Y-%m-%d'), current_date.strftime('%Y-%m-%d'), "streak", 1))
+            streak_list.append((self.name, check_days[0], check_days[0], "streak", 1))
             return
 
         countif = 0
         countelif = 0
-        previous_date = None
+        previous_day = None
         streak_type = None 
-        start_date = None
-        first_checked_date = datetime.strptime(check_list_sorted[0][0], strftime_format).date()
+        start_day = None
+        first_checked_day = check_days[0]
         #handles breaks prior the first checked day as the following structure only computes inbetween the first and last checked day
-        if creation_date < first_checked_date:
-            break_days = (first_checked_date - creation_date).days
-            if break_days > 0:
-                streak_list.append((self.name, creation_date.strftime('%Y-%m-%d'), (first_checked_date - timedelta(days=1)).strftime('%Y-%m-%d'), "break", break_days))
+        if creation_day < first_checked_day:
+            streak_list.append((self.name, creation_day, first_checked_day - 1, "break", first_checked_day - creation_day))
         #whole code for handling inbetween checks and streaks, note that I this code does not include singular checks as streaks(assumtion that a streak begins with 2 consecutive checked days)
-        for current_date in check_list_sorted:
-            current_date = datetime.strptime(current_date[0], strftime_format).date() 
-            
-            if previous_date:
+        for current_day in check_days:
+            if previous_day is not None:
             
-                date_difference = (current_date - previous_date).days
+                day_difference = current_day - previous_day
                 #if the difference is 1 or 7 we know that we are working with a streak
-                if date_difference == delta.days:
+                if day_difference == delta_days:
                     if streak_type != "streak":
                         if streak_type == "break" and countelif > 0:
-                            streak_list.append((self.name, start_date, previous_date, "break", countelif))
-                        start_date = previous_date
+                            streak_list.append((self.name, start_day, previous_day, "break", countelif))
+                        start_day = previous_day
                         #this is initialiased as 2, assuming that two consecutive checks would be a two day streak
                         countif = 2
                     else:
@@ -402,67 +1731,130 @@ class Streaks:
                     
                     streak_type = "streak"
                 #when checked dates are longer apart than a day they count as breaks
-                elif date_difference > delta.days:
+                elif day_difference > delta_days:
                     if streak_type != "break":
                         if streak_type == "streak" and countif > 0:
-                            streak_list.append((self.name, start_date, previous_date, "streak", countif))
-                        start_date = previous_date + timedelta(days=1)
-                        countelif = date_difference - 1
+                            streak_list.append((self.name, start_day, previous_day, "streak", countif))
+                        start_day = previous_day + 1
+                        countelif = day_difference - 1
                     else:
-                        countelif += date_difference - 1
+                        countelif += day_difference - 1
 
                     streak_type = "break"
 
-            previous_date = current_date
+            previous_day = current_day
         #to handle final appends
         if streak_type == "streak" and countif > 0:
-            streak_list.append((self.name, start_date, previous_date, "streak", countif))
+            streak_list.append((self.name, start_day, previous_day, "streak", countif))
         elif streak_type == "break" and countelif > 0:
-            streak_list.append((self.name, start_date, previous_date, "break", countelif))
-        last_checked_date = previous_date
+            streak_list.append((self.name, start_day, previous_day, "break", countelif))
         #this is for adding breaks after the last checked date and todays date
-        current_date = datetime.now().date()
-        if last_checked_date < current_date:
-            break_days = (current_date - last_checked_date).days - 1  # Days between last check and today
-            if break_days > 0:
-                streak_list.append((self.name, (last_checked_date + timedelta(days=1)).strftime('%Y-%m-%d'), current_date.strftime('%Y-%m-%d'), "break", break_days))
+        today = date.today().toordinal()
+        break_days = today - previous_day - 1  # Days between last check and today
+        if break_days > 0:
+            streak_list.append((self.name, previous_day + 1, today, "break", break_days))
 
     def current_streak(self):
-        """Returns the current streak for a specified habit"""
-        query_object = self.db.db_query_by_name(self.name, "all", "streakdata")
+        """Returns the current streak for a specified habit, the streak that was checked today or in this week for weekly habits"""
+        schedule = self.db.query_schedule(self.name)
+        if schedule is None:
+            return 0
+        # daily and weekly streaks both end on the date of their last check
+        return self.db.query_current_streak(self.name, current_period_start(schedule[0], date.today().toordinal()))
 
-        # we had this before
-        if isinstance(query_object, tuple) and not isinstance(query_object[0], tuple):
-            query_object = [query_object]
+    def longest_streak(self):
+        """Returns the longest streak and break for a specified habit"""
+        return self.db.query_longest(self.name, 'streak'), self.db.query_longest(self.name, 'break')
 
-        current_date = datetime.now()
-        current_date_string_day = current_date.strftime('%Y-%m-%d')
-        current_date_string_week = current_date.strftime('%Y-%m-%d')
+class IncrementalStreaks:
+    """Keeps the streakdata of habits up to date without recomputing their whole check history.
+    New checks only rewrite the segments from the last closed segment before them onwards,
+    anything else (first checks, checks before the first check) falls back to a full rebuild through Streaks."""
+    def __init__(self, db) -> None:
+        self.db = db
 
-        current_streak_value = 0  # Default to 0 if no match is found
+    @timed("IncrementalStreaks.add_range")
+    def add_range(self, name, start_date, count, step_days):
+        """Inserts count checks every step_days from start_date that the habit doesn't have yet and updates its streaks
+        from start_date on, returns the number of new checks"""
+        first_check, last_check, check_count = self.db.query_check_bounds(name)
+        inserted = self.db.insert_check_range(name, start_date, count, step_days)
+        # a range that was checked already leaves the streaks as they are
+        if inserted:
+            self.update_from(name, to_day(start_date), first_check, last_check, check_count)
+        return inserted
 
-        for item in query_object:
-            if item[3] == 'streak' and (item[2] == current_date_string_day or item[2] == current_date_string_week):
-                current_streak_value = item[4]
-                break
+    def update_from(self, name, new_first_check, first_check, last_check, check_count):
+        """Updates the streaks of a habit after checks from the day ordinal new_first_check on were added to the
+        check_count checks from first_check to last_check, and writes the habitdata values"""
+        # a single stored check has no segments to continue from and earlier checks change the leading break
+        if check_count < 2 or new_first_check <= first_check or not self.update(name, new_first_check, first_check, last_check):
+            self.rebuild(name)
+        self.update_habit(name)
+
+    @timed("IncrementalStreaks.rebuild")
+    def rebuild(self, name):
+        """Fallback that recomputes all streaks and breaks of a habit from its full check history"""
+        self.db.clear_streaks_for_habit(name)
+        Streaks(self.db, name)
+
+    @timed("IncrementalStreaks.update")
+    def update(self, name, new_first_check, first_check, last_check):
+        """Rewrites the segments from the last segment that ended before the new checks, returns False if there is none"""
+        anchor = self.db.query_closed_segment(name, new_first_check, first_check, last_check)
+        if anchor is None:
+            return False
+        rowid, start_date, end_date, streak_type, count = anchor
+        periodicity = self.db.query_schedule(name)[0]
+        delta_days = 1 if periodicity == Periodicity.DAILY else 7
+        # the anchor ends on a check date, so the checks from there on are all the scan needs
+        check_days = self.db.load_check_history(name, end_date).days
+        streak_list = self.continue_streaks(name, check_days, delta_days, start_date, streak_type, count)
+        self.db.replace_streaks_from(name, rowid, streak_list)
+        return True
+
+    def continue_streaks(self, name, check_days, delta_days, start_day, streak_type, count):
+        """Continues the calculate_streaks loop from an open segment instead of the first check of the habit"""
+        streak_list = []
+        previous_day = check_days[0]
+        for current_day in check_days[1:]:
+            day_difference = current_day - previous_day
+            if day_difference == delta_days:
+                if streak_type != "streak":
+                    streak_list.append((name, start_day, previous_day, streak_type, count))
+                    start_day = previous_day
+                    count = 2
+                else:
+                    count += 1
+                streak_type = "streak"
+            elif day_difference > delta_days:
+                if streak_type != "break":
+                    streak_list.append((name, start_day, previous_day, streak_type, count))
+                    start_day = previous_day + 1
+                    count = day_difference - 1
+                else:
+                    count += day_difference - 1
+                streak_type = "break"
+            previous_day = current_day
+        streak_list.append((name, start_day, previous_day, streak_type, count))
+        #the open break between the last checked date and today
+        today = date.today().toordinal()
+        if today - previous_day > 1:
+            streak_list.append((name, previous_day + 1, today, "break", today - previous_day - 1))
+        return streak_list
+
+    def update_habit(self, name):
+        """Writes the current streak, longest streak and longest break of a habit to habitdata"""
+        streaks = Streaks(self.db, name, rebuild=False)
+        current_streak_value = streaks.current_streak()
+        longest_streak_value, longest_break_value = streaks.longest_streak()
+        self.db.update_streaks(name, current_streak_value, longest_streak_value, longest_break_value)
 
-        return current_streak_value
-   
-    def longest_streak(self):
-        """Returns the longest streak and break for a specified habit"""
-        query_object = self.db.db_query_by_name(self.name, "all", "streakdata")
-        if isinstance(query_object, tuple):
-            query_object = [query_object]
-        filtered_query_streak = [streak_type for streak_type in query_object if streak_type[3] == 'streak']
-        filtered_query_break = [streak_type for streak_type in query_object if streak_type[3] == 'break']
-        longest_streak = max(filtered_query_streak, key=lambda x: x[4])[4] if filtered_query_streak else 0
-        longest_break = max(filtered_query_break, key=lambda x: x[4])[4] if filtered_query_break else 0
-        return longest_streak, longest_break
-        
 class Analyse:
-    """Analyse Class"""
-    def __init__(self, db):
+    """Analyse Class, the results are printed through echo and returned"""
+    def __init__(self, db, echo=print):
         self.db = db
+        self.echo = echo
    
     def convert_to_index(self, column):
         """Returns the index of the given habitdata column, to use in max and sort functions, as db_query_by_name is in tuple form."""
@@ -479,49 +1871,173 @@ class Analyse:
             filtered_row = [row[i] for i in column_keep]
         return filtered_row
 
+    @timed("Analyse.max_typ")
     def max_typ(self, typ):
-        """Fetches the maximum of either priority, current_streak, longest_streak, longest_break"""
-        query_object = self.db.db_query_by_name("all", "all", "habitdata")
-        index = self.convert_to_index(typ)
-        max_value = max(query_object, key=lambda x: x[index])
-        max_values = [x for x in query_object if x[index] == max_value[index]]
-        habit_names = ", ".join([x[0] for x in max_values])
-        sorted_query_object = f"The greatest {typ} belongs to the habit(s): {habit_names}, with a {typ} of {max_value[index]}"
-        print(sorted_query_object)
+        """Fetches the maximum of either priority, current_streak, longest_streak, longest_break, total_checks or completion_rate"""
+        self.db.validate_habit_column(typ)
+        self.db.refresh_stats()
+        max_value = self.db.query_max(typ)
+        habit_names = ", ".join(name for name, in self.db.query_habits(["name"], where=(typ, max_value)))
+        sorted_query_object = f"The greatest {typ} belongs to the habit(s): {habit_names}, with a {typ} of {max_value}"
+        self.echo(sorted_query_object)
         return habit_names
 
+    @timed("Analyse.same")
     def same(self, typ, same):
         """Fetches the Habits containing the same values for: 2. priority(1-10) and 3. periodicity(DAILY, WEEKLY)"""
-        query_object = self.db.db_query_by_name("all", "all", "habitdata")
-        index = self.convert_to_index(typ)
-        
-        if typ == "periodicity":
-            same = Periodicity[same.upper()].value
-        else:
-            same = int(same)
-        same_value = [row for row in query_object if row[index] == same]
-        same_values = ", ".join([x[0] for x in same_value])
+        same = self.same_value(typ, same)
+        same_values = ", ".join(self.same_names(typ, same))
         sorted_query_object = f"The habits:{same_values} have the same {typ}: {same}"
-        print(sorted_query_object)
+        self.echo(sorted_query_object)
         return same_values
 
+    def same_value(self, typ, same):
+        """Converts the value entered for same to the stored priority or periodicity"""
+        self.convert_to_index(typ)
+        if typ == "periodicity":
+            return Periodicity[same.upper()].value
+        return int(same)
+
+    def same_names(self, typ, same):
+        """Returns the names of the habits with the given stored priority or periodicity as a list"""
+        return [name for name, in self.db.query_habits(["name"], where=(typ, same))]
+
+    @timed("Analyse.select")
     def select(self, name, typ, only, order):
-        """Selects a un/sorted list of the Habits or a Habit important parameters(which can be specified)"""
-        query_object = self.db.db_query_by_name(name, "all", "habitdata")
-        if typ != "all":
-            index = self.convert_to_index(typ)
-            if index == 0:
-                    sorted_query = sorted(query_object, key=lambda x: x[index], reverse=order)
-                    sorted_query_object = [(x[0]) for x in sorted_query]
-            else:
-                if only=='True':
-                    sorted_query = sorted(query_object, key=lambda x: x[index], reverse=order)
-                    sorted_query_object = self.keep_column(sorted_query, [0, index])
-                else:
-                    sorted_query = sorted(query_object, key=lambda x: x[index], reverse=order)
-                    sorted_query_object = [(x[0], x[index]) for x in sorted_query]
+        """Selects a un/sorted list of the Habits or a Habit important parameters(which can be specified),
+        order=True sorts from the greatest to the smallest value"""
+        if not name:
+            raise InvalidParameterError("You entered a habit that does not exist")
+        self.db.refresh_stats()
+        if typ == "all":
+            sorted_query_object = self.format_list(self.db.query_habits(HABIT_COLUMNS, name))
+        elif typ == "name":
+            sorted_query_object = self.format_list(habit_name for habit_name, in self.db.query_habits(["name"], name, order_by=[("name", order)]))
+        elif only == 'True':
+            # the last habit of the sorted list: the greatest value (or smallest if order is True), the latest added habit for equal values
+            self.db.validate_habit_column(typ)
+            row = self.db.query_habits(["name", typ], name, order_by=[(typ, not order), ("rowid", True)], limit=1).fetchone()
+            sorted_query_object = list(row) if row else []
         else:
-            sorted_query_object = query_object
+            self.db.validate_habit_column(typ)
+            sorted_query_object = self.format_list(self.db.query_habits(["name", typ], name, order_by=[(typ, order)]))
         sorted_query_object = f"Here is your list: {sorted_query_object}"
-        print(sorted_query_object)
-        return sorted_query_object
\ No newline at end of file
+        self.echo(sorted_query_object)
+        return sorted_query_object
+
+    def parse_date(self, value):
+        """Parses a year-month-day string of a date range"""
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise InvalidParameterError(f"The date {value} is not a year-month-day date")
+
+    def habit_bitmaps(self, name):
+        """Returns the check bitmaps of the named habit or of all habits"""
+        if name == "all":
+            return list(self.db.iter_check_bitmaps())
+        bitmap = self.db.load_check_bitmap(name)
+        if bitmap is None:
+            raise InvalidParameterError("You entered a habit that does not exist")
+        return [bitmap]
+
+    @timed("Analyse.checked_on")
+    def checked_on(self, day):
+        """Fetches the habits that were checked on the day, or in its week for weekly habits"""
+        checked_day = self.parse_date(day)
+        checked = ", ".join(bitmap.name for bitmap in self.db.iter_check_bitmaps() if checked_day in bitmap)
+        self.echo(f"The habits checked on {checked_day.isoformat()}: {checked}")
+        return checked
+
+    @timed("Analyse.completion")
+    def completion(self, name, start, end, today=None):
+        """Fetches the checked periods, the periods and the completion rate of a habit or all habits from start to end,
+        periods before the creation of a habit or after today don't count"""
+        start_date, end_date = self.parse_date(start), self.parse_date(end)
+        if end_date < start_date:
+            raise InvalidParameterError("The end of the time frame is before its start")
+        # days that haven't come yet can't be missed
+        end_date = min(end_date, today or date.today())
+        rates = []
+        for bitmap in self.habit_bitmaps(name):
+            checks = bitmap.count_between(start_date, end_date)
+            periods = bitmap.periods_between(start_date, end_date)
+            rates.append((bitmap.name, checks, periods, round(checks / periods, 3) if periods else 0.0))
+        self.echo(f"Here is your list: {rates}")
+        return rates
+
+    @timed("Analyse.heatmap")
+    def heatmap(self, name, days=365, today=None):
+        """Draws the checks of a habit over the last days, # for checked and . for missed periods.
+        Daily habits get a row per weekday and a column per week, weekly habits a single row of weeks."""
+        if name == "all":
+            raise InvalidParameterError("The heatmap draws a single habit, enter its name instead of all")
+        bitmap, = self.habit_bitmaps(name)
+        end_date = today or date.today()
+        start_date = end_date - timedelta(days=days - 1)
+        calendar = bitmap.calendar(start_date, end_date)
+        if bitmap.periodicity == Periodicity.WEEKLY:
+            rows = ["".join("#" if checked else "." for _, checked in calendar)]
+        else:
+            first_monday = adjust_week(start_date)
+            weeks = (end_date - first_monday).days // 7 + 1
+            grid = [[" "] * weeks for _ in range(7)]
+            for period_date, checked in calendar:
+                grid[period_date.weekday()][(period_date - first_monday).days // 7] = "#" if checked else "."
+            rows = [f"{weekday} {''.join(row)}" for weekday, row in zip(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"), grid)]
+        checks = sum(checked for _, checked in calendar)
+        heatmap = "\n".join([f"{bitmap.name}: {checks} of {len(calendar)} periods checked since {start_date.isoformat()}"] + rows)
+        self.echo(heatmap)
+        return heatmap
+
+    def format_list(self, rows):
+        """Formats streamed rows like a printed list without collecting them in one first"""
+        return "[" + ", ".join(repr(row) for row in rows) + "]"
+
+class ShardedAnalyse:
+    """Runs the Analyse queries on the database of every user of a ShardRouter and merges the results,
+    habits are named user/habit in the merged results"""
+    def __init__(self, router, echo=print):
+        self.router = router
+        self.echo = echo
+
+    def fan_out(self):
+        """Yields every user with an Analyse on their database"""
+        for user in self.router.users():
+            yield user, Analyse(self.router.get(user), echo=lambda text: None)
+
+    @timed("ShardedAnalyse.max_typ")
+    def max_typ(self, typ):
+        """Fetches the greatest priority, streak, break, total_checks or completion_rate over the habits of all users"""
+        maxima = {}
+        for user, analyse in self.fan_out():
+            analyse.db.validate_habit_column(typ)
+            analyse.db.refresh_stats()
+            value = analyse.db.query_max(typ)
+            if value is not None:
+                maxima[user] = value
+        max_value = max(maxima.values(), default=None)
+        habit_names = ", ".join(
+            f"{user}/{name}"
+            for user, value in maxima.items() if value == max_value
+            for name, in self.router.get(user).query_habits(["name"], where=(typ, max_value))
+        )
+        self.echo(f"The greatest {typ} belongs to the habit(s): {habit_names}, with a {typ} of {max_value}")
+        return habit_names
+
+    @timed("ShardedAnalyse.same")
+    def same(self, typ, same):
+        """Fetches the habits of all users with the same priority or periodicity"""
+        # the names of every shard are merged as lists, joining and splitting them would break names with commas
+        same_values = ", ".join(
+            f"{user}/{name}" for user, analyse in self.fan_out() for name in analyse.same_names(typ, analyse.same_value(typ, same))
+        )
+        self.echo(f"The habits:{same_values} have the same {typ}: {same}")
+        return same_values
+
+    @timed("ShardedAnalyse.completion")
+    def completion(self, start, end):
+        """Fetches the completion rates of the habits of all users from start to end"""
+        rates = [(f"{user}/{name}",) + rate for user, analyse in self.fan_out() for name, *rate in analyse.completion("all", start, end)]
+        self.echo(f"Here is your list: {rates}")
+        return rates
@@ -0,0 +1,161 @@
+"""Optional instrumentation of the habit tracker: per statement SQL timings and timers around the Streaks and Analyse phases.
+Nothing is recorded (and DataBase uses plain sqlite3 connections) until start() is called."""
+import functools
+import re
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+
+# the running Profiler, None while profiling is off
+active = None
+
+class Profiler:
+    """Collects the count, total seconds and rows returned per SQL statement and the count and seconds per phase"""
+    def __init__(self) -> None:
+        self.statements = {}
+        self.phases = {}
+
+    def record_statement(self, sql, seconds):
+        """Adds an execution or commit of a statement"""
+        statement = self.statements.setdefault(sql, {"count": 0, "seconds": 0.0, "rows": 0})
+        statement["count"] += 1
+        statement["seconds"] += seconds
+
+    def add_fetch(self, sql, seconds, rows):
+        """Adds the time and rows of fetching results to a statement without counting another execution"""
+        statement = self.statements.setdefault(sql, {"count": 0, "seconds": 0.0, "rows": 0})
+        statement["seconds"] += seconds
+        statement["rows"] += rows
+
+    def record_phase(self, name, seconds):
+        """Adds a call of a phase"""
+        phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+        phase["count"] += 1
+        phase["seconds"] += seconds
+
+    def to_dict(self):
+        return {"statements": self.statements, "phases": self.phases}
+
+    def summary(self):
+        """Returns the statements and phases as text tables, the slowest first"""
+        lines = [f"{'calls':>7} {'total ms':>10} {'mean ms':>9} {'rows':>8}  statement"]
+        for sql, statement in sorted(self.statements.items(), key=lambda item: -item[1]["seconds"]):
+            mean = statement["seconds"] / statement["count"] if statement["count"] else 0.0
+            lines.append(f"{statement['count']:>7} {statement['seconds'] * 1000:>10.2f} {mean * 1000:>9.3f} {statement['rows']:>8}  {sql[:90]}")
+        lines.append("")
+        lines.append(f"{'calls':>7} {'total ms':>10} {'mean ms':>9}  phase")
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"{phase['count']:>7} {phase['seconds'] * 1000:>10.2f} {phase['seconds'] / phase['count'] * 1000:>9.3f}  {name}")
+        return "\n".join(lines)
+
+def start():
+    """Switches profiling on for the DataBase connections opened from now on and returns the Profiler"""
+    global active
+    active = Profiler()
+    return active
+
+def stop():
+    """Switches profiling off and returns the Profiler that was running"""
+    global active
+    profiler, active = active, None
+    return profiler
+
+def normalise(sql):
+    """Collapses the whitespace of a statement so the same query is counted under one name"""
+    return re.sub(r"\s+", " ", sql).strip()
+
+@contextmanager
+def timed_phase(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if active is not None:
+            active.record_phase(name, time.perf_counter() - start_time)
+
+def phase(name):
+    """Context manager that times a phase while profiling is on and does nothing otherwise"""
+    return timed_phase(name) if active is not None else nullcontext()
+
+def timed(name):
+    """Decorator that times every call of the function as a phase while profiling is on"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active is None:
+                return function(*args, **kwargs)
+            with timed_phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports the time and returned rows of its statements to the active Profiler"""
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        self.statement = normalise(sql)
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.record(time.perf_counter() - start_time)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = normalise(sql)
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.record(time.perf_counter() - start_time)
+
+    def fetchone(self):
+        start_time = time.perf_counter()
+        row = super().fetchone()
+        self.record_fetch(time.perf_counter() - start_time, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        start_time = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.record_fetch(time.perf_counter() - start_time, len(rows))
+        return rows
+
+    def fetchall(self):
+        start_time = time.perf_counter()
+        rows = super().fetchall()
+        self.record_fetch(time.perf_counter() - start_time, len(rows))
+        return rows
+
+    def __next__(self):
+        start_time = time.perf_counter()
+        row = super().__next__()
+        self.record_fetch(time.perf_counter() - start_time, 1)
+        return row
+
+    def record(self, seconds):
+        if active is not None:
+            active.record_statement(self.statement, seconds)
+
+    def record_fetch(self, seconds, rows):
+        if active is not None and self.statement is not None:
+            active.add_fetch(self.statement, seconds, rows)
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors and commits report to the active Profiler"""
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start_time = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            if active is not None:
+                active.record_statement("COMMIT", time.perf_counter() - start_time)
@@ -0,0 +1,259 @@
+"""Asyncio service layer over the habit store for many concurrent clients in one process.
+AsyncHabitStore runs the Analyse queries on a bounded pool of read only connections and funnels all writes through
+one writer task that commits whatever queued up in the meantime as one transaction. serve() exposes the store
+as JSON-RPC 2.0 over HTTP POST requests on a local port."""
+import asyncio
+import inspect
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from habit_tracker import DataBase, ConnectionPool, Habit, Periodicity, Analyse, InvalidParameterError, check_habit
+
+# the store methods that can be called through JSON-RPC
+SERVICE_METHODS = ("create", "check", "delete", "max_value", "same_value", "select_habits", "checked_on", "completion_rate", "heatmap")
+
+def quiet(text):
+    """Analyse echo for the service, the results go into the responses instead of stdout"""
+
+class AsyncHabitStore:
+    """Habit store for asyncio code. Reads run on readers threads with a read only connection each,
+    writes are queued and run on a single writer thread with the only writing connection, up to max_batch
+    of them in one transaction and each in its own savepoint so a failing write doesn't roll back the others."""
+    def __init__(self, db_path, readers=4, max_batch=256) -> None:
+        if db_path == ":memory:":
+            raise InvalidParameterError("The service needs a database file, an in-memory database can't be shared between connections")
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.pool = ConnectionPool(db_path, readers)
+        self.read_executor = ThreadPoolExecutor(readers, thread_name_prefix="habit-reader")
+        self.write_executor = ThreadPoolExecutor(1, thread_name_prefix="habit-writer")
+        self.db = None
+        self.writes = None
+        self.writer = None
+        self.batches = 0
+        # the day the habitstats were last brought up to date, the readers can't refresh them themselves
+        self.stats_day = None
+
+    async def start(self):
+        """Opens (and migrates) the database on the writer thread and starts the writer task"""
+        loop = asyncio.get_running_loop()
+        self.db = await loop.run_in_executor(self.write_executor, lambda: DataBase(self.db_path, profile="concurrent"))
+        # the read only connections can't refresh the cached habit stats, the writer keeps them current
+        await loop.run_in_executor(self.write_executor, self.db.refresh_stats)
+        self.stats_day = date.today()
+        self.writes = asyncio.Queue()
+        self.writer = asyncio.create_task(self.write_loop())
+        return self
+
+    async def close(self):
+        """Stops the writer task and closes all connections"""
+        if self.writer is not None:
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+        if self.db is not None:
+            await asyncio.get_running_loop().run_in_executor(self.write_executor, self.db.close)
+        self.write_executor.shutdown()
+        self.read_executor.shutdown()
+        self.pool.close()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def write(self, operation, *args):
+        """Queues a write for the writer task and waits for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.writes.put((operation, args, future))
+        return await future
+
+    async def write_loop(self):
+        """Writes everything that queued up while the previous batch was written as the next batch"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < self.max_batch and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.write_executor, self.write_batch, batch)
+            except Exception as error:
+                results = [error] * len(batch)
+            self.batches += 1
+            for (_, _, future), result in zip(batch, results):
+                # the client may have gone away in the meantime
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def write_batch(self, batch):
+        """Runs queued writes in one transaction on the writer thread, returns the result or exception of each"""
+        results = []
+        with self.db.transaction():
+            for operation, args, _ in batch:
+                self.db.connection.execute("SAVEPOINT service_write")
+                try:
+                    results.append(operation(*args))
+                # any failing write, also one with arguments of the wrong type, only rolls back its own savepoint
+                except Exception as error:
+                    self.db.connection.execute("ROLLBACK TO service_write")
+                    results.append(error)
+                self.db.connection.execute("RELEASE service_write")
+            self.db.refresh_stats()
+        self.stats_day = date.today()
+        return results
+
+    async def read(self, query, *args):
+        """Runs an Analyse method on a reader thread with a connection of the pool,
+        after the writer refreshed the habitstats if they are from an earlier day"""
+        if self.stats_day != date.today():
+            await self.write(self.db.refresh_stats)
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, self.run_read, query, args)
+
+    def run_read(self, query, args):
+        with self.pool.reader() as database:
+            return query(Analyse(database, echo=quiet), *args)
+
+    def create_habit(self, name, description, priority, periodicity):
+        habit = Habit(self.db, name, description, priority, Periodicity[periodicity.upper()])
+        self.db.db_insert(habit)
+        return name
+
+    def check_habit(self, name, startdate, enddate):
+        if self.db.query_schedule(name) is None:
+            raise InvalidParameterError(f"No habit found with the name '{name}'")
+        check_habit(self.db, name, startdate, enddate)
+        return name
+
+    def delete_habit(self, name):
+        if self.db.query_schedule(name) is None:
+            raise InvalidParameterError(f"No habit found with the name '{name}'")
+        self.db.delete_habit(name)
+        return name
+
+    async def create(self, name: str, description: str, priority: int, periodicity: str):
+        """Creates a habit, periodicity is DAILY or WEEKLY"""
+        return await self.write(self.create_habit, name, description, priority, periodicity)
+
+    async def check(self, name: str, startdate: str = None, enddate: str = None):
+        """Checks a habit today or from startdate to enddate"""
+        return await self.write(self.check_habit, name, startdate, enddate)
+
+    async def delete(self, name: str):
+        return await self.write(self.delete_habit, name)
+
+    async def max_value(self, type: str):
+        return await self.read(Analyse.max_typ, type)
+
+    async def same_value(self, type, value):
+        return await self.read(Analyse.same, type, value)
+
+    async def select_habits(self, name: str = "all", type: str = "all", only: str = "False", order: str = "DESC"):
+        return await self.read(Analyse.select, name, type, only, order == "ASC")
+
+    async def checked_on(self, date: str):
+        return await self.read(Analyse.checked_on, date)
+
+    async def completion_rate(self, name: str, start: str, end: str):
+        return await self.read(Analyse.completion, name, start, end)
+
+    async def heatmap(self, name: str, days: int = 365):
+        return await self.read(Analyse.heatmap, name, days)
+
+def coerce_params(signature, arguments):
+    """Checks the bound params against the str and int annotations of the store method, numbers may be sent as strings.
+    Raises a TypeError or ValueError for a param of the wrong type."""
+    for name, value in arguments.arguments.items():
+        parameter = signature.parameters[name]
+        if value is None and parameter.default is None:
+            continue
+        if parameter.annotation is int:
+            if isinstance(value, bool) or not isinstance(value, (int, str)):
+                raise TypeError(f"{name} has to be a whole number")
+            arguments.arguments[name] = int(value)
+        elif parameter.annotation is str and not isinstance(value, str):
+            raise TypeError(f"{name} has to be a string")
+
+def rpc_error(request_id, code, message):
+    return {"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": request_id}
+
+async def dispatch(store, body):
+    """Calls the store method of a JSON-RPC request and returns the response"""
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return rpc_error(None, -32700, "Parse error")
+    if not isinstance(request, dict):
+        return rpc_error(None, -32600, "Invalid Request")
+    request_id = request.get("id")
+    method = request.get("method")
+    if method not in SERVICE_METHODS:
+        return rpc_error(request_id, -32601, f"Method not found: {method}")
+    params = request.get("params", {})
+    if not isinstance(params, (dict, list)):
+        return rpc_error(request_id, -32602, "Invalid params: params has to be an object or an array")
+    function = getattr(store, method)
+    signature = inspect.signature(function)
+    try:
+        arguments = signature.bind(**params) if isinstance(params, dict) else signature.bind(*params)
+        coerce_params(signature, arguments)
+    except (TypeError, ValueError) as error:
+        return rpc_error(request_id, -32602, f"Invalid params: {error}")
+    try:
+        result = await function(*arguments.args, **arguments.kwargs)
+    except (InvalidParameterError, sqlite3.Error, ValueError, KeyError) as error:
+        return rpc_error(request_id, -32000, str(error))
+    except Exception as error:
+        return rpc_error(request_id, -32603, f"Internal error: {error}")
+    return {"jsonrpc": "2.0", "result": result, "id": request_id}
+
+async def handle_connection(store, reader, writer):
+    """Answers the HTTP/1.1 requests of a keep-alive connection one after another"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if request_line.split()[0] == b"POST":
+                status, response = "200 OK", await dispatch(store, body)
+            else:
+                status, response = "405 Method Not Allowed", rpc_error(None, -32600, "Only POST requests are served")
+            payload = json.dumps(response).encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def start_service(store, host="127.0.0.1", port=8080):
+    """Starts the HTTP server of a started store and returns the asyncio server"""
+    return await asyncio.start_server(lambda reader, writer: handle_connection(store, reader, writer), host, port)
+
+async def serve(db_path, host="127.0.0.1", port=8080, readers=4, ready=None):
+    """Runs the service until it is cancelled, ready is called with the bound (host, port)"""
+    async with AsyncHabitStore(db_path, readers) as store:
+        server = await start_service(store, host, port)
+        async with server:
+            if ready:
+                ready(server.sockets[0].getsockname()[:2])
+            await server.serve_forever()
@@ -1,7 +1,17 @@
+import asyncio
+import json
 import pytest
+import random
+import threading
+import sqlite3
+import instrumentation
+import cli
+from click.testing import CliRunner
 from cli import same_value
-from habit_tracker import DataBase, Habit, Periodicity, Analyse, InvalidParameterError, init_predefined_habits
+from habit_tracker import DataBase, Habit, check_habit, create_habits, read_habit_file, archive_habits, CHILD_TABLES, Periodicity, Analyse, InvalidParameterError, Streaks, init_predefined_habits, import_checks, read_check_file, adjust_week, export_table, LazyDataBase, DB_PATH_ENV, DEFAULT_DB_PATH, SCHEMA_VERSION, ConnectionPool, rebuild_all_streaks, CheckHistory, ShardRouter, ShardedAnalyse, rollover
 from datetime import datetime, timedelta
+from service import AsyncHabitStore, start_service, dispatch
+from vectorised_streaks import calculate_streaks_vectorised
 class TestHabitTracker:
 
     def setup_method(self):
@@ -86,6 +96,17 @@ class TestHabitTracker:
         names=analyse.select(name="all", typ="name", only=False, order=True)
         assert names=="Here is your list: ['meditate', 'Test Habit']"
  
+    def test_select_only_greatest(self):
+        """Test that only='True' returns the habit with the greatest value, the latest added one for equal values."""
+        analyse = Analyse(self.db)
+        greatest = analyse.select(name="all", typ="priority", only='True', order=False)
+        assert greatest == "Here is your list: ['Test Habit', 8]"
+
+    def test_max_current_streak_skips_unchecked(self):
+        """Test that habits without a current streak yet don't break the max query."""
+        analyse = Analyse(self.db)
+        assert analyse.max_typ('current_streak') == 'meditate'
+
     def test_delete_habit(self):
         """Test for deleting a habit and associated data."""
         self.db.delete_habit('meditate')
@@ -94,6 +115,691 @@ class TestHabitTracker:
         result = self.db.cursor.execute("SELECT * FROM streakdata WHERE name = ?", ('meditate',)).fetchone()
         assert result is None, "The streak data should be deleted from streakdata."
     
+    def test_incremental_streaks_match_full_rebuild(self):
+        """Test that streaks updated check by check, including backfilled dates, match calculate_streaks."""
+        rng = random.Random(7)
+        for periodicity, delta_days in ((Periodicity.DAILY, 1), (Periodicity.WEEKLY, 7)):
+            name = f'Incremental {periodicity.name}'
+            habit = Habit(self.db, name, 'Incremental streaks', 5, periodicity)
+            habit.creation_time = datetime.now() - timedelta(days=120)
+            self.db.db_insert(habit)
+            # a random order makes most checks land in the middle of the existing history
+            for day in rng.sample(range(1, 120), 60):
+                date = (datetime.now() - timedelta(days=day)).strftime('%Y-%m-%d')
+                habit.check(name, date, date)
+                stored = self.db.cursor.execute("SELECT * FROM streakdata WHERE name = ? ORDER BY rowid", (name,)).fetchall()
+                expected = []
+                Streaks(self.db, name, rebuild=False).calculate_streaks(self.db.query_check_dates(name), delta_days, expected)
+                assert stored == expected
+
+    def test_vectorised_streaks_match_calculate_streaks(self):
+        """Test that the NumPy backend gives the same segments as calculate_streaks for many random daily and weekly habits."""
+        pytest.importorskip("numpy")
+        rng = random.Random(11)
+        habits = []
+        for number in range(60):
+            periodicity = rng.choice(list(Periodicity))
+            habit = Habit(self.db, f'Vectorised {number}', 'Vectorised streaks', 5, periodicity)
+            habit.creation_time = datetime.now() - timedelta(days=200)
+            self.db.db_insert(habit)
+            offsets = rng.sample(range(0, 200), rng.choice([1, 2, 5, 40, 150]))
+            check_days = sorted((datetime.now() - timedelta(days=offset)).toordinal() for offset in offsets)
+            habits.append((habit.name, 1 if periodicity == Periodicity.DAILY else 7, habit.creation_time.toordinal(), check_days))
+        vectorised = calculate_streaks_vectorised(habits, datetime.now().toordinal())
+        for name, delta_days, _, check_days in habits:
+            expected = []
+            Streaks(self.db, name, rebuild=False).calculate_streaks(check_days, delta_days, expected)
+            assert vectorised[name] == expected
+
+    def test_sql_streaks_match_calculate_streaks(self):
+        """Test that the window function backend gives the same segments as calculate_streaks for many random daily and weekly habits."""
+        rng = random.Random(13)
+        names = []
+        for number in range(60):
+            periodicity = rng.choice(list(Periodicity))
+            habit = Habit(self.db, f'Windowed {number}', 'Window function streaks', 5, periodicity)
+            habit.creation_time = datetime.now() - timedelta(days=200)
+            self.db.db_insert(habit)
+            offsets = rng.sample(range(0, 200), rng.choice([1, 2, 5, 40, 150]))
+            self.db.db_insert_check([(habit.name, (datetime.now() - timedelta(days=offset)).strftime('%Y-%m-%d'), 1) for offset in offsets])
+            names.append((habit.name, 1 if periodicity == Periodicity.DAILY else 7))
+        self.db.cursor.execute("DELETE FROM streakdata")
+        self.db.insert_streaks_sql(datetime.now().date())
+        for name, delta_days in names:
+            expected = []
+            Streaks(self.db, name, rebuild=False).calculate_streaks(self.db.query_check_dates(name), delta_days, expected)
+            stored = self.db.cursor.execute("SELECT * FROM streakdata WHERE name = ? ORDER BY rowid", (name,)).fetchall()
+            assert stored == expected
+
+    @pytest.mark.parametrize("backend", ["python", "numpy", "sql"])
+    def test_parallel_rebuild_matches_streaks(self, tmp_path, backend):
+        """Test that rebuilding all habits in worker processes gives the same streakdata and habitdata as Streaks."""
+        file_db = DataBase(str(tmp_path / 'rebuild.db'))
+        for habit_name in ('meditate', 'reading'):
+            init_predefined_habits(file_db, habit_name)
+        habit = Habit(file_db, 'Unchecked', 'Test Description', 8, Periodicity.WEEKLY)
+        file_db.db_insert(habit)
+        expected_streaks = file_db.db_query_by_name('all', 'all', 'streakdata')
+        expected_habits = file_db.db_query_by_name('all', 'all', 'habitdata')
+        file_db.cursor.execute("DELETE FROM streakdata")
+        file_db.cursor.execute("UPDATE habitdata SET longest_streak = 0, longest_break = 0")
+        habits, segments, timings = rebuild_all_streaks(file_db, workers=2, backend=backend)
+        assert (habits, segments) == (2, len(expected_streaks))
+        assert set(timings) == {"partition", "compute", "write"}
+        assert sorted(file_db.db_query_by_name('all', 'all', 'streakdata')) == sorted(expected_streaks)
+        assert file_db.db_query_by_name('all', 'all', 'habitdata') == expected_habits
+        file_db.close()
+
+    def test_compact_habit_and_check_history(self):
+        """Test that habits use __slots__ and the check history is loaded once as day ordinals."""
+        habit = self.db.load_habit('meditate')
+        assert not hasattr(habit, '__dict__') and not hasattr(Habit(self.db, 'a', 'b', 1, Periodicity.DAILY), '__dict__')
+        assert (habit.periodicity, habit.creation_date.isoformat()) == (Periodicity.DAILY, '2024-08-12')
+        history = self.db.load_check_history('meditate')
+        assert [checked.isoformat() for checked in history.dates()] == [date for date, in sorted(self.db.db_query_by_name('meditate', 'datemodify', 'checkdata'))]
+        assert '2024-08-16' in history and '2024-08-15' not in history
+        assert history.count_between('2024-08-16', '2024-08-22') == 5
+        assert history.add('2024-08-15') and not history.add('2024-08-15')
+        assert [history.name for history in self.db.iter_check_histories()] == ['meditate']
+        assert CheckHistory.from_dates('x', ['2024-08-13', '2024-08-12']).days.tolist() == [739110, 739111]
+
+    def test_profiling_records_statements_and_phases(self):
+        """Test that a profiled check records its statements, rows and phases and that unprofiled databases use plain connections."""
+        assert type(self.db.connection) is sqlite3.Connection
+        profiler = instrumentation.start()
+        try:
+            profiled_db = DataBase(':memory:')
+            init_predefined_habits(profiled_db, 'meditate')
+            Habit(profiled_db, 'meditate', 'Test Description', 8, Periodicity.DAILY).check('meditate')
+        finally:
+            instrumentation.stop()
+        assert profiler.statements["INSERT OR IGNORE INTO checkdata (name, datemodify, checks) VALUES (?, ?, ?)"]["count"] == 1
+        assert any(statement.startswith("WITH RECURSIVE offsets") for statement in profiler.statements)
+        assert profiler.statements["SELECT MIN(datemodify), MAX(datemodify), COUNT(*) FROM checkdata WHERE name = ?"]["rows"] == 1
+        assert {"Habit.check", "IncrementalStreaks.add_range", "Streaks.calculate_streaks"} <= set(profiler.phases)
+        assert "Habit.check" in profiler.summary()
+        profiled_db.close()
+
+    def test_bulk_import_checks(self, tmp_path):
+        """Test that a bulk import skips already checked dates and recomputes the streaks of the habit."""
+        check_file = tmp_path / 'checks.csv'
+        check_file.write_text('name,date\nmeditate,2024-08-12\nmeditate,2024-08-13\nmeditate,2024-08-14\nmeditate,2024-08-13\nmeditate,2024-08-18\n')
+        rows_read, inserted, names = import_checks(self.db, read_check_file(str(check_file)), batch_size=2)
+        assert (rows_read, inserted, names) == (5, 3, {'meditate'})
+        stored = self.db.db_query_by_name('meditate', 'all', 'streakdata')
+        self.db.clear_streaks_for_habit('meditate')
+        Streaks(self.db, 'meditate')
+        assert stored == self.db.db_query_by_name('meditate', 'all', 'streakdata')
+
+    def test_bulk_import_unknown_habit(self):
+        """Test that a bulk import with an unknown habit is rolled back completely."""
+        with pytest.raises(InvalidParameterError):
+            self.db.bulk_insert_checks([('meditate', '2024-08-13'), ('unknown', '2024-08-13')], batch_size=1)
+        assert len(self.db.db_query_by_name('meditate', 'all', 'checkdata')) == 10
+
+    def test_bulk_import_backdates_new_habit(self):
+        """Test that the history of a habit created today is only imported with backdate, which moves its creation back."""
+        habit = Habit(self.db, 'Test Habit', 'Test Description', 8, Periodicity.DAILY)
+        day = lambda days_ago: (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+        history = [('Test Habit', day(30)), ('Test Habit', day(29)), ('Test Habit', day(10))]
+        assert self.db.query_schedule('Test Habit')[1] == datetime.now().toordinal()
+        with pytest.raises(InvalidParameterError):
+            import_checks(self.db, history)
+        assert self.db.query_check_bounds('Test Habit')[2] == 0
+        with pytest.raises(InvalidParameterError):
+            import_checks(self.db, history + [('Test Habit', day(-1))], backdate=True)
+        assert import_checks(self.db, history, backdate=True)[1] == 3
+        assert self.db.cursor.execute("SELECT creation_time FROM habitdata WHERE name = 'Test Habit'").fetchone()[0] == (datetime.now() - timedelta(days=30)).toordinal()
+        stored = self.db.db_query_by_name('Test Habit', 'all', 'streakdata')
+        self.db.clear_streaks_for_habit('Test Habit')
+        Streaks(self.db, 'Test Habit')
+        assert stored == self.db.db_query_by_name('Test Habit', 'all', 'streakdata')
+        assert habit.check('Test Habit', day(20), day(20)) == 1
+
+    def test_failed_bulk_import_keeps_outer_transaction(self):
+        """Test that a failed bulk import inside a transaction block leaves the earlier writes of the block alone."""
+        with self.db.transaction():
+            assert self.db.bulk_insert_checks([('meditate', '2024-08-12'), ('meditate', '2024-08-18')])[1] == 1
+            with pytest.raises(InvalidParameterError):
+                self.db.bulk_insert_checks([('unknown', '2024-08-13')])
+        assert len(self.db.db_query_by_name('meditate', 'all', 'checkdata')) == 11
+
+    def test_create_habits_in_bulk(self, tmp_path):
+        """Test that bulk creation validates every definition first, skips existing habits and computes the streaks of their checks."""
+        day = lambda days_ago: (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+        habit_file = tmp_path / 'habits.jsonl'
+        habit_file.write_text("\n".join(json.dumps(definition) for definition in [
+            {'name': 'Run', 'description': 'Run 5k', 'priority': 6, 'periodicity': 'weekly', 'creation_time': day(40), 'checks': [day(35), day(28), day(14)]},
+            {'name': 'Floss', 'description': 'Floss', 'priority': '3', 'periodicity': 'DAILY'},
+            {'name': 'meditate', 'description': 'Exists already', 'priority': 1, 'periodicity': 'DAILY', 'checks': [day(0)]},
+        ]))
+        created, skipped, checks = create_habits(self.db, read_habit_file(str(habit_file)))
+        assert (created, skipped, checks) == (['Run', 'Floss'], ['meditate'], 3)
+        assert len(self.db.db_query_by_name('meditate', 'all', 'checkdata')) == 10
+        stored = self.db.db_query_by_name('Run', 'all', 'streakdata')
+        self.db.clear_streaks_for_habit('Run')
+        Streaks(self.db, 'Run')
+        assert stored == self.db.db_query_by_name('Run', 'all', 'streakdata')
+        assert self.db.load_habit('Run').longest_streak == 2
+        invalid = [{'name': 'Valid', 'description': 'x', 'priority': 2, 'periodicity': 'DAILY'},
+                   {'name': 'Priority', 'description': 'x', 'priority': 11, 'periodicity': 'DAILY'},
+                   {'name': 'Monthly', 'description': 'x', 'priority': 2, 'periodicity': 'MONTHLY'},
+                   {'name': 'Future', 'description': 'x', 'priority': 2, 'periodicity': 'DAILY', 'checks': [day(-3)]}]
+        with pytest.raises(InvalidParameterError, match="3 invalid habit definition"):
+            create_habits(self.db, invalid)
+        assert self.db.load_habit('Valid') is None
+        init_predefined_habits(self.db, ['reading', 'cdcworkout', 'meditate'])
+        assert [name for name, in self.db.db_query_by_name('all', 'name', 'habitdata')][-4:] == ['Run', 'Floss', 'reading', 'CDC workout']
+
+    def test_foreign_keys_cascade_deletes(self, tmp_path):
+        """Test that foreign keys are enforced, deleting a habit cascades and the migration removes rows of deleted habits."""
+        with pytest.raises(sqlite3.IntegrityError):
+            self.db.db_insert_check([('Missing Habit', '2024-08-13', 1)])
+        self.db.refresh_stats()
+        self.db.delete_habit('meditate')
+        for table in CHILD_TABLES:
+            assert self.db.cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE name = 'meditate'").fetchone()[0] == 0
+        db_path = str(tmp_path / 'orphans.db')
+        file_db = DataBase(db_path)
+        init_predefined_habits(file_db, 'meditate')
+        file_db.cursor.execute("PRAGMA foreign_keys = OFF")
+        file_db.cursor.execute("DELETE FROM habitdata")
+        file_db.cursor.execute("PRAGMA user_version = 5")
+        file_db.connection.commit()
+        file_db.close()
+        migrated_db = DataBase(db_path)
+        assert all(migrated_db.cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0 for table in CHILD_TABLES)
+        migrated_db.close()
+
+    def test_archive_and_compact(self, tmp_path):
+        """Test that inactive habits are archived to a file create_habits reads back and that compact shrinks the file."""
+        db_path = str(tmp_path / 'churn.db')
+        file_db = DataBase(db_path)
+        start = datetime.now().date() - timedelta(days=200)
+        create_habits(file_db, [
+            {'name': f'Habit {number}', 'description': 'Churn', 'priority': number % 2 + 1, 'periodicity': 'DAILY', 'creation_time': start.isoformat(),
+             'checks': [(start + timedelta(days=offset)).isoformat() for offset in range(0, 100 if number % 3 else 190)]}
+            for number in range(60)
+        ])
+        inactive_since = (start + timedelta(days=150)).isoformat()
+        expected = list(file_db.iter_habit_definitions(inactive_since, priority=1))
+        archive = tmp_path / 'archive.jsonl'
+        deleted = archive_habits(file_db, str(archive), inactive_since, priority=1)
+        assert deleted == [definition['name'] for definition in expected] and len(deleted) == 20
+        assert [json.loads(line) for line in archive.read_text().splitlines()] == expected
+        assert archive_habits(file_db, None, inactive_since) == [f'Habit {number}' for number in range(60) if number % 3 and number % 2]
+        page_count, freelist_count, _ = file_db.query_storage()
+        assert freelist_count > 0
+        assert file_db.compact()[:2] == (page_count, page_count - freelist_count)
+        assert file_db.query_storage()[1] == 0 and file_db.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        created, _, checks = create_habits(file_db, read_habit_file(str(archive)))
+        assert created == deleted and checks == sum(len(definition['checks']) for definition in expected)
+        with pytest.raises(InvalidParameterError):
+            file_db.delete_habits()
+        # files created before incremental auto_vacuum are switched by their first compact
+        file_db.cursor.execute("PRAGMA auto_vacuum = NONE")
+        file_db.cursor.execute("VACUUM")
+        file_db.compact()
+        assert file_db.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        file_db.close()
+        # the WAL mode of the concurrent profile must not keep a new file from getting incremental auto_vacuum
+        concurrent_db = DataBase(str(tmp_path / 'concurrent.db'), profile="concurrent")
+        assert concurrent_db.cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert concurrent_db.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        concurrent_db.close()
+
+    def test_lazy_database(self, tmp_path, monkeypatch):
+        """Test that the database file is only opened and given its schema on first use."""
+        db_path = tmp_path / 'lazy.db'
+        monkeypatch.setenv(DB_PATH_ENV, str(db_path))
+        lazy_db = LazyDataBase()
+        assert not db_path.exists()
+        assert lazy_db.db_query_by_name("all", "name", "habitdata") == []
+        assert lazy_db.cursor.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        lazy_db.close()
+
+    def test_cli_rebuild_streaks_without_db_option(self, tmp_path, monkeypatch):
+        """Test that rebuild-streaks with workers finds the default database file through the lazy database."""
+        db_path = str(tmp_path / DEFAULT_DB_PATH)
+        file_db = DataBase(db_path)
+        init_predefined_habits(file_db, ['meditate', 'reading', 'cdcworkout'])
+        expected = sorted(file_db.db_query_by_name('all', 'all', 'streakdata'))
+        file_db.close()
+        monkeypatch.delenv(DB_PATH_ENV, raising=False)
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(cli, 'db', LazyDataBase())
+        result = CliRunner().invoke(cli.interface, ['rebuild-streaks', '--workers', '2'])
+        cli.db.close()
+        assert result.exit_code == 0, result.output
+        assert 'Rebuilt' in result.output
+        check_db = DataBase(db_path)
+        assert sorted(check_db.db_query_by_name('all', 'all', 'streakdata')) == expected
+        check_db.close()
+
+    def test_transaction_rolls_back_all_writes(self):
+        """Test that a failing unit of work leaves none of its writes behind."""
+        habit = Habit(self.db, 'Rolled Back', 'Test Description', 3, Periodicity.DAILY)
+        with pytest.raises(InvalidParameterError):
+            with self.db.transaction():
+                self.db.db_insert(habit)
+                self.db.delete_habit('meditate')
+                raise InvalidParameterError("abort")
+        assert self.db.db_query_by_name('Rolled Back', 'all', 'habitdata') == []
+        assert self.db.db_query_by_name('meditate', 'name', 'habitdata') == [('meditate',)]
+
+    def test_concurrent_checkers_and_readers(self, tmp_path):
+        """Stress test with checking threads, each with its own connection, and pooled readers on one database file."""
+        db_path = str(tmp_path / 'concurrent.db')
+        checkers, readers, days = 4, 4, 15
+        setup_db = DataBase(db_path, profile="concurrent")
+        for number in range(checkers):
+            habit = Habit(setup_db, f'Concurrent {number}', 'Concurrent checks', 5, Periodicity.DAILY)
+            habit.creation_time = datetime.now() - timedelta(days=days)
+            setup_db.db_insert(habit)
+        pool = ConnectionPool(db_path, size=2)
+        errors = []
+
+        def check(number):
+            checker_db = DataBase(db_path, profile="concurrent")
+            habit = Habit(checker_db, f'Concurrent {number}', 'Concurrent checks', 5, Periodicity.DAILY)
+            for day in range(days, 0, -1):
+                date = (datetime.now() - timedelta(days=day)).strftime('%Y-%m-%d')
+                habit.check(habit.name, date, date)
+            checker_db.close()
+
+        def read():
+            for _ in range(days):
+                with pool.reader() as read_db:
+                    Analyse(read_db).max_typ('longest_streak')
+
+        def run(target, *args):
+            try:
+                target(*args)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(check, number)) for number in range(checkers)]
+        threads += [threading.Thread(target=run, args=(read,)) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+        assert errors == []
+        assert setup_db.cursor.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        for number in range(checkers):
+            assert Streaks(setup_db, f'Concurrent {number}', rebuild=False).longest_streak() == (days, 0)
+        setup_db.close()
+
+    def test_hot_queries_use_indexes(self):
+        """Test through EXPLAIN QUERY PLAN that the per habit streak and check queries don't scan their tables."""
+        statements = []
+        # the setup cached the habit, the habitdata lookup is only made again after this
+        self.db.habits.invalidate()
+        self.db.connection.set_trace_callback(statements.append)
+        streaks = Streaks(self.db, 'meditate', rebuild=False)
+        streaks.current_streak()
+        streaks.longest_streak()
+        self.db.query_check_bounds('meditate')
+        self.db.load_check_history('meditate', '2024-08-20')
+        self.db.clear_streaks_for_habit('meditate')
+        self.db.connection.set_trace_callback(None)
+        queries = [statement for statement in statements if statement.startswith(('SELECT', 'DELETE'))]
+        assert len(queries) == 7
+        for query in queries:
+            plan = " ".join(row[3] for row in self.db.cursor.execute(f"EXPLAIN QUERY PLAN {query}"))
+            assert "USING" in plan and "INDEX" in plan, f"{query} does not use an index: {plan}"
+            assert "idx_streakdata_name_type_count" in plan or "sqlite_autoindex_checkdata_1" in plan or "sqlite_autoindex_habitdata_1" in plan
+
+    def test_migrate_adds_indexes(self, tmp_path):
+        """Test that a database file without indexes gets them once it is opened."""
+        db_path = str(tmp_path / 'old.db')
+        old_db = DataBase(db_path)
+        old_db.cursor.execute("DROP INDEX idx_streakdata_name_type_count")
+        old_db.cursor.execute("PRAGMA user_version = 1")
+        old_db.close()
+        migrated_db = DataBase(db_path)
+        indexes = migrated_db.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        assert ('idx_streakdata_name_type_count',) in indexes
+        assert migrated_db.cursor.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        migrated_db.close()
+
+    def test_stats_cache_invalidation(self):
+        """Test that the cached habit stats are recomputed after a check and on the next day."""
+        today = datetime.now().date()
+        assert self.db.refresh_stats() == 2
+        assert self.db.refresh_stats() == 0
+        row = self.db.query_habits(["current_streak", "longest_break", "total_checks"], "meditate").fetchone()
+        assert row == (0, (today - datetime(2024, 8, 31).date()).days - 1, 10)
+        habit = Habit(self.db, 'meditate', 'Meditation', 8, Periodicity.DAILY)
+        habit.check('meditate', (today - timedelta(days=1)).isoformat(), today.isoformat())
+        assert self.db.cursor.execute("SELECT COUNT(*) FROM habitstats WHERE name = 'meditate'").fetchone()[0] == 0
+        assert Analyse(self.db).max_typ("total_checks") == "meditate"
+        row = self.db.query_habits(["current_streak", "total_checks", "completion_rate"], "meditate").fetchone()
+        assert row[:2] == (2, 12)
+        assert 0 < row[2] < 1
+        assert self.db.refresh_stats(today=today + timedelta(days=1)) == 2
+
+    def test_stats_of_single_check_habit(self):
+        """Test that the cached stats of a habit with a single check have no open break, like its stored streaks."""
+        habit = Habit(self.db, 'Test Habit', 'Test Description', 8, Periodicity.DAILY)
+        self.db.cursor.execute("UPDATE habitdata SET creation_time = ? WHERE name = 'Test Habit'", ((datetime.now() - timedelta(days=20)).toordinal(),))
+        day = (datetime.now() - timedelta(days=10)).strftime('%Y-%m-%d')
+        habit.check('Test Habit', day, day)
+        self.db.refresh_stats()
+        stored = self.db.cursor.execute("SELECT longest_break FROM habitdata WHERE name = 'Test Habit'").fetchone()
+        cached = self.db.cursor.execute("SELECT longest_break FROM habitstats WHERE name = 'Test Habit'").fetchone()
+        assert stored == cached == (0,)
+
+    def test_check_bitmap_matches_checkdata(self):
+        """Test that the check bitmaps kept by the write path count the same checks as checkdata for any range."""
+        creation_time = datetime.now() - timedelta(days=800)
+        weekly = Habit(self.db, 'Weekly Habit', 'Test Description', 5, Periodicity.WEEKLY)
+        weekly.creation_time = creation_time
+        self.db.db_insert(weekly)
+        self.db.cursor.execute("UPDATE habitdata SET creation_time = ? WHERE name = 'Test Habit'", (creation_time.toordinal(),))
+        rng = random.Random(3)
+        first_day = creation_time.date()
+        checks = [('Test Habit', (first_day + timedelta(days=day)).isoformat()) for day in range(800) if rng.random() < 0.6]
+        checks += [('Weekly Habit', (first_day + timedelta(days=day)).isoformat()) for day in range(0, 800, 7) if rng.random() < 0.6]
+        import_checks(self.db, checks)
+        Habit(self.db, 'Test Habit', 'Test Description', 8, Periodicity.DAILY).check('Test Habit')
+        for name in ('Test Habit', 'Weekly Habit', 'meditate'):
+            bitmap = self.db.load_check_bitmap(name)
+            history = self.db.load_check_history(name)
+            for _ in range(20):
+                start, end = sorted(rng.sample(range(-10, 810), 2))
+                start_date, end_date = first_day + timedelta(days=start), first_day + timedelta(days=end)
+                if name == 'Weekly Habit':
+                    start_date, end_date = adjust_week(start_date), adjust_week(end_date) + timedelta(days=6)
+                assert bitmap.count_between(start_date, end_date) == history.count_between(start_date, end_date)
+        rates = Analyse(self.db).completion('Weekly Habit', first_day.isoformat(), datetime.now().date().isoformat())
+        assert rates[0][1] == len(self.db.load_check_history('Weekly Habit'))
+        today = datetime.now().date()
+        assert Analyse(self.db).completion('meditate', '2024-08-12', '2030-12-31') == Analyse(self.db).completion('meditate', '2024-08-12', today.isoformat())
+        assert Analyse(self.db).completion('meditate', '2024-08-12', '2024-08-31', today=datetime(2024, 8, 21).date())[0][1:3] == (5, 10)
+        for name in ('all', 'Missing Habit'):
+            with pytest.raises(InvalidParameterError):
+                Analyse(self.db).heatmap(name)
+        assert 'meditate' in Analyse(self.db).checked_on('2024-08-21').split(', ')
+        assert 'meditate' not in Analyse(self.db).checked_on('2024-08-23').split(', ')
+
+    def test_migrate_fills_check_bitmaps(self, tmp_path):
+        """Test that opening a database from before the check bitmaps builds them from the existing checks."""
+        db_path = str(tmp_path / 'old.db')
+        old_db = DataBase(db_path)
+        init_predefined_habits(old_db, 'meditate')
+        old_db.cursor.execute("DROP TABLE checkbitmap")
+        old_db.cursor.execute("PRAGMA user_version = 3")
+        old_db.close()
+        migrated_db = DataBase(db_path)
+        bitmap = migrated_db.load_check_bitmap('meditate')
+        assert bitmap.count_between('2024-08-01', '2024-09-01') == 10
+        assert '2024-08-21' in bitmap and '2024-08-23' not in bitmap
+        migrated_db.close()
+
+    def test_migrate_converts_dates_to_day_ordinals(self, tmp_path):
+        """Test that opening a database with date strings converts them to day ordinals in batches without changing what is read."""
+        db_path = str(tmp_path / 'old.db')
+        old_db = DataBase(db_path)
+        init_predefined_habits(old_db, 'meditate')
+        expected = [old_db.db_query_by_name('all', 'all', table) for table in ('habitdata', 'checkdata', 'streakdata')]
+        # the layout before version 5, dates as year-month-day strings and the creation time as a timestamp
+        old_db.cursor.execute("UPDATE habitdata SET creation_time = date(creation_time + 1721424.5) || ' 09:30:00.000000'")
+        old_db.cursor.execute("UPDATE checkdata SET datemodify = date(datemodify + 1721424.5)")
+        old_db.cursor.execute("UPDATE streakdata SET start_date = date(start_date + 1721424.5), end_date = date(end_date + 1721424.5)")
+        old_db.cursor.execute("PRAGMA user_version = 4")
+        old_db.connection.commit()
+        assert old_db.convert_dates(batch_size=3) == 1 + 10 + len(expected[2])
+        old_db.cursor.execute("UPDATE checkdata SET datemodify = date(datemodify + 1721424.5)")
+        old_db.connection.commit()
+        old_db.close()
+        migrated_db = DataBase(db_path)
+        assert migrated_db.cursor.execute("SELECT DISTINCT typeof(datemodify) FROM checkdata").fetchall() == [('integer',)]
+        assert [migrated_db.db_query_by_name('all', 'all', table) for table in ('habitdata', 'checkdata', 'streakdata')] == expected
+        assert migrated_db.cursor.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        migrated_db.close()
+
+    def test_export_chunks_filters_in_sql(self):
+        """Test that exports are fetched in chunks and filtered by name, date range and periodicity."""
+        columns, chunks = self.db.export_chunks('checkdata', name='meditate', start='2024-08-17', end='2024-08-27', chunk_size=3)
+        chunks = list(chunks)
+        assert columns == ['name', 'date', 'datemodify', 'checks']
+        assert [len(rows) for rows in chunks] == [3, 3]
+        assert [row[2] for rows in chunks for row in rows] == ['2024-08-17', '2024-08-20', '2024-08-21', '2024-08-22', '2024-08-26', '2024-08-27']
+        weekly = Habit(self.db, 'Weekly Habit', 'Test Description', 5, Periodicity.WEEKLY)
+        self.db.db_insert(weekly)
+        _, chunks = self.db.export_chunks('habitdata', periodicity=Periodicity.WEEKLY)
+        assert [row[0] for rows in chunks for row in rows] == ['Weekly Habit']
+        _, chunks = self.db.export_chunks('streakdata', start='2024-08-18', end='2024-08-22')
+        assert [row[1:] for rows in chunks for row in rows] == [('2024-08-18', '2024-08-20', 'break', 2), ('2024-08-20', '2024-08-22', 'streak', 3)]
+        with pytest.raises(InvalidParameterError):
+            self.db.export_chunks('sqlite_master')
+
+    @pytest.mark.parametrize("file_format", ["csv", "jsonl", "parquet"])
+    def test_export_table_formats(self, tmp_path, file_format):
+        """Test that every export format holds all rows of the exported table."""
+        if file_format == "parquet":
+            pytest.importorskip("pyarrow")
+        path = str(tmp_path / f"checks.{file_format}")
+        assert export_table(self.db, 'checkdata', path, chunk_size=4) == 10
+        if file_format == "parquet":
+            import pyarrow.parquet
+            rows = pyarrow.parquet.read_table(path).to_pylist()
+        else:
+            rows = list(read_check_file(path))
+        assert len(rows) == 10
+
+    def test_service_coalesces_concurrent_checks(self, tmp_path):
+        """Test that concurrent checks through the async store are committed in shared batches and a failing one doesn't affect the others."""
+        db_path = str(tmp_path / 'service.db')
+        setup_db = DataBase(db_path)
+        habit = Habit(setup_db, 'Service Habit', 'Test Description', 5, Periodicity.DAILY)
+        habit.creation_time = datetime.now() - timedelta(days=30)
+        setup_db.db_insert(habit)
+        setup_db.close()
+        days = [(datetime.now() - timedelta(days=day)).strftime('%Y-%m-%d') for day in range(20)]
+
+        async def run():
+            async with AsyncHabitStore(db_path, readers=2) as store:
+                results = await asyncio.gather(
+                    *(store.check('Service Habit', day, day) for day in days), store.check('Missing Habit'), return_exceptions=True
+                )
+                server = await start_service(store, port=0)
+                host, port = server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                body = json.dumps({"jsonrpc": "2.0", "method": "max_value", "params": {"type": "total_checks"}, "id": 7}).encode()
+                writer.write(f"POST / HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                response = json.loads((await reader.read()).split(b"\r\n\r\n", 1)[1])
+                server.close()
+                return results, store.batches, response
+
+        results, batches, response = asyncio.run(run())
+        assert results[:-1] == ['Service Habit'] * 20
+        assert isinstance(results[-1], InvalidParameterError)
+        assert batches <= 2
+        assert response == {"jsonrpc": "2.0", "result": "Service Habit", "id": 7}
+        check_db = DataBase(db_path)
+        assert Streaks(check_db, 'Service Habit', rebuild=False).longest_streak()[0] == 20
+        check_db.close()
+
+    def test_service_isolates_bad_requests_and_refreshes_stats(self, tmp_path):
+        """Test that a malformed write only fails itself, bad params get JSON-RPC errors and reads refresh stats from an earlier day."""
+        db_path = str(tmp_path / 'service.db')
+        setup_db = DataBase(db_path)
+        init_predefined_habits(setup_db, 'meditate')
+        setup_db.close()
+        today = datetime.now().strftime('%Y-%m-%d')
+        call = lambda store, method, params: dispatch(store, json.dumps({"jsonrpc": "2.0", "method": method, "params": params, "id": 1}))
+
+        async def run():
+            async with AsyncHabitStore(db_path, readers=2) as store:
+                results = await asyncio.gather(
+                    store.create('Bad Priority', 'Test Description', '5', 'DAILY'), store.check('meditate', today, today), return_exceptions=True
+                )
+                responses = [
+                    await call(store, "heatmap", {"name": "meditate", "days": "x"}),
+                    await call(store, "create", {"name": "Coerced", "description": "Test Description", "priority": "5", "periodicity": "DAILY"}),
+                    await call(store, "checked_on", {"date": 20240812}),
+                ]
+                store.stats_day = None
+                # stats as an idle service still had them from yesterday
+                with sqlite3.connect(db_path) as connection:
+                    connection.execute("UPDATE habitstats SET as_of = as_of - 1, current_streak = 0")
+                responses.append(await call(store, "max_value", {"type": "current_streak"}))
+                return results, responses
+
+        results, responses = asyncio.run(run())
+        assert isinstance(results[0], TypeError) and results[1] == 'meditate'
+        assert responses[0]["error"]["code"] == -32602 and responses[2]["error"]["code"] == -32602
+        assert responses[1]["result"] == 'Coerced'
+        assert responses[3]["result"] == 'meditate'
+        check_db = DataBase(db_path)
+        assert check_db.load_habit('Bad Priority') is None and check_db.load_habit('Coerced').priority == 5
+        assert datetime.now().toordinal() in check_db.query_check_dates('meditate')
+        check_db.close()
+
+    def test_service_readers_see_deleted_and_recreated_habits(self, tmp_path):
+        """Test that the read only connections of the service don't answer from habit metadata the writer changed."""
+        db_path = str(tmp_path / 'service.db')
+        DataBase(db_path).close()
+        today = datetime.now().strftime('%Y-%m-%d')
+
+        async def run():
+            async with AsyncHabitStore(db_path, readers=1) as store:
+                await store.create('Changing', 'Test Description', 5, 'DAILY')
+                await store.check('Changing', today, today)
+                daily = await store.completion_rate('Changing', today, today)
+                await store.delete('Changing')
+                try:
+                    await store.completion_rate('Changing', today, today)
+                    deleted = None
+                except InvalidParameterError as error:
+                    deleted = error
+                await store.create('Changing', 'Test Description', 5, 'WEEKLY')
+                return daily, deleted, await store.heatmap('Changing', 14)
+
+        daily, deleted, heatmap = asyncio.run(run())
+        assert daily == [('Changing', 1, 1, 1.0)]
+        assert isinstance(deleted, InvalidParameterError)
+        # a weekly habit is drawn as a single row of weeks instead of one row per weekday
+        assert len(heatmap.splitlines()) == 2
+
+    def test_shard_router_isolates_users(self, tmp_path):
+        """Test that users get their own habits with the same names, the LRU closes old shards and Analyse fans out over all of them."""
+        router = ShardRouter(str(tmp_path / 'shards'), max_open=2)
+        for user, priority, name in (('alice', 3, 'reading'), ('bob', 9, 'reading'), ('carol/eve', 9, 'reading, writing')):
+            shard = router.get(user)
+            shard.db_insert(Habit(shard, name, 'Test Description', priority, Periodicity.DAILY))
+        assert list(router.open_shards) == ['bob', 'carol/eve']
+        assert router.users() == ['alice', 'bob', 'carol/eve']
+        assert router.get('alice').load_habit('reading').priority == 3
+        analyse = ShardedAnalyse(router)
+        assert analyse.max_typ('priority') == 'bob/reading, carol/eve/reading, writing'
+        # a comma in a habit name must not split it into two habits
+        assert analyse.same('periodicity', 'DAILY') == 'alice/reading, bob/reading, carol/eve/reading, writing'
+        router.close()
+        assert router.open_shards == {}
+
+    def test_overlapping_range_checks(self):
+        """Test that overlapping range checks only add the missing days and leave the streaks of a full rebuild."""
+        habit = Habit(self.db, 'Test Habit', 'Test Description', 8, Periodicity.DAILY)
+        self.db.cursor.execute("UPDATE habitdata SET creation_time = ? WHERE name = 'Test Habit'", ((datetime.now() - timedelta(days=400)).toordinal(),))
+        day = lambda days_ago: (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+        assert habit.check('Test Habit', day(300), day(200)) == 101
+        assert habit.check('Test Habit', day(250), day(150)) == 50
+        assert habit.check('Test Habit', day(250), day(150)) == 0
+        assert habit.check('Test Habit', day(360), day(355)) == 6
+        incremental = self.db.db_query_by_name('Test Habit', 'all', 'streakdata')
+        self.db.clear_streaks_for_habit('Test Habit')
+        Streaks(self.db, 'Test Habit')
+        assert incremental == self.db.db_query_by_name('Test Habit', 'all', 'streakdata')
+        assert self.db.load_check_bitmap('Test Habit').count_between(day(400), day(0)) == 157
+        weekly = Habit(self.db, 'Weekly Habit', 'Test Description', 5, Periodicity.WEEKLY)
+        weekly.creation_time = datetime.now() - timedelta(days=100)
+        self.db.db_insert(weekly)
+        assert weekly.check('Weekly Habit', day(70), day(0)) == 11
+        assert self.db.query_check_bounds('Weekly Habit')[2] == 11
+
+    def test_reversed_range_check_writes_nothing(self, monkeypatch):
+        """Test that a check range that ends before it starts is refused before anything is written."""
+        habit = Habit(self.db, 'meditate', 'Test Description', 8, Periodicity.DAILY)
+        checks = self.db.query_check_bounds('meditate')
+        streaks = self.db.db_query_by_name('meditate', 'all', 'streakdata')
+        with pytest.raises(InvalidParameterError):
+            habit.check('meditate', '2024-08-25', '2024-08-23')
+        with pytest.raises(InvalidParameterError):
+            self.db.insert_check_range('meditate', '2024-08-25', 0, 1)
+        assert self.db.query_check_bounds('meditate') == checks
+        assert self.db.db_query_by_name('meditate', 'all', 'streakdata') == streaks
+        monkeypatch.setattr(cli, 'db', self.db)
+        result = CliRunner().invoke(cli.check, ['--name', 'meditate', '--startdate', '2024-08-25', '--enddate', '2024-08-23'])
+        assert 'Error: The end of the time frame is before its start' in result.output
+
+    def test_typed_queries_and_whitelist(self):
+        """Test that the typed queries return plain values and that db_query_by_name only reads whitelisted columns."""
+        assert self.db.query_schedule('meditate') == (Periodicity.DAILY, datetime(2024, 8, 12).toordinal())
+        assert self.db.query_schedule('Missing Habit') is None
+        assert self.db.query_check_dates('meditate')[:2] == [datetime(2024, 8, 12).toordinal(), datetime(2024, 8, 16).toordinal()]
+        assert self.db.db_query_by_name('meditate', 'priority', 'habitdata') == [(8,)]
+        for typ, tb in (("COUNT(1)", "habitdata"), ("name FROM habitdata; DROP TABLE habitdata --", "habitdata"), ("name", "sqlite_master")):
+            with pytest.raises(InvalidParameterError):
+                self.db.db_query_by_name('meditate', typ, tb)
+
+    def test_habit_cache_single_lookup(self):
+        """Test that a check reads the habit metadata once, and that deletes, rollbacks and the size limit drop cached habits."""
+        self.db.habits.invalidate()
+        misses = self.db.habits.misses
+        statements = []
+        self.db.connection.set_trace_callback(statements.append)
+        check_habit(self.db, 'meditate')
+        self.db.connection.set_trace_callback(None)
+        assert len([statement for statement in statements if "FROM habitdata WHERE name" in statement]) == 1
+        assert self.db.habits.misses == misses + 1 and self.db.habits.hits > 0
+        habit = Habit(self.db, 'Rolled Back', 'Test Description', 3, Periodicity.DAILY)
+        with pytest.raises(InvalidParameterError):
+            with self.db.transaction():
+                self.db.db_insert(habit)
+                assert self.db.query_schedule('Rolled Back') is not None
+                raise InvalidParameterError("roll back")
+        assert self.db.query_schedule('Rolled Back') is None
+        self.db.delete_habit('meditate')
+        assert self.db.query_schedule('meditate') is None and self.db.load_habit('meditate') is None
+        self.db.habits.max_size = 2
+        for name in ('First', 'Second', 'Third'):
+            self.db.db_insert(Habit(self.db, name, 'Test Description', 3, Periodicity.WEEKLY))
+            self.db.query_schedule(name)
+        assert list(self.db.habits.schedules) == ['Second', 'Third']
+
+    def test_rollover_matches_rebuild(self):
+        """Test that rolling streaks computed yesterday over to today gives the streaks of a rebuild today, also when it runs twice."""
+        today = datetime.now().date()
+        creation_time = datetime.now() - timedelta(days=60)
+        habits = {'Yesterday': (Periodicity.DAILY, 1), 'Two Days': (Periodicity.DAILY, 2), 'Ten Days': (Periodicity.DAILY, 10),
+                  'Weekly Habit': (Periodicity.WEEKLY, 2), 'Single Check': (Periodicity.DAILY, 5)}
+        checks = []
+        for name, (periodicity, last) in habits.items():
+            habit = Habit(self.db, name, 'Test Description', 5, periodicity)
+            habit.creation_time = creation_time
+            self.db.db_insert(habit)
+            step = 7 if periodicity == Periodicity.WEEKLY else 1
+            days = [last] if name == 'Single Check' else range(last + 6 * step, last - 1, -step)
+            checks += [(name, (today - timedelta(days=day)).isoformat()) for day in days]
+        import_checks(self.db, checks)
+        rebuild_all_streaks(self.db, workers=1, backend="python")
+        expected_streaks = sorted(self.db.db_query_by_name('all', 'all', 'streakdata'))
+        expected_habits = self.db.db_query_by_name('all', 'all', 'habitdata')
+        # the streaks as a rebuild yesterday left them, with stale current streaks, from the SQL backend as it takes
+        # the day to compute them for (NumPy is optional)
+        self.db.cursor.execute("DELETE FROM streakdata")
+        self.db.insert_streaks_sql(today - timedelta(days=1))
+        self.db.cursor.execute("UPDATE habitdata SET current_streak = 99, longest_break = 0 WHERE current_streak IS NOT NULL")
+        assert rollover(self.db)[:2] == (2, 2)
+        assert sorted(self.db.db_query_by_name('all', 'all', 'streakdata')) == expected_streaks
+        assert self.db.db_query_by_name('all', 'all', 'habitdata') == expected_habits
+        assert rollover(self.db)[:2] == (0, 0)
+        assert sorted(self.db.db_query_by_name('all', 'all', 'streakdata')) == expected_streaks
+
     def teardown_method(self):
         """Teardown method to clear the database after each test."""
         self.db.clear_all_tables()
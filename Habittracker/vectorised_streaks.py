@@ -0,0 +1,85 @@
+"""NumPy backend for the streak computation of habit_tracker, it finds the streaks and breaks of many habits in one pass.
+NumPy is optional, HAS_NUMPY tells whether the backend can be used. NumPy is only imported once the backend runs,
+importing it takes longer than starting the CLI without it."""
+import importlib.util
+
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+
+# types of the pairs of consecutive checks
+NO_CHANGE = 0
+STREAK = 1
+BREAK = 2
+# the pair between the last check of one habit and the first check of the next one
+HABIT_BOUNDARY = 3
+
+def calculate_streaks_vectorised(habits, today):
+    """Returns {name: streak_list} with the same (name, start_day, end_day, type, count) tuples as Streaks.calculate_streaks
+    for a list of (name, delta_days, creation_day, sorted checked days) habits, all days and today as day ordinals"""
+    import numpy as np
+    streaks = {}
+    names, deltas, creation_days, lengths, all_days = [], [], [], [], []
+    for name, delta_days, creation_day, check_days in habits:
+        if not check_days:
+            streaks[name] = []
+        elif len(check_days) == 1:
+            # like calculate_streaks a single check is a streak of 1 without any breaks
+            streaks[name] = [(name, check_days[0], check_days[0], "streak", 1)]
+        else:
+            names.append(name)
+            deltas.append(delta_days)
+            creation_days.append(creation_day)
+            lengths.append(len(check_days))
+            all_days.extend(check_days)
+    if not names:
+        return streaks
+
+    days = np.array(all_days, dtype=np.int64)
+    lengths = np.array(lengths)
+    last_check = np.cumsum(lengths) - 1
+    first_check = last_check - lengths + 1
+    habit_of_pair = np.repeat(np.arange(len(names)), lengths)[:-1]
+    pair_delta = np.array(deltas)[habit_of_pair]
+    difference = np.diff(days)
+    pair_type = np.where(difference == pair_delta, STREAK, np.where(difference > pair_delta, BREAK, NO_CHANGE))
+    pair_type[last_check[:-1]] = HABIT_BOUNDARY
+
+    # run-length encoding of the pair types, pairs closer than the periodicity change nothing and are left out
+    pairs = np.flatnonzero(pair_type != NO_CHANGE)
+    runs = {index: [] for index in range(len(names))}
+    if pairs.size:
+        types = pair_type[pairs]
+        run_starts = np.flatnonzero(np.r_[True, types[1:] != types[:-1]])
+        run_first_pair = pairs[run_starts]
+        run_type = types[run_starts]
+        # a segment ends on the check where the next segment starts, the last one on the last check
+        run_end = np.r_[days[pairs[run_starts[1:]]], days[-1]]
+        run_pairs = np.diff(np.r_[run_starts, pairs.size])
+        missed = np.add.reduceat(difference[pairs] - 1, run_starts)
+        run_start = np.where(run_type == STREAK, days[run_first_pair], days[run_first_pair] + 1)
+        run_count = np.where(run_type == STREAK, run_pairs + 1, missed)
+        keep = run_type != HABIT_BOUNDARY
+        for habit, start, end, streak_type, count in zip(
+            habit_of_pair[run_first_pair][keep].tolist(),
+            run_start[keep].tolist(),
+            run_end[keep].tolist(),
+            run_type[keep].tolist(),
+            run_count[keep].tolist(),
+        ):
+            runs[habit].append((names[habit], start, end, "streak" if streak_type == STREAK else "break", count))
+
+    first_days = days[first_check]
+    last_days = days[last_check]
+    leading = (first_days - np.array(creation_days, dtype=np.int64)).tolist()
+    trailing = (today - last_days - 1).tolist()
+    before_first = (first_days - 1).tolist()
+    after_last = (last_days + 1).tolist()
+    for index, name in enumerate(names):
+        streak_list = []
+        # the break between the creation and the first check, and the one between the last check and today
+        if leading[index] > 0:
+            streak_list.append((name, creation_days[index], before_first[index], "break", leading[index]))
+        streak_list.extend(runs[index])
+        if trailing[index] > 0:
+            streak_list.append((name, after_last[index], today, "break", trailing[index]))
+        streaks[name] = streak_list
+    return streaks